@@ -0,0 +1,292 @@
+#!/usr/bin/python3
+
+################################################################################
+#
+# Copyright 2018 Crown copyright (c)
+# Land Information New Zealand and the New Zealand Government.
+# All rights reserved
+#
+# This program is released under the terms of the new BSD license. See the
+# LICENSE file for more information.
+#
+################################################################################
+
+"""
+Generate synthetic ISO 19139 (ANZLIC profile) metadata documents
+shaped like those on the LINZ Data Service. Document sizes are
+drawn log uniformly between a min and max size and a proportion
+of the documents (the match rate) carry the CC3 licence text the
+updater is typically configured to replace.
+
+    python -m benchmarks.corpus --count 100 --out /tmp/corpus
+"""
+
+import argparse
+import math
+import os
+import random
+import re
+from xml.sax.saxutils import escape
+
+KB = 1024
+MB = 1024 * KB
+
+CC3_TEXT = 'Released under Creative Commons Attribution 3.0 New Zealand'
+CC4_TEXT = 'Released under Creative Commons Attribution 4.0 International'
+
+# Replaces the CC3 licence text wherever it is found
+CC3_TO_CC4_MAPPING = {1: {'search': CC3_TEXT, 'replace': CC4_TEXT,
+                          'ignore_case': False, 'target_element': None}}
+
+# Text found in every generated document
+COMMON_TEXT = ('LINZ - Land Information New Zealand', '155 The Terrace', 'Wellington', '6011',
+               'customersupport@linz.govt.nz', 'Data Manager', 'ANZLIC Metadata Profile',
+               'resourceProvider', 'onGoing', 'dataset')
+
+WORDS = ('survey', 'boundary', 'parcel', 'hydrographic', 'chart', 'coastline', 'topographic',
+         'aerial', 'imagery', 'elevation', 'contour', 'road', 'centreline', 'railway', 'river',
+         'lake', 'island', 'geodetic', 'mark', 'address', 'title', 'cadastral', 'land',
+         'district', 'region', 'data', 'captured', 'derived', 'updated', 'national', 'scale',
+         'accuracy', 'source', 'feature', 'attribute', 'Wellington', 'Auckland', 'Canterbury')
+
+CODE_LIST = 'http://asdd.ga.gov.au/asdd/profileinfo/gmxCodelists.xml'
+
+HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<gmd:MD_Metadata xmlns:gco="http://www.isotc211.org/2005/gco" xmlns:gmd="http://www.isotc211.org/2005/gmd" xmlns:gml="http://www.opengis.net/gml" xmlns:gts="http://www.isotc211.org/2005/gts" xmlns:xlink="http://www.w3.org/1999/xlink">
+  <gmd:fileIdentifier><gco:CharacterString>{file_id}</gco:CharacterString></gmd:fileIdentifier>
+  <gmd:language><gco:CharacterString>eng</gco:CharacterString></gmd:language>
+  <gmd:characterSet><gmd:MD_CharacterSetCode codeList="{code_list}#MD_CharacterSetCode" codeListValue="utf8">utf8</gmd:MD_CharacterSetCode></gmd:characterSet>
+  <gmd:hierarchyLevel><gmd:MD_ScopeCode codeList="{code_list}#MD_ScopeCode" codeListValue="dataset">dataset</gmd:MD_ScopeCode></gmd:hierarchyLevel>
+  <gmd:contact>
+    <gmd:CI_ResponsibleParty>
+      <gmd:individualName><gco:CharacterString>omit</gco:CharacterString></gmd:individualName>
+      <gmd:organisationName><gco:CharacterString>LINZ - Land Information New Zealand</gco:CharacterString></gmd:organisationName>
+      <gmd:positionName><gco:CharacterString>Data Manager</gco:CharacterString></gmd:positionName>
+      <gmd:contactInfo>
+        <gmd:CI_Contact>
+          <gmd:address>
+            <gmd:CI_Address>
+              <gmd:deliveryPoint><gco:CharacterString>155 The Terrace</gco:CharacterString></gmd:deliveryPoint>
+              <gmd:city><gco:CharacterString>Wellington</gco:CharacterString></gmd:city>
+              <gmd:postalCode><gco:CharacterString>6011</gco:CharacterString></gmd:postalCode>
+              <gmd:country><gco:CharacterString>New Zealand</gco:CharacterString></gmd:country>
+              <gmd:electronicMailAddress><gco:CharacterString>customersupport@linz.govt.nz</gco:CharacterString></gmd:electronicMailAddress>
+            </gmd:CI_Address>
+          </gmd:address>
+        </gmd:CI_Contact>
+      </gmd:contactInfo>
+      <gmd:role><gmd:CI_RoleCode codeList="{code_list}#CI_RoleCode" codeListValue="resourceProvider">resourceProvider</gmd:CI_RoleCode></gmd:role>
+    </gmd:CI_ResponsibleParty>
+  </gmd:contact>
+  <gmd:dateStamp><gco:Date>{date}</gco:Date></gmd:dateStamp>
+  <gmd:metadataStandardName><gco:CharacterString>ANZLIC Metadata Profile: An Australian/New Zealand Profile of AS/NZS ISO 19115:2005, Geographic information - Metadata</gco:CharacterString></gmd:metadataStandardName>
+  <gmd:metadataStandardVersion><gco:CharacterString>1.1</gco:CharacterString></gmd:metadataStandardVersion>
+  <gmd:identificationInfo>
+    <gmd:MD_DataIdentification>
+      <gmd:citation>
+        <gmd:CI_Citation>
+          <gmd:title><gco:CharacterString>{title}</gco:CharacterString></gmd:title>
+          <gmd:date><gmd:CI_Date><gmd:date><gco:Date>{date}</gco:Date></gmd:date><gmd:dateType><gmd:CI_DateTypeCode codeList="{code_list}#CI_DateTypeCode" codeListValue="publication">publication</gmd:CI_DateTypeCode></gmd:dateType></gmd:CI_Date></gmd:date>
+        </gmd:CI_Citation>
+      </gmd:citation>
+      <gmd:abstract><gco:CharacterString>{abstract}</gco:CharacterString></gmd:abstract>
+      <gmd:purpose><gco:CharacterString>{purpose}</gco:CharacterString></gmd:purpose>
+      <gmd:status><gmd:MD_ProgressCode codeList="{code_list}#MD_ProgressCode" codeListValue="onGoing">onGoing</gmd:MD_ProgressCode></gmd:status>
+'''
+
+KEYWORD = '''      <gmd:descriptiveKeywords>
+        <gmd:MD_Keywords>
+          <gmd:keyword><gco:CharacterString>{keyword}</gco:CharacterString></gmd:keyword>
+          <gmd:type><gmd:MD_KeywordTypeCode codeList="{code_list}#MD_KeywordTypeCode" codeListValue="theme">theme</gmd:MD_KeywordTypeCode></gmd:type>
+        </gmd:MD_Keywords>
+      </gmd:descriptiveKeywords>
+'''
+
+CONSTRAINTS = '''      <gmd:resourceConstraints>
+        <gmd:MD_LegalConstraints>
+          <gmd:useLimitation><gco:CharacterString>{licence}</gco:CharacterString></gmd:useLimitation>
+          <gmd:useConstraints><gmd:MD_RestrictionCode codeList="{code_list}#MD_RestrictionCode" codeListValue="license">license</gmd:MD_RestrictionCode></gmd:useConstraints>
+        </gmd:MD_LegalConstraints>
+      </gmd:resourceConstraints>
+      <gmd:topicCategory><gmd:MD_TopicCategoryCode>{topic}</gmd:MD_TopicCategoryCode></gmd:topicCategory>
+'''
+
+EXTENT = '''      <gmd:extent>
+        <gmd:EX_Extent>
+          <gmd:geographicElement>
+            <gmd:EX_GeographicBoundingBox>
+              <gmd:westBoundLongitude><gco:Decimal>{west:.7f}</gco:Decimal></gmd:westBoundLongitude>
+              <gmd:eastBoundLongitude><gco:Decimal>{east:.7f}</gco:Decimal></gmd:eastBoundLongitude>
+              <gmd:southBoundLatitude><gco:Decimal>{south:.7f}</gco:Decimal></gmd:southBoundLatitude>
+              <gmd:northBoundLatitude><gco:Decimal>{north:.7f}</gco:Decimal></gmd:northBoundLatitude>
+            </gmd:EX_GeographicBoundingBox>
+          </gmd:geographicElement>
+        </gmd:EX_Extent>
+      </gmd:extent>
+'''
+
+LINEAGE_START = '''    </gmd:MD_DataIdentification>
+  </gmd:identificationInfo>
+  <gmd:distributionInfo>
+    <gmd:MD_Distribution>
+      <gmd:transferOptions>
+        <gmd:MD_DigitalTransferOptions>
+          <gmd:onLine><gmd:CI_OnlineResource><gmd:linkage><gmd:URL>https://data.linz.govt.nz/layer/{layer_id}/</gmd:URL></gmd:linkage></gmd:CI_OnlineResource></gmd:onLine>
+        </gmd:MD_DigitalTransferOptions>
+      </gmd:transferOptions>
+    </gmd:MD_Distribution>
+  </gmd:distributionInfo>
+  <gmd:dataQualityInfo>
+    <gmd:DQ_DataQuality>
+      <gmd:scope><gmd:DQ_Scope><gmd:level><gmd:MD_ScopeCode codeList="{code_list}#MD_ScopeCode" codeListValue="dataset">dataset</gmd:MD_ScopeCode></gmd:level></gmd:DQ_Scope></gmd:scope>
+      <gmd:lineage>
+        <gmd:LI_Lineage>
+          <gmd:statement><gco:CharacterString>{statement}</gco:CharacterString></gmd:statement>
+'''
+
+PROCESS_STEP = '''          <gmd:processStep>
+            <gmd:LI_ProcessStep>
+              <gmd:description><gco:CharacterString>{description}</gco:CharacterString></gmd:description>
+              <gmd:dateTime><gco:DateTime>{date}T00:00:00</gco:DateTime></gmd:dateTime>
+            </gmd:LI_ProcessStep>
+          </gmd:processStep>
+'''
+
+FOOTER = '''        </gmd:LI_Lineage>
+      </gmd:lineage>
+    </gmd:DQ_DataQuality>
+  </gmd:dataQualityInfo>
+  <gmd:metadataConstraints>
+    <gmd:MD_LegalConstraints>
+      <gmd:useLimitation><gco:CharacterString>{licence}</gco:CharacterString></gmd:useLimitation>
+    </gmd:MD_LegalConstraints>
+  </gmd:metadataConstraints>
+</gmd:MD_Metadata>
+'''
+
+
+def compact(template):
+    """
+    Remove the whitespace between elements. LDS serves its
+    documents on one line, other than the newlines in text
+    """
+
+    return re.sub(r'>\s*\n\s*<', '><', template)
+
+
+HEADER, KEYWORD, CONSTRAINTS, EXTENT, LINEAGE_START, PROCESS_STEP, FOOTER = map(
+    compact, (HEADER, KEYWORD, CONSTRAINTS, EXTENT, LINEAGE_START, PROCESS_STEP, FOOTER))
+
+
+def sentence(rng, words=12):
+    text = ' '.join(rng.choice(WORDS) for _ in range(words))
+    return text[0].upper() + text[1:] + '.'
+
+
+def paragraph(rng, sentences=4):
+    text = ' '.join(sentence(rng, rng.randint(6, 20)) for _ in range(sentences))
+    return escape(text)
+
+
+def random_size(rng, min_size=5 * KB, max_size=5 * MB):
+    """
+    Return a size drawn log uniformly between min_size and max_size
+    """
+
+    return int(math.exp(rng.uniform(math.log(min_size), math.log(max_size))))
+
+
+def generate_document(layer_id, size, match=True, seed=None):
+    """
+    Return an ISO 19139 document (bytes) of about size bytes, or
+    the smallest complete document (6 - 7 KB) if that is larger. If
+    match the document's licence statements contain the CC3 licence text
+    """
+
+    rng = random.Random(seed if seed is not None else layer_id)
+    date = '20{0:02d}-{1:02d}-{2:02d}'.format(rng.randint(10, 24), rng.randint(1, 12), rng.randint(1, 28))
+    licence = CC3_TEXT if match else 'Crown copyright reserved'
+    west, south = rng.uniform(166.0, 178.0), rng.uniform(-47.0, -34.0)
+
+    parts = [HEADER.format(file_id='{0:08x}-0000-4000-8000-{1:012x}'.format(layer_id, rng.getrandbits(48)),
+                           code_list=CODE_LIST, date=date,
+                           title=escape(sentence(rng, 5)[:-1]),
+                           abstract=paragraph(rng, 2) + '\n\n' + paragraph(rng, 1),
+                           purpose=paragraph(rng, 1))]
+    for _ in range(rng.randint(1, 3)):
+        parts.append(KEYWORD.format(keyword=rng.choice(WORDS), code_list=CODE_LIST))
+    parts.append(CONSTRAINTS.format(licence=licence, code_list=CODE_LIST,
+                                    topic=rng.choice(('oceans', 'boundaries', 'location'))))
+    parts.append(EXTENT.format(west=west, east=west + rng.uniform(0.01, 2),
+                               south=south, north=south + rng.uniform(0.01, 2)))
+    parts.append(LINEAGE_START.format(layer_id=layer_id, code_list=CODE_LIST,
+                                      statement=paragraph(rng, 1)))
+    footer = FOOTER.format(licence=licence)
+
+    # Pad with process steps, as large LDS documents have long lineages
+    length = sum(len(part) for part in parts) + len(footer)
+    while length < size:
+        step = PROCESS_STEP.format(description=paragraph(rng, rng.randint(1, 8)), date=date)
+        parts.append(step)
+        length += len(step)
+    parts.append(footer)
+    return ''.join(parts).encode('utf-8')
+
+
+def generate_corpus(count, min_size=5 * KB, max_size=5 * MB, match_rate=0.5, seed=0, first_id=1):
+    """
+    Return a generator of (layer_id, document bytes) for count
+    documents. The same seed always returns the same corpus
+    """
+
+    rng = random.Random(seed)
+    for layer_id in range(first_id, first_id + count):
+        size = random_size(rng, min_size, max_size)
+        match = rng.random() < match_rate
+        yield layer_id, generate_document(layer_id, size, match, seed=rng.getrandbits(32))
+
+
+def make_mapping(count, match_rate=1.0):
+    """
+    Return a config Text Mapping of count mappings, of which
+    count * match_rate match every generated document. Matching
+    mappings replace the text with itself so they keep matching
+    however many are applied
+    """
+
+    matches = int(round(count * match_rate))
+    mapping = {}
+    for i in range(1, count + 1):
+        if i <= matches:
+            text = COMMON_TEXT[(i - 1) % len(COMMON_TEXT)]
+            mapping[i] = {'search': re.escape(text), 'replace': text}
+        else:
+            mapping[i] = {'search': 'Not in the corpus {0}'.format(i), 'replace': 'Unused'}
+        mapping[i].update({'ignore_case': False, 'target_element': None})
+    return mapping
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Generate a synthetic ISO 19139 corpus')
+    parser.add_argument('--count', type=int, default=100, help='Number of documents')
+    parser.add_argument('--min-kb', type=float, default=5, help='Smallest document size (KB)')
+    parser.add_argument('--max-kb', type=float, default=5 * 1024, help='Largest document size (KB)')
+    parser.add_argument('--match-rate', type=float, default=0.5,
+                        help='Proportion of documents with the CC3 licence text')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', required=True, help='Directory to write the documents to')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    os.makedirs(args.out, exist_ok=True)
+    corpus = generate_corpus(args.count, int(args.min_kb * KB), int(args.max_kb * KB),
+                             args.match_rate, args.seed)
+    for layer_id, document in corpus:
+        with open(os.path.join(args.out, '{0}.iso.xml'.format(layer_id)), 'wb') as f:
+            f.write(document)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+
+################################################################################
+#
+# Copyright 2018 Crown copyright (c)
+# Land Information New Zealand and the New Zealand Government.
+# All rights reserved
+#
+# This program is released under the terms of the new BSD license. See the
+# LICENSE file for more information.
+#
+################################################################################
+
+"""
+Measure the time taken to import metadata_updater and check none
+of the heavy dependencies are loaded at import. Exits non zero if
+the import is slower than --max-ms or a heavy module is imported.
+
+    python -m benchmarks.import_time --runs 10 --max-ms 150
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+MODULE = 'metadata_updater.metadata_updater'
+
+# Only to be imported by the code paths that need them
+HEAVY_MODULES = ('koordinates', 'requests', 'yaml', 'lxml', 'openpyxl')
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def heavy_modules_imported(module=MODULE):
+    """
+    Import the module in a fresh interpreter and return
+    the heavy modules that were loaded as a result
+    """
+
+    code = ('import json, sys; import {0}; '
+            'print(json.dumps([m for m in {1!r} if m in sys.modules]))').format(module, HEAVY_MODULES)
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=REPO_DIR)
+    return json.loads(output.decode('utf-8'))
+
+
+def import_time_us(module=MODULE):
+    """
+    Return the cumulative import time (microseconds) of
+    the module in a fresh interpreter as per -X importtime
+    """
+
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {0}'.format(module)],
+                            cwd=REPO_DIR, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, check=True)
+    for line in result.stderr.decode('utf-8').splitlines():
+        parts = [part.strip() for part in line.split('|')]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1])
+    raise RuntimeError('No import time reported for {0}'.format(module))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=10, help='Number of imports to time')
+    parser.add_argument('--max-ms', type=float, default=150.0,
+                        help='Fail if the median import time exceeds this')
+    args = parser.parse_args()
+
+    times = [import_time_us() / 1000.0 for _ in range(args.runs)]
+    median = statistics.median(times)
+    heavy = heavy_modules_imported()
+
+    print('{0}: median {1:.1f} ms, min {2:.1f} ms, max {3:.1f} ms over {4} run(s)'.format(
+        MODULE, median, min(times), max(times), args.runs))
+
+    failed = False
+    if heavy:
+        print('FAIL: heavy module(s) imported at start up: {0}'.format(', '.join(heavy)))
+        failed = True
+    if median > args.max_ms:
+        print('FAIL: median import time {0:.1f} ms exceeds {1:.1f} ms'.format(median, args.max_ms))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
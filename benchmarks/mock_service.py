@@ -0,0 +1,374 @@
+################################################################################
+#
+# Copyright 2018 Crown copyright (c)
+# Land Information New Zealand and the New Zealand Government.
+# All rights reserved
+#
+# This program is released under the terms of the new BSD license. See the
+# LICENSE file for more information.
+#
+################################################################################
+
+"""
+A local stub of the Data Service endpoints used by the metadata updater:
+layers, metadata get/set, versions/drafts, publishing and the catalog.
+
+The stub is mounted on a koordinates client's requests session as a
+transport adapter, so the koordinates client code runs unchanged but no
+network requests are made. Latency and errors can be injected.
+
+    service = MockDataService(latency=0.05, error_rate=0.01)
+    service.add_layer(1234, metadata_xml_bytes)
+    client = koordinates.Client(service.host, 'token')
+    service.install(client)
+"""
+
+import email.utils
+import gzip
+import hashlib
+import http.client
+import io
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+import requests
+import urllib3
+
+API_PATH = '/services/api/v1'
+
+CC3_LICENSE = {'id': 1, 'title': 'Creative Commons Attribution 3.0 New Zealand',
+               'type': 'cc-by', 'version': '3.0', 'jurisdiction': 'nz',
+               'url': 'https://creativecommons.org/licenses/by/3.0/nz/'}
+
+
+class MockLayer():
+    """
+    State of a layer held by the stub
+    """
+
+    def __init__(self, layer_id, metadata, title, kind, license, public_access, num_downloads):
+        self.id = layer_id
+        self.title = title
+        self.kind = kind
+        self.license = license
+        self.public_access = public_access
+        self.num_downloads = num_downloads
+        self.published_version = 1
+        self.draft_version = None
+        self.next_version = 2
+        # version id: metadata document bytes
+        self.metadata = {1: metadata}
+        # version id: Last-Modified time of the metadata
+        self.modified = {1: time.time()}
+
+
+class MockDataServiceAdapter(requests.adapters.HTTPAdapter):
+    """
+    Transport adapter that answers requests from a MockDataService
+    """
+
+    def __init__(self, service):
+        super(MockDataServiceAdapter, self).__init__()
+        self.service = service
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        status, headers, body = self.service.handle(request.method, request.url,
+                                                    request.headers, request.body)
+        raw = urllib3.HTTPResponse(body=io.BytesIO(body), headers=headers, status=status,
+                                   reason=http.client.responses.get(status, ''),
+                                   preload_content=False, decode_content=True)
+        return self.build_response(request, raw)
+
+
+class MockDataService():
+    """
+    In memory Data Service. latency is the seconds added to every
+    request (plus up to latency_jitter). error_rate is the probability
+    a request fails with error_status, limited to the paths matching
+    error_path if given. publish_delay is the seconds a publish group
+    takes to complete. Publish groups with an item of a layer in
+    failing_publishes end in the error state, publishing nothing.
+    Responses are gzipped when the client accepts
+    it and gzipped request bodies are accepted unless
+    compressed_uploads is False, when they are rejected with a 415
+    """
+
+    def __init__(self, host='mock.data.service', latency=0.0, latency_jitter=0.0, error_rate=0.0,
+                 error_status=504, error_path=None, publish_delay=0.0, page_size=100, seed=None,
+                 compressed_uploads=True, failing_publishes=()):
+        self.host = host
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.error_path = re.compile(error_path) if error_path else None
+        self.publish_delay = publish_delay
+        self.page_size = page_size
+        self.compressed_uploads = compressed_uploads
+        self.failing_publishes = set(failing_publishes)
+        self.layers = {}
+        self.publishes = {}
+        self.requests = []
+        # metadata requests answered with 304 Not Modified
+        self.not_modified = 0
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._next_publish = 1
+        self._routes = [
+            ('GET', r'/layers/(\d+)/$', self.get_layer),
+            ('GET', r'/layers/(\d+)/versions/draft/$', self.get_draft),
+            ('GET', r'/layers/(\d+)/versions/(\d+)/$', self.get_version),
+            ('POST', r'/layers/(\d+)/versions/$', self.create_draft),
+            ('DELETE', r'/layers/(\d+)/versions/(\d+)/$', self.delete_version),
+            ('GET', r'/layers/(\d+)/versions/(\d+)/metadata/(?:iso/|dc/)?$', self.get_metadata),
+            ('POST', r'/layers/(\d+)/versions/(\d+)/metadata/$', self.set_metadata),
+            ('GET', r'/data/$', self.get_catalog),
+            ('POST', r'/publish/$', self.create_publish),
+            ('GET', r'/publish/(\d+)/$', self.get_publish),
+        ]
+
+    # SET UP
+
+    def add_layer(self, layer_id, metadata, title=None, kind='vector', license=CC3_LICENSE,
+                  public_access='download', num_downloads=0):
+        """
+        Add a published layer with the metadata document (bytes)
+        """
+
+        with self._lock:
+            self.layers[int(layer_id)] = MockLayer(int(layer_id), metadata,
+                                                   title or 'Layer {0}'.format(layer_id),
+                                                   kind, license, public_access, num_downloads)
+
+    def set_published_metadata(self, layer_id, metadata):
+        """
+        Replace the metadata document (bytes) of the published version
+        """
+
+        with self._lock:
+            layer = self.layers[int(layer_id)]
+            layer.metadata[layer.published_version] = metadata
+            layer.modified[layer.published_version] = time.time()
+
+    def install(self, client):
+        """
+        Route all of the client's requests for this host to the stub
+        """
+
+        client._session.mount('https://{0}/'.format(self.host), MockDataServiceAdapter(self))
+        return client
+
+    def published_metadata(self, layer_id):
+        layer = self.layers[int(layer_id)]
+        return layer.metadata[layer.published_version]
+
+    # REQUEST HANDLING
+
+    def url(self, path):
+        return 'https://{0}{1}{2}'.format(self.host, API_PATH, path)
+
+    def handle(self, method, url, headers, body):
+        """
+        Return the (status, headers, body) response to a request
+        """
+
+        if self.latency or self.latency_jitter:
+            time.sleep(self.latency + self._random.uniform(0, self.latency_jitter))
+
+        parsed = urllib.parse.urlparse(url)
+        path = parsed.path[len(API_PATH):] if parsed.path.startswith(API_PATH) else parsed.path
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if headers.get('Content-Encoding') == 'gzip':
+            if not self.compressed_uploads:
+                return self._json(415, {'error': 'Unsupported Content-Encoding'})
+            body = gzip.decompress(body)
+
+        status, response_headers, response_body = self._route(method, parsed, path, headers, body)
+        if response_body and 'gzip' in headers.get('Accept-Encoding', ''):
+            response_headers = dict(response_headers, **{'Content-Encoding': 'gzip'})
+            response_body = gzip.compress(response_body)
+        return status, response_headers, response_body
+
+    def _route(self, method, parsed, path, headers, body):
+        with self._lock:
+            self.requests.append((method, path))
+            self._complete_publishes()
+            if self.error_rate and (not self.error_path or self.error_path.search(path)) \
+                    and self._random.random() < self.error_rate:
+                return self._json(self.error_status, {'error': 'Injected error'})
+            for route_method, pattern, handler in self._routes:
+                match = re.match(pattern, path)
+                if route_method == method and match:
+                    ids = [int(group) for group in match.groups()]
+                    return handler(*ids, query=urllib.parse.parse_qs(parsed.query),
+                                   headers=headers, body=body or b'')
+        return self._json(404, {'error': 'Not found'})
+
+    def _json(self, status, data, headers=None):
+        response_headers = {'Content-Type': 'application/json'}
+        response_headers.update(headers or {})
+        return status, response_headers, json.dumps(data).encode('utf-8')
+
+    def _layer_json(self, layer, version_id):
+        base = self.url('/layers/{0}/'.format(layer.id))
+        version_url = '{0}versions/{1}/'.format(base, version_id)
+        latest = layer.draft_version or layer.published_version
+        return {
+            'id': layer.id,
+            'url': base,
+            'type': 'layer',
+            'kind': layer.kind,
+            'title': layer.title,
+            'version': {'id': version_id, 'url': version_url, 'status': 'ok'},
+            'this_version': version_url,
+            'latest_version': '{0}versions/{1}/'.format(base, latest),
+            'published_version': '{0}versions/{1}/'.format(base, layer.published_version),
+            'license': layer.license,
+            'metadata': {'iso': version_url + 'metadata/iso/',
+                         'dc': version_url + 'metadata/dc/',
+                         'native': version_url + 'metadata/'},
+            'public_access': layer.public_access,
+            'num_downloads': layer.num_downloads,
+            'first_published_at': '2019-01-01T00:00:00Z',
+            'published_at': '2019-01-01T00:00:00Z'
+        }
+
+    def _layer(self, layer_id):
+        return self.layers.get(layer_id)
+
+    def get_layer(self, layer_id, **kwargs):
+        layer = self._layer(layer_id)
+        if not layer:
+            return self._json(404, {'error': 'Not found'})
+        return self._json(200, self._layer_json(layer, layer.published_version))
+
+    def get_draft(self, layer_id, **kwargs):
+        layer = self._layer(layer_id)
+        if not layer or not layer.draft_version:
+            return self._json(404, {'error': 'Not found'})
+        return self._json(200, self._layer_json(layer, layer.draft_version))
+
+    def get_version(self, layer_id, version_id, **kwargs):
+        layer = self._layer(layer_id)
+        if not layer or version_id not in layer.metadata:
+            return self._json(404, {'error': 'Not found'})
+        return self._json(200, self._layer_json(layer, version_id))
+
+    def create_draft(self, layer_id, **kwargs):
+        layer = self._layer(layer_id)
+        if not layer:
+            return self._json(404, {'error': 'Not found'})
+        if layer.draft_version:
+            return self._json(409, {'error': 'A draft version already exists'})
+        layer.draft_version = layer.next_version
+        layer.next_version += 1
+        layer.metadata[layer.draft_version] = layer.metadata[layer.published_version]
+        layer.modified[layer.draft_version] = time.time()
+        return self._json(201, self._layer_json(layer, layer.draft_version))
+
+    def delete_version(self, layer_id, version_id, **kwargs):
+        layer = self._layer(layer_id)
+        if not layer or version_id != layer.draft_version:
+            return self._json(409, {'error': 'Only draft versions can be deleted'})
+        del layer.metadata[version_id]
+        layer.draft_version = None
+        return 204, {}, b''
+
+    def get_metadata(self, layer_id, version_id, headers=None, **kwargs):
+        layer = self._layer(layer_id)
+        if not layer or version_id not in layer.metadata:
+            return self._json(404, {'error': 'Not found'})
+        metadata = layer.metadata[version_id]
+        modified = int(layer.modified.get(version_id, 0))
+        validators = {'ETag': '"{0}"'.format(hashlib.sha1(metadata).hexdigest()),
+                      'Last-Modified': email.utils.formatdate(modified, usegmt=True)}
+
+        # If-None-Match takes precedence over If-Modified-Since
+        headers = headers or {}
+        if 'If-None-Match' in headers:
+            not_modified = validators['ETag'] in [tag.strip() for tag in headers['If-None-Match'].split(',')]
+        elif 'If-Modified-Since' in headers:
+            since = email.utils.parsedate_to_datetime(headers['If-Modified-Since']).timestamp()
+            not_modified = modified <= since
+        else:
+            not_modified = False
+        if not_modified:
+            self.not_modified += 1
+            return 304, validators, b''
+        validators['Content-Type'] = 'text/xml'
+        return 200, validators, metadata
+
+    def set_metadata(self, layer_id, version_id, body=b'', **kwargs):
+        layer = self._layer(layer_id)
+        if not layer or version_id != layer.draft_version:
+            return self._json(409, {'error': 'Metadata can only be set on a draft version'})
+        layer.metadata[version_id] = body
+        layer.modified[version_id] = time.time()
+        return self._json(200, {})
+
+    def get_catalog(self, query=None, **kwargs):
+        page = int((query or {}).get('page', ['1'])[0])
+        layers = [self.layers[layer_id] for layer_id in sorted(self.layers)]
+        start = (page - 1) * self.page_size
+        results = [self._layer_json(layer, layer.published_version)
+                   for layer in layers[start:start + self.page_size]]
+        headers = {'X-Resource-Range': '{0}-{1}/{2}'.format(start, start + len(results), len(layers))}
+        if start + self.page_size < len(layers):
+            headers['Link'] = '<{0}?page={1}>; rel="page-next"'.format(self.url('/data/'), page + 1)
+        return self._json(200, results, headers)
+
+    def _publish_json(self, publish):
+        return {key: value for key, value in publish.items() if not key.startswith('_')}
+
+    def create_publish(self, body=b'', **kwargs):
+        data = json.loads(body.decode('utf-8') or '{}')
+        publish_id = self._next_publish
+        self._next_publish += 1
+        publish = {
+            'id': publish_id,
+            'url': self.url('/publish/{0}/'.format(publish_id)),
+            'state': 'publishing',
+            'reference': data.get('reference'),
+            'publish_strategy': data.get('publish_strategy', 'together'),
+            'error_strategy': data.get('error_strategy', 'abort'),
+            'items': data.get('items', []),
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'completed_at': None,
+            '_completes': time.monotonic() + self.publish_delay
+        }
+        self.publishes[publish_id] = publish
+        self._complete_publishes()
+        return self._json(201, self._publish_json(publish))
+
+    def get_publish(self, publish_id, **kwargs):
+        publish = self.publishes.get(publish_id)
+        if not publish:
+            return self._json(404, {'error': 'Not found'})
+        return self._json(200, self._publish_json(publish))
+
+    def _complete_publishes(self):
+        """
+        Publish the draft versions of any publish groups that are due
+        """
+
+        now = time.monotonic()
+        for publish in self.publishes.values():
+            if publish['state'] != 'publishing' or publish['_completes'] > now:
+                continue
+            publish['completed_at'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+            if any(match and int(match.group(1)) in self.failing_publishes
+                   for match in (re.search(r'/layers/(\d+)/', item) for item in publish['items'])):
+                publish['state'] = 'error'
+                continue
+            for item in publish['items']:
+                match = re.search(r'/layers/(\d+)/versions/(\d+)/', item)
+                layer = match and self._layer(int(match.group(1)))
+                if layer and layer.draft_version == int(match.group(2)):
+                    layer.published_version = layer.draft_version
+                    layer.draft_version = None
+            publish['state'] = 'completed'
@@ -0,0 +1,233 @@
+#!/usr/bin/python3
+
+################################################################################
+#
+# Copyright 2018 Crown copyright (c)
+# Land Information New Zealand and the New Zealand Government.
+# All rights reserved
+#
+# This program is released under the terms of the new BSD license. See the
+# LICENSE file for more information.
+#
+################################################################################
+
+"""
+Run the metadata updater against the mock Data Service and a
+synthetic corpus and report layers/sec, per stage latency and
+peak RSS. No network access or API key is required.
+
+    python -m benchmarks.run_benchmark --layers 200 --latency 0.05 \\
+        --network-workers 8 --transform-workers 4
+"""
+
+import argparse
+import json
+import logging
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks import corpus
+from benchmarks.mock_service import MockDataService
+
+KB = 1024
+
+
+class StageRecorder(logging.Handler):
+    """
+    Collect the durations of the pipeline stages from the
+    records logged by log.stage
+    """
+
+    def __init__(self):
+        super(StageRecorder, self).__init__(logging.DEBUG)
+        self.durations = {}
+
+    def emit(self, record):
+        stage = getattr(record, 'stage', None)
+        if stage is not None:
+            self.durations.setdefault(stage, []).append(record.duration)
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def stage_stats(durations):
+    """
+    Return {stage: {count, total, mean, p50, p95, max}} in seconds
+    """
+
+    stats = {}
+    for stage, values in durations.items():
+        stats[stage] = {'count': len(values),
+                        'total': sum(values),
+                        'mean': sum(values) / len(values),
+                        'p50': percentile(values, 50),
+                        'p95': percentile(values, 95),
+                        'max': max(values)}
+    return stats
+
+
+def peak_rss_kb():
+    """
+    Return the peak resident set size (KB) of this process
+    and of its largest child (the transform workers)
+    """
+
+    scale = 1 if sys.platform != 'darwin' else 1.0 / KB
+    return (int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale),
+            int(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale))
+
+
+def make_service(args):
+    """
+    Return a mock Data Service loaded with the synthetic corpus
+    """
+
+    service = MockDataService(latency=args.latency, latency_jitter=args.jitter,
+                              error_rate=args.error_rate, error_path=args.error_path or None,
+                              seed=args.seed)
+    documents = corpus.generate_corpus(args.layers, int(args.min_kb * KB), int(args.max_kb * KB),
+                                       args.match_rate, args.seed)
+    corpus_bytes = 0
+    for layer_id, document in documents:
+        service.add_layer(layer_id, document)
+        corpus_bytes += len(document)
+    return service, corpus_bytes
+
+
+def make_config(args, destination_dir, layer_ids):
+    return {
+        'Connection': {'Api_key': 'benchmark', 'Domain': MockDataService().host},
+        'Text': {'Mapping': corpus.CC3_TO_CC4_MAPPING},
+        'Output': {'Destination': destination_dir},
+        'Datasets': {'Layers': layer_ids},
+        'Test': {'Dry_run': args.dry_run, 'Overwrite_files': True},
+        'Summarise': {'Summarise_metadata': args.summarise},
+        'Performance': {'Transform_workers': args.transform_workers,
+                        'Network_workers': args.network_workers,
+                        'Adaptive_concurrency': args.adaptive,
+                        'Min_network_workers': args.min_network_workers,
+                        'Compression': args.compression,
+                        'Compress_uploads': args.compression}
+    }
+
+
+def run(args):
+    """
+    Run the benchmark and return the report dict
+    """
+
+    import koordinates
+    from metadata_updater.metadata_updater import Runner
+
+    service, corpus_bytes = make_service(args)
+    client = service.install(koordinates.Client(service.host, 'benchmark'))
+
+    recorder = StageRecorder()
+    package_logger = logging.getLogger('metadata_updater')
+    package_logger.addHandler(recorder)
+    package_logger.setLevel(logging.DEBUG)
+    # Only the stage timings are wanted, not the log output
+    package_logger.propagate = False
+
+    destination_dir = tempfile.mkdtemp(prefix='metadata_updater_benchmark_')
+    try:
+        config = make_config(args, destination_dir, sorted(service.layers))
+        start = time.perf_counter()
+        with Runner(config, client) as runner:
+            result = runner.run()
+            concurrency = runner.limiter.stats() if runner.limiter else None
+            transfer = runner.transfer_stats.stats() if runner.transfer_stats else None
+        elapsed = time.perf_counter() - start
+    finally:
+        package_logger.removeHandler(recorder)
+        package_logger.propagate = True
+        shutil.rmtree(destination_dir)
+
+    rss, children_rss = peak_rss_kb()
+    requests = {}
+    for method, path in service.requests:
+        requests[method] = requests.get(method, 0) + 1
+    return {'layers': result.layer_count,
+            'layers_edited': result.layers_edited_count,
+            'errors': result.errors,
+            'corpus_mb': corpus_bytes / float(KB * KB),
+            'seconds': elapsed,
+            'layers_per_sec': result.layer_count / elapsed if elapsed else 0,
+            'peak_rss_kb': rss,
+            'peak_worker_rss_kb': children_rss,
+            'requests': requests,
+            'concurrency': concurrency,
+            'transfer': transfer,
+            'stages': stage_stats(recorder.durations)}
+
+
+def print_report(report):
+    print('{layers} layer(s) | {layers_edited} edited | {errors} error(s) | '
+          '{corpus_mb:.1f} MB corpus'.format(**report))
+    print('{seconds:.2f}s | {layers_per_sec:.1f} layers/sec | peak RSS {peak_rss_kb} KB '
+          '(workers {peak_worker_rss_kb} KB)'.format(**report))
+    print('Requests: ' + ', '.join('{0} {1}'.format(count, method)
+                                   for method, count in sorted(report['requests'].items())))
+    if report['concurrency']:
+        print('Concurrency limit {limit} (peak {peak_limit}) | {increases} increase(s) | '
+              '{decreases} decrease(s) | {errors} error(s)'.format(**report['concurrency']))
+    if report['transfer']:
+        print('Downloaded {downloaded_raw} B ({downloaded_wire} B on the wire) | '
+              'uploaded {uploaded_raw} B ({uploaded_wire} B on the wire)'.format(**report['transfer']))
+    print('{0:<16}{1:>8}{2:>12}{3:>12}{4:>12}{5:>12}'.format('stage', 'count', 'mean ms',
+                                                              'p50 ms', 'p95 ms', 'max ms'))
+    for stage, stats in sorted(report['stages'].items()):
+        print('{0:<16}{1:>8}{2:>12.2f}{3:>12.2f}{4:>12.2f}{5:>12.2f}'.format(
+            stage, stats['count'], stats['mean'] * 1000, stats['p50'] * 1000,
+            stats['p95'] * 1000, stats['max'] * 1000))
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the metadata updater offline')
+    parser.add_argument('--layers', type=int, default=100, help='Number of layers')
+    parser.add_argument('--min-kb', type=float, default=5, help='Smallest document size (KB)')
+    parser.add_argument('--max-kb', type=float, default=5 * 1024, help='Largest document size (KB)')
+    parser.add_argument('--match-rate', type=float, default=0.5,
+                        help='Proportion of documents the rules edit')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to each request')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Max random seconds added to the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Proportion of requests that fail with a 504')
+    parser.add_argument('--error-path', default=r'/layers/\d+/$',
+                        help='Regex of the request paths errors are injected on. Defaults to '
+                        'the layer GET the updater retries (LDS 504s, issue #15). '
+                        'Use "" for all paths')
+    parser.add_argument('--transform-workers', type=int, default=1)
+    parser.add_argument('--network-workers', type=int, default=1,
+                        help='Network threads, the maximum concurrency with --adaptive')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Adapt the request concurrency to latency and errors')
+    parser.add_argument('--min-network-workers', type=int, default=1)
+    parser.add_argument('--compression', action='store_true',
+                        help='Download and upload the metadata compressed')
+    parser.add_argument('--dry-run', action='store_true', help='Do not post or publish')
+    parser.add_argument('--summarise', action='store_true', help='Write the summary workbooks')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+################################################################################
+#
+# Copyright 2018 Crown copyright (c)
+# Land Information New Zealand and the New Zealand Government.
+# All rights reserved
+#
+# This program is released under the terms of the new BSD license. See the
+# LICENSE file for more information.
+#
+################################################################################
+
+"""
+pytest-benchmark micro benchmarks of the functions run once per
+layer, or once per layer per mapping, over a matrix of document
+sizes, mapping counts and match rates. See the README for saving
+a baseline and failing on regressions against it.
+
+    python -m pytest benchmarks --benchmark-autosave
+"""
+
+import shutil
+import timeit
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from benchmarks import corpus
+from metadata_updater import metadata_updater
+from metadata_updater.rules import compile_rules
+from metadata_updater.streaming import transform_file
+from metadata_updater.transform import transform_document
+from metadata_updater.utils.xml_to_excel import parse_xml_file
+
+SIZES = {'5kb': 5 * corpus.KB, '100kb': 100 * corpus.KB, '1mb': corpus.MB}
+MAPPING_COUNTS = (1, 10, 50)
+MATCH_RATES = (0.0, 0.5, 1.0)
+
+# Max growth in time, relative to linear, as the
+# document size or mapping count grows
+MAX_SCALING = 2.0
+
+
+@pytest.fixture(scope='session')
+def documents(tmp_path_factory):
+    """
+    Generated documents, as {size name: path}, matching
+    the CC3 text
+    """
+
+    directory = tmp_path_factory.mktemp('corpus')
+    paths = {}
+    for name, size in SIZES.items():
+        paths[name] = directory / '{0}.iso.xml'.format(name)
+        paths[name].write_bytes(corpus.generate_document(1, size, match=True))
+    return paths
+
+
+@pytest.mark.parametrize('match', (True, False), ids=('match', 'no_match'))
+@pytest.mark.parametrize('size', SIZES)
+def test_file_has_text(benchmark, documents, size, match):
+    search_text = corpus.CC3_TEXT if match else 'Not in the corpus'
+    benchmark.group = 'file_has_text'
+    assert benchmark(metadata_updater.file_has_text, search_text, False, str(documents[size])) is match
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_file_has_text_element(benchmark, documents, size):
+    target_element = './/gmd:contact/gmd:CI_ResponsibleParty/gmd:organisationName/gco:CharacterString'
+    benchmark.group = 'file_has_text_element'
+    assert benchmark(metadata_updater.file_has_text, 'Land Information',
+                     False, str(documents[size]), target_element)
+
+
+@pytest.mark.parametrize('match_rate', MATCH_RATES)
+@pytest.mark.parametrize('mapping_count', MAPPING_COUNTS)
+@pytest.mark.parametrize('size', SIZES)
+def test_update_metadata(benchmark, documents, tmp_path, size, mapping_count, match_rate):
+    """
+    Applies each mapping to the file in turn, as a run did before
+    the rules were applied in memory
+    """
+
+    rules = compile_rules(corpus.make_mapping(mapping_count, match_rate))
+    file = str(tmp_path / 'layer.iso.xml')
+
+    def copy_document():
+        shutil.copyfile(str(documents[size]), file)
+
+    def update_file():
+        for rule in rules:
+            if metadata_updater.file_has_text(rule.search_pattern, rule.ignore_case, file):
+                metadata_updater.update_metadata(file, rule)
+
+    benchmark.group = 'update_metadata'
+    benchmark.pedantic(update_file, setup=copy_document, rounds=5, warmup_rounds=1)
+
+
+@pytest.mark.parametrize('match_rate', MATCH_RATES)
+@pytest.mark.parametrize('mapping_count', MAPPING_COUNTS)
+@pytest.mark.parametrize('size', SIZES)
+def test_transform_document(benchmark, documents, size, mapping_count, match_rate):
+    rules = compile_rules(corpus.make_mapping(mapping_count, match_rate))
+    data = documents[size].read_bytes()
+    benchmark.group = 'transform_document'
+    edited, applied = benchmark(transform_document, data, rules)
+    assert len(applied) == int(round(mapping_count * match_rate))
+
+
+@pytest.mark.parametrize('mapping_count', (1, 10))
+@pytest.mark.parametrize('size', SIZES)
+def test_transform_file(benchmark, documents, tmp_path, size, mapping_count):
+    """
+    Streams the document from and to disk, for
+    comparison with test_transform_document
+    """
+
+    rules = compile_rules(corpus.make_mapping(mapping_count, 1.0))
+    output = str(tmp_path / 'layer.iso.xml.edited')
+    benchmark.group = 'transform_file'
+    edited, applied = benchmark(transform_file, str(documents[size]), output, rules)
+    assert len(applied) == mapping_count
+
+
+def best_time(function, *args):
+    return min(timeit.repeat(lambda: function(*args), number=1, repeat=5))
+
+
+def test_transform_scales_linearly(documents):
+    """
+    Fail on quadratic behaviour in the document size
+    or number of mappings, without needing a baseline
+    """
+
+    rules = compile_rules(corpus.make_mapping(5, 1.0))
+    small, large = documents['100kb'].read_bytes(), documents['1mb'].read_bytes()
+    growth = best_time(transform_document, large, rules) / best_time(transform_document, small, rules)
+    assert growth < MAX_SCALING * len(large) / len(small)
+
+    many_rules = compile_rules(corpus.make_mapping(50, 1.0))
+    growth = best_time(transform_document, small, many_rules) / best_time(transform_document, small, rules)
+    assert growth < 10 * MAX_SCALING
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_parse_xml_file(benchmark, documents, size):
+    benchmark.group = 'parse_xml_file'
+    assert benchmark(parse_xml_file, str(documents[size]))
+
+
+@pytest.mark.parametrize('length', (20, 200, 2000))
+def test_remove_illegal_chars(benchmark, length):
+    title = ('Weed/Kelp polygons (Hydro, 1:4k - 1:22k) ' * length)[:length]
+    benchmark.group = 'remove_illegal_chars'
+    benchmark(metadata_updater.remove_illegal_chars, title)
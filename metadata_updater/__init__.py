@@ -1,3 +1,4 @@
 #!/usr/bin/env python
 
-from .metadata_updater import main
\ No newline at end of file
+from .metadata_updater import main, Runner, ConfigReader
+from .run_context import RunContext, RunResult
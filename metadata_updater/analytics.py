@@ -0,0 +1,517 @@
+#!/usr/bin/python3
+
+################################################################################
+#
+# Copyright 2018 Crown copyright (c)
+# Land Information New Zealand and the New Zealand Government.
+# All rights reserved
+#
+# This program is released under the terms of the new BSD license. See the
+# LICENSE file for more information.
+#
+################################################################################
+
+"""
+Catalog wide analytics over the metadata summaries. With Analytics
+configured, summarise runs write the summaries column wise, in chunks
+of rows, to the metadata_summary.columns directory. The report loads
+the columns as numpy arrays (numpy is an optional dependency) and
+computes completeness, value counts, numeric statistics, cross
+tabulations and searches over them
+
+    metadata_updater_report <Destination>/metadata_summary.columns \
+        --search "Creative Commons Attribution 3\\.0" --search-field useLimitation
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+
+from .utils.xml_to_excel import SUMMARY_FIELDS, SUMMARY_KEYS, SummaryRecord
+
+SUMMARY_COLUMNS_DIR = 'metadata_summary.columns'
+COLUMNS_INDEX_FILE = 'columns.json'
+CHUNK_FILE = 'chunk-{0:05d}.npz'
+
+# Rows buffered before they are written as a chunk
+CHUNK_ROWS = 1000
+
+# Follows each value in a text column's buffer
+SEPARATOR = '\x00'
+OFFSETS_SUFFIX = '.offsets'
+
+LAYER_ID_FIELD = '__layer_id'
+BBOX_FIELDS = ('westBoundLongitude', 'eastBoundLongitude', 'southBoundLatitude', 'northBoundLatitude')
+NUMERIC_FIELDS = tuple(field.key for field in SUMMARY_FIELDS if field.numeric)
+TEXT_FIELDS = tuple(field.key for field in SUMMARY_FIELDS if not field.numeric)
+
+# Reported by default
+VALUE_COUNT_FIELDS = ('__license_type', 'organisationName', 'topicCategory', 'hierarchyLevel', 'status')
+CROSSTAB_FIELDS = ('organisationName', '__license_type')
+
+
+def require_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise SystemExit('Error, the summary analytics require numpy. Install it with ' \
+                         '"pip install metadata_updater[analytics]"')
+    return numpy
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+class TextColumn():
+    """
+    A column of strings held as one UTF-8 buffer, each value
+    followed by SEPARATOR, and the offset of each value in it
+    """
+
+    __slots__ = ('data', 'offsets', '_text', '_char_offsets', '_values')
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+        self._text = None
+        self._char_offsets = None
+        self._values = None
+
+    @classmethod
+    def from_values(cls, np, values):
+        encoded = [('' if value is None else str(value)).replace(SEPARATOR, '').encode('utf-8') + b'\x00'
+                   for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)), out=offsets[1:])
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+
+    @classmethod
+    def concatenate(cls, np, columns):
+        if not columns:
+            return cls(np.zeros(0, dtype=np.uint8), np.zeros(1, dtype=np.int64))
+        offsets, base = [], 0
+        for column in columns:
+            offsets.append(column.offsets[:-1] + base)
+            base += len(column.data)
+        offsets.append(np.array([base], dtype=np.int64))
+        return cls(np.concatenate([column.data for column in columns]), np.concatenate(offsets))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self, np):
+        """
+        Return the length in bytes of each value
+        """
+
+        return np.diff(self.offsets) - 1
+
+    def text(self):
+        """
+        Return the buffer as one string
+        """
+
+        if self._text is None:
+            self._text = self.data.tobytes().decode('utf-8')
+        return self._text
+
+    def char_offsets(self, np):
+        """
+        Return the offsets as offsets in text()
+        """
+
+        if self._char_offsets is None:
+            self._char_offsets = self.offsets
+            if len(self.data) and self.data.max() >= 0x80:
+                # Less the number of UTF-8 continuation bytes before each offset
+                continuation = np.flatnonzero((self.data & 0xC0) == 0x80)
+                self._char_offsets = self.offsets - np.searchsorted(continuation, self.offsets)
+        return self._char_offsets
+
+    def values(self, np):
+        """
+        Return the values as an object array of strings, '' for no value
+        """
+
+        if self._values is None:
+            self._values = np.array(self.text().split(SEPARATOR)[:-1], dtype=object)
+        return self._values
+
+
+class ColumnStore():
+    """
+    Writes the summaries column wise to a directory. Rows are buffered
+    and every chunk_rows rows written out as a chunk, with an array per
+    SUMMARY_FIELDS field (floats for numeric fields, a TextColumn for the
+    rest), so memory use does not grow with the number of layers. Has
+    the same append interface as the workbook writers so can be used as
+    a RunContext summary sink
+    """
+
+    def __init__(self, directory, chunk_rows=CHUNK_ROWS):
+        self.np = require_numpy()
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+        self.row_count = 0
+        self.chunk_count = 0
+        self._rows = []
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # Remove a previous run's columns
+        for name in os.listdir(directory):
+            if name == COLUMNS_INDEX_FILE or (name.startswith('chunk-') and name.endswith('.npz')):
+                os.remove(os.path.join(directory, name))
+
+    def append(self, data):
+        if not isinstance(data, SummaryRecord):
+            data = SummaryRecord.from_mapping(data)
+        row = tuple(getattr(data, field.name) for field in SUMMARY_FIELDS)
+        with self._lock:
+            self._rows.append(row)
+            self.row_count += 1
+            if len(self._rows) >= self.chunk_rows:
+                self._write_chunk()
+
+    def _write_chunk(self):
+        np = self.np
+        arrays = {}
+        for field, values in zip(SUMMARY_FIELDS, zip(*self._rows)):
+            if field.numeric:
+                arrays[field.key] = np.fromiter(map(to_float, values), dtype=np.float64,
+                                                count=len(values))
+            else:
+                column = TextColumn.from_values(np, values)
+                arrays[field.key] = column.data
+                arrays[field.key + OFFSETS_SUFFIX] = column.offsets
+        np.savez(os.path.join(self.directory, CHUNK_FILE.format(self.chunk_count)), **arrays)
+        self.chunk_count += 1
+        self._rows = []
+
+    def close(self):
+        with self._lock:
+            if self._rows:
+                self._write_chunk()
+            with open(os.path.join(self.directory, COLUMNS_INDEX_FILE), 'w') as f:
+                json.dump({'fields': SUMMARY_KEYS, 'numeric': list(NUMERIC_FIELDS),
+                           'row_count': self.row_count, 'chunks': self.chunk_count}, f)
+
+    @staticmethod
+    def load(directory):
+        """
+        Return the Columns written to the directory
+        """
+
+        np = require_numpy()
+        with open(os.path.join(directory, COLUMNS_INDEX_FILE)) as f:
+            index = json.load(f)
+        parts = {field: [] for field in index['fields']}
+        for chunk in range(index['chunks']):
+            with np.load(os.path.join(directory, CHUNK_FILE.format(chunk))) as arrays:
+                for field in index['fields']:
+                    if field in index['numeric']:
+                        parts[field].append(arrays[field])
+                    else:
+                        parts[field].append(TextColumn(arrays[field], arrays[field + OFFSETS_SUFFIX]))
+        columns = {}
+        for field in index['fields']:
+            if field in index['numeric']:
+                columns[field] = np.concatenate(parts[field]) if parts[field] else np.zeros(0)
+            else:
+                columns[field] = TextColumn.concatenate(np, parts[field])
+        return Columns(index['fields'], index['row_count'], columns)
+
+
+class Columns():
+    """
+    The summaries loaded from a ColumnStore: a float array per
+    numeric field and a TextColumn per other field
+    """
+
+    def __init__(self, fields, row_count, columns):
+        self.fields = fields
+        self.row_count = row_count
+        self.columns = columns
+
+    def text_values(self, np, field):
+        """
+        Return the field's values as an object array of strings
+        """
+
+        column = self.columns[field]
+        if isinstance(column, TextColumn):
+            return column.values(np)
+        return np.where(np.isnan(column), '', column.astype(str)).astype(object)
+
+    def rows(self):
+        """
+        Return a generator of the summaries as dicts
+        """
+
+        np = require_numpy()
+        values = {field: self.text_values(np, field) if isinstance(column, TextColumn) else column
+                  for field, column in self.columns.items()}
+        for row in range(self.row_count):
+            data = {}
+            for field, column in values.items():
+                value = column[row]
+                if isinstance(value, float) or isinstance(value, np.floating):
+                    value = None if np.isnan(value) else float(value)
+                data[field] = value
+            yield data
+
+
+def _spans_values(sre_parse, items):
+    """
+    Test if the parsed pattern has an anchor or lookaround, which
+    would see past the ends of a value when the values of a column
+    are searched as one string. Word boundaries do not, as each
+    value is followed by SEPARATOR, a non word character
+    """
+
+    repeats = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, 'POSSESSIVE_REPEAT', None))
+    for op, av in items:
+        if op == sre_parse.AT and av not in (sre_parse.AT_BOUNDARY, sre_parse.AT_NON_BOUNDARY):
+            return True
+        if op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT, sre_parse.GROUPREF_EXISTS):
+            return True
+        if op == sre_parse.BRANCH:
+            bodies = av[1]
+        elif op == sre_parse.SUBPATTERN:
+            bodies = [av[-1]]
+        elif op in repeats:
+            bodies = [av[2]]
+        elif op == getattr(sre_parse, 'ATOMIC_GROUP', None):
+            bodies = [av]
+        else:
+            bodies = []
+        if any(_spans_values(sre_parse, body) for body in bodies):
+            return True
+    return False
+
+
+def spans_values(pattern):
+    try:
+        from re import _parser as sre_parse
+    except ImportError:
+        # Python < 3.11
+        import sre_parse
+
+    return _spans_values(sre_parse, sre_parse.parse(pattern.pattern, pattern.flags))
+
+
+def search_text(np, pattern, column):
+    """
+    Return a boolean array of the values of a TextColumn the compiled
+    pattern is found in. The column is searched as one string, so the
+    regex engine scans the values that do not match in one call and is
+    only called again after each match. A match that runs past the end
+    of its value is checked against the value alone. Patterns with
+    anchors or lookarounds are instead searched for in each distinct value
+    """
+
+    found = np.zeros(len(column), dtype=bool)
+    if not len(column):
+        return found
+    if spans_values(pattern):
+        distinct, inverse = np.unique(column.values(np), return_inverse=True)
+        matches = np.fromiter((pattern.search(value) is not None for value in distinct),
+                              dtype=bool, count=len(distinct))
+        return matches[inverse.ravel()]
+
+    text = column.text()
+    starts = column.char_offsets(np)
+    position = 0
+    while position < len(text):
+        match = pattern.search(text, position)
+        if match is None:
+            break
+        row = int(np.searchsorted(starts, match.start(), side='right')) - 1
+        if row >= len(column):
+            break
+        end = int(starts[row + 1]) - 1
+        if match.end() <= end or pattern.search(text[starts[row]:end]):
+            found[row] = True
+        position = end + 1
+    return found
+
+
+def value_counts(np, array, top=10):
+    """
+    Return [(value, count)] of the most common non empty values
+    """
+
+    values, counts = np.unique(array[array != ''], return_counts=True)
+    order = np.argsort(-counts, kind='stable')[:top]
+    return [(values[i], int(counts[i])) for i in order]
+
+
+def crosstab(np, rows, columns, top=10):
+    """
+    Return the counts of each pair of values, as {row value: {column
+    value: count}}, for the top rows and columns by total
+    """
+
+    row_values, row_index = np.unique(rows, return_inverse=True)
+    column_values, column_index = np.unique(columns, return_inverse=True)
+    counts = np.zeros((len(row_values), len(column_values)), dtype=np.int64)
+    np.add.at(counts, (row_index.ravel(), column_index.ravel()), 1)
+    top_rows = np.argsort(-counts.sum(axis=1), kind='stable')[:top]
+    top_columns = np.argsort(-counts.sum(axis=0), kind='stable')[:top]
+    return {row_values[r] or '(none)': {column_values[c] or '(none)': int(counts[r, c])
+                                        for c in top_columns if counts[r, c]}
+            for r in top_rows}
+
+
+def search(np, columns, pattern, fields):
+    """
+    Return a boolean array of the layers with pattern in any of the fields
+    """
+
+    pattern = re.compile(pattern)
+    found = np.zeros(columns.row_count, dtype=bool)
+    for field in fields:
+        column = columns.columns[field]
+        if not isinstance(column, TextColumn):
+            column = TextColumn.from_values(np, columns.text_values(np, field))
+        found |= search_text(np, pattern, column)
+    return found
+
+
+def report(columns, value_count_fields=VALUE_COUNT_FIELDS, crosstab_fields=CROSSTAB_FIELDS,
+           search_pattern=None, search_fields=None, top=10):
+    """
+    Return the report on the loaded summary Columns as a dict
+    """
+
+    np = require_numpy()
+    row_count = columns.row_count
+    layer_ids = columns.text_values(np, LAYER_ID_FIELD)
+    numeric = {field: column for field, column in columns.columns.items()
+               if not isinstance(column, TextColumn)}
+
+    result = {'layer_count': row_count, 'fields': {}, 'numeric': {}, 'value_counts': {}}
+    for field, column in columns.columns.items():
+        if field in numeric:
+            filled = ~np.isnan(column)
+            distinct = len(np.unique(column[filled]))
+        else:
+            filled = column.lengths(np) > 0
+            distinct = len(np.unique(column.values(np)[filled]))
+        filled_count = int(np.count_nonzero(filled))
+        result['fields'][field] = {
+            'filled': filled_count,
+            'completeness': filled_count / float(row_count) if row_count else 0.0,
+            'distinct': int(distinct)
+        }
+
+    for field, values in numeric.items():
+        present = ~np.isnan(values)
+        result['numeric'][field] = {'count': int(np.count_nonzero(present))}
+        if present.any():
+            result['numeric'][field].update({'min': float(values[present].min()),
+                                             'max': float(values[present].max()),
+                                             'mean': float(values[present].mean())})
+
+    for field in value_count_fields:
+        if field in columns.columns:
+            result['value_counts'][field] = value_counts(np, columns.text_values(np, field), top)
+
+    if crosstab_fields and all(field in columns.columns for field in crosstab_fields):
+        result['crosstab'] = {'fields': list(crosstab_fields),
+                              'counts': crosstab(np, columns.text_values(np, crosstab_fields[0]),
+                                                 columns.text_values(np, crosstab_fields[1]), top)}
+
+    if all(field in numeric for field in BBOX_FIELDS):
+        missing = np.zeros(row_count, dtype=bool)
+        for field in BBOX_FIELDS:
+            missing |= np.isnan(numeric[field])
+        result['missing_bounding_box'] = layer_ids[missing].tolist()
+
+    if search_pattern:
+        fields = search_fields or [field for field in columns.fields if field not in numeric]
+        found = search(np, columns, search_pattern, fields)
+        result['search'] = {'pattern': search_pattern, 'fields': list(fields),
+                            'layer_ids': layer_ids[found].tolist()}
+
+    return result
+
+
+def print_report(result, top=10):
+    print('{0} layer(s)\n'.format(result['layer_count']))
+
+    print('{0:<32}{1:>10}{2:>14}{3:>10}'.format('field', 'filled', 'completeness', 'distinct'))
+    for field, stats in result['fields'].items():
+        print('{0:<32}{1:>10}{2:>13.1f}%{3:>10}'.format(field, stats['filled'],
+                                                        stats['completeness'] * 100,
+                                                        stats['distinct']))
+
+    print('\n{0:<32}{1:>10}{2:>14}{3:>14}{4:>14}'.format('numeric field', 'count', 'min', 'max', 'mean'))
+    for field, stats in result['numeric'].items():
+        print('{0:<32}{1:>10}{2:>14.4f}{3:>14.4f}{4:>14.4f}'.format(
+            field, stats['count'], stats.get('min', float('nan')),
+            stats.get('max', float('nan')), stats.get('mean', float('nan'))))
+
+    for field, counts in result['value_counts'].items():
+        print('\nTop values of {0}'.format(field))
+        for value, count in counts:
+            print('  {0:>8}  {1}'.format(count, value))
+
+    if 'crosstab' in result:
+        print('\n{0} by {1}'.format(*result['crosstab']['fields']))
+        for row, counts in result['crosstab']['counts'].items():
+            print('  {0}: {1}'.format(row, ', '.join('{0} {1}'.format(count, value)
+                                                     for value, count in counts.items())))
+
+    if 'missing_bounding_box' in result:
+        missing = result['missing_bounding_box']
+        print('\n{0} layer(s) missing a bounding box: {1}'.format(
+            len(missing), ', '.join(missing[:top]) + (' ...' if len(missing) > top else '')))
+
+    if 'search' in result:
+        found = result['search']['layer_ids']
+        print('\n{0} layer(s) matching "{1}": {2}'.format(len(found), result['search']['pattern'],
+                                                          ', '.join(found)))
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Report on the metadata summaries of a summarise run')
+    parser.add_argument('columns_dir', help='Path to the {0} directory'.format(SUMMARY_COLUMNS_DIR))
+    parser.add_argument('--value-counts', action='append', metavar='FIELD', choices=SUMMARY_KEYS,
+                        help='Field to report the most common values of (repeatable)')
+    parser.add_argument('--crosstab', nargs=2, metavar=('ROWS', 'COLUMNS'), choices=SUMMARY_KEYS,
+                        default=CROSSTAB_FIELDS, help='Count the layers by each pair of values')
+    parser.add_argument('--search', default=None, metavar='PATTERN',
+                        help='Regular expression to find layers by')
+    parser.add_argument('--search-field', action='append', metavar='FIELD', choices=SUMMARY_KEYS,
+                        help='Field to search (repeatable). Default all text fields')
+    parser.add_argument('--top', type=int, default=10, help='Number of values to list')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args(args)
+    if args.search:
+        try:
+            re.compile(args.search)
+        except re.error as e:
+            parser.error('--search is not a valid regular expression: {0}'.format(e))
+    return args
+
+
+def main(args=None):
+    args = parse_args(sys.argv[1:] if args is None else args)
+    columns = ColumnStore.load(args.columns_dir)
+    result = report(columns, args.value_counts or VALUE_COUNT_FIELDS, args.crosstab,
+                    args.search, args.search_field, args.top)
+    if args.json:
+        print(json.dumps(result, indent=2, default=str))
+    else:
+        print_report(result, args.top)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+################################################################################
+#
+# Copyright 2018 Crown copyright (c)
+# Land Information New Zealand and the New Zealand Government.
+# All rights reserved
+#
+# This program is released under the terms of the new BSD license. See the
+# LICENSE file for more information.
+#
+################################################################################
+
+import gzip
+import logging
+import re
+import threading
+
+from requests.adapters import BaseAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+
+logger = logging.getLogger(__name__)
+
+# Request bodies smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 1024
+
+# A 400 response body saying the Content-Encoding is not accepted,
+# rather than that the (decompressed) body is not valid
+ENCODING_REJECTED = re.compile(r'content.?encoding|gzip|compress', re.IGNORECASE)
+
+
+class TransferStats():
+    """
+    Counts of the bytes downloaded and uploaded, both before
+    compression (raw) and as sent over the network (wire)
+    """
+
+    def __init__(self):
+        self.downloaded_raw = 0
+        self.downloaded_wire = 0
+        self.uploaded_raw = 0
+        self.uploaded_wire = 0
+        self._lock = threading.Lock()
+
+    def add_download(self, raw, wire):
+        with self._lock:
+            self.downloaded_raw += raw
+            self.downloaded_wire += wire
+
+    def add_upload(self, raw, wire):
+        with self._lock:
+            self.uploaded_raw += raw
+            self.uploaded_wire += wire
+
+    def stats(self):
+        with self._lock:
+            return {'downloaded_raw': self.downloaded_raw, 'downloaded_wire': self.downloaded_wire,
+                    'uploaded_raw': self.uploaded_raw, 'uploaded_wire': self.uploaded_wire}
+
+
+def count_download(response, stats):
+    """
+    Count the response body's raw and wire bytes as it is read
+    """
+
+    raw = response.raw
+    stream = raw.stream
+
+    def counted_stream(*args, **kwargs):
+        length = 0
+        for chunk in stream(*args, **kwargs):
+            length += len(chunk)
+            yield chunk
+        stats.add_download(length, raw.tell())
+
+    raw.stream = counted_stream
+
+
+def encoding_rejected(response):
+    """
+    Test if the response rejects a request for its Content-Encoding:
+    a 415, or a 400 whose body says the encoding was the problem
+    """
+
+    if response.status_code == 415:
+        return True
+    return response.status_code == 400 and bool(ENCODING_REJECTED.search(response.text or ''))
+
+
+class CompressionAdapter(BaseAdapter):
+    """
+    requests transport adapter that counts the bytes transferred in
+    stats and, if compress_uploads, gzips XML request bodies. If the
+    server rejects the encoding of a compressed body it is sent again
+    uncompressed and no further bodies are compressed. requests already
+    asks for gzip and deflate responses, so the Accept-Encoding header
+    set here only adds br (when brotli is installed) and zstd (when
+    zstandard is installed)
+    """
+
+    def __init__(self, adapter, stats, compress_uploads=False):
+        super(CompressionAdapter, self).__init__()
+        self.adapter = adapter
+        self.stats = stats
+        self.compress_uploads = compress_uploads
+
+    def send(self, request, **kwargs):
+        request.headers['Accept-Encoding'] = ACCEPT_ENCODING
+        body = request.body
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if not isinstance(body, bytes):
+            body = None
+
+        compressed = None
+        if body and self.compress_uploads and len(body) >= MIN_COMPRESS_SIZE \
+                and 'xml' in request.headers.get('Content-Type', ''):
+            compressed = request.copy()
+            compressed.body = gzip.compress(body)
+            compressed.headers['Content-Encoding'] = 'gzip'
+            compressed.headers['Content-Length'] = str(len(compressed.body))
+            response = self.adapter.send(compressed, **kwargs)
+            if response.status_code not in (400, 415):
+                self.stats.add_upload(len(body), len(compressed.body))
+                count_download(response, self.stats)
+                return response
+            if not encoding_rejected(response):
+                # i.e. the metadata is not valid. The body has been read
+                self.stats.add_upload(len(body), len(compressed.body))
+                self.stats.add_download(len(response.content), response.raw.tell())
+                return response
+            logger.warning('Compressed request body rejected ({0}), no longer compressing '
+                           'uploads'.format(response.status_code))
+            response.close()
+            self.compress_uploads = False
+
+        response = self.adapter.send(request, **kwargs)
+        if body:
+            self.stats.add_upload(len(body), len(body))
+        count_download(response, self.stats)
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+def install(client, stats, compress_uploads=False):
+    """
+    Route the koordinates client's Data Service requests through a
+    CompressionAdapter. Returns the client
+    """
+
+    prefix = 'https://{0}/'.format(client.host)
+    session = client._session
+    session.mount(prefix, CompressionAdapter(session.get_adapter(prefix), stats, compress_uploads))
+    return client
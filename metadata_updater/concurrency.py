@@ -0,0 +1,168 @@
+################################################################################
+#
+# Copyright 2018 Crown copyright (c)
+# Land Information New Zealand and the New Zealand Government.
+# All rights reserved
+#
+# This program is released under the terms of the new BSD license. See the
+# LICENSE file for more information.
+#
+################################################################################
+
+import logging
+import threading
+import time
+
+from requests.adapters import BaseAdapter
+from requests.exceptions import ConnectionError, Timeout
+
+logger = logging.getLogger(__name__)
+
+# Weight of the latest request in the latency moving average
+LATENCY_SMOOTHING = 0.2
+
+
+class AdaptiveLimiter():
+    """
+    Limit the number of requests in flight with an AIMD (additive
+    increase, multiplicative decrease) controller, as TCP does. The
+    limit rises by one each time a limit's worth of requests succeed
+    while the limit is in use, and is multiplied by `decrease` on a
+    5xx or 429 response, timeout or connection error, or, if a
+    latency_target (seconds) is set, when the smoothed latency exceeds
+    it. With no target latency alone does not cut the limit, as the
+    latency of a metadata upload of several MB is not comparable to
+    that of a small GET. Requests started before a decrease do not
+    cause another, so one burst of errors only cuts the limit once
+    """
+
+    def __init__(self, minimum=1, maximum=32, initial=None, decrease=0.5,
+                 latency_target=None):
+        if not 1 <= minimum <= maximum:
+            raise ValueError('AdaptiveLimiter requires 1 <= minimum <= maximum')
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = min(max(initial or minimum, minimum), maximum)
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self.latency = None
+        self.requests = 0
+        self.errors = 0
+        self.increases = 0
+        self.decreases = 0
+        self.peak_limit = self.limit
+        self._successes = 0
+        self._saturated = False
+        self._decreased_at = 0.0
+        self._changed = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait for a request slot. Returns the request's start time
+        """
+
+        with self._changed:
+            while self.in_flight >= int(self.limit):
+                self._saturated = True
+                self._changed.wait()
+            self.in_flight += 1
+            if self.in_flight >= int(self.limit):
+                self._saturated = True
+        return time.monotonic()
+
+    def release(self, started, error=False):
+        """
+        Free the request's slot and adjust the limit
+        on its outcome and latency
+        """
+
+        latency = time.monotonic() - started
+        with self._changed:
+            self.in_flight -= 1
+            self.requests += 1
+            if error:
+                self.errors += 1
+            else:
+                self.latency = latency if self.latency is None else \
+                    LATENCY_SMOOTHING * latency + (1 - LATENCY_SMOOTHING) * self.latency
+
+            if error or self.latency_exceeded():
+                if started >= self._decreased_at:
+                    self._set_limit(max(self.minimum, int(self.limit * self.decrease)),
+                                    'error' if error else 'latency')
+                    self.decreases += 1
+                    self._decreased_at = time.monotonic()
+            elif self._saturated:
+                self._successes += 1
+                if self._successes >= self.limit and self.limit < self.maximum:
+                    self._set_limit(self.limit + 1, 'healthy')
+                    self.increases += 1
+            self._changed.notify_all()
+
+    def latency_exceeded(self):
+        if self.latency is None or self.latency_target is None:
+            return False
+        return self.latency > self.latency_target
+
+    def _set_limit(self, limit, reason):
+        self._successes = 0
+        self._saturated = False
+        if limit == self.limit:
+            return
+        logger.info('Concurrency limit {0} -> {1} ({2}, latency {3:.0f} ms)'.format(
+            self.limit, limit, reason, (self.latency or 0) * 1000),
+            extra={'concurrency_limit': limit})
+        self.limit = limit
+        self.peak_limit = max(self.peak_limit, limit)
+
+    def stats(self):
+        with self._changed:
+            return {'limit': self.limit, 'peak_limit': self.peak_limit, 'in_flight': self.in_flight,
+                    'requests': self.requests, 'errors': self.errors, 'increases': self.increases,
+                    'decreases': self.decreases,
+                    'latency_ms': round(self.latency * 1000, 1) if self.latency is not None else None}
+
+
+class LimitedAdapter(BaseAdapter):
+    """
+    requests transport adapter passing each request through the
+    limiter to the adapter it wraps. 5xx and 429 (too many requests)
+    responses, timeouts and connection errors are reported to the
+    limiter as errors
+    """
+
+    def __init__(self, adapter, limiter):
+        super(LimitedAdapter, self).__init__()
+        self.adapter = adapter
+        self.limiter = limiter
+
+    def send(self, request, **kwargs):
+        started = self.limiter.acquire()
+        try:
+            response = self.adapter.send(request, **kwargs)
+        except (ConnectionError, Timeout):
+            self.limiter.release(started, error=True)
+            raise
+        except Exception:
+            self.limiter.release(started)
+            raise
+        self.limiter.release(started, error=response.status_code >= 500 or response.status_code == 429)
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+def install(client, limiter):
+    """
+    Route the koordinates client's Data Service requests through the
+    limiter. Returns the client
+    """
+
+    prefix = 'https://{0}/'.format(client.host)
+    # koordinates.Client creates its own requests session and takes
+    # none, so the adapter is mounted on its (private) session
+    session = client._session
+    session.mount(prefix, LimitedAdapter(session.get_adapter(prefix), limiter))
+    return client
@@ -0,0 +1,89 @@
+################################################################################
+#
+# Copyright 2018 Crown copyright (c)
+# Land Information New Zealand and the New Zealand Government.
+# All rights reserved
+#
+# This program is released under the terms of the new BSD license. See the
+# LICENSE file for more information.
+#
+################################################################################
+
+import html
+import json
+import os
+import threading
+
+JSONL_FILE = 'metadata_changes.jsonl'
+HTML_FILE = 'metadata_changes.html'
+
+HTML_HEAD = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Metadata changes</title>
+<style>
+body {{ font-family: sans-serif; font-size: 13px; }}
+table {{ border-collapse: collapse; width: 100%; }}
+th, td {{ border: 1px solid #ccc; padding: 4px; vertical-align: top; text-align: left; }}
+td.old {{ background: #fdd; white-space: pre-wrap; }}
+td.new {{ background: #dfd; white-space: pre-wrap; }}
+td.path {{ font-family: monospace; word-break: break-all; }}
+</style>
+</head>
+<body>
+<h1>Metadata changes{0}</h1>
+<table>
+<tr><th>Layer</th><th>Rule</th><th>Element / line</th><th>Old</th><th>New</th></tr>
+'''
+
+HTML_FOOT = '''</table>
+<p>{0} change(s) to {1} layer(s)</p>
+</body>
+</html>
+'''
+
+
+class DiffReport():
+    """
+    Streams the changes the rules made to each layer's metadata (as
+    recorded by the transform) to one JSON lines and one HTML report
+    per run, so edits can be reviewed without diffing the backups
+    """
+
+    def __init__(self, output_dir, title=None):
+        self.jsonl_file = os.path.join(output_dir, JSONL_FILE)
+        self.html_file = os.path.join(output_dir, HTML_FILE)
+        self.change_count = 0
+        self.layer_count = 0
+        self._lock = threading.Lock()
+        self._jsonl = open(self.jsonl_file, 'w', encoding='utf-8')
+        self._html = open(self.html_file, 'w', encoding='utf-8')
+        self._html.write(HTML_HEAD.format(': ' + html.escape(title) if title else ''))
+
+    def add(self, layer_id, changes):
+        """
+        Add the changes made to a layer
+        """
+
+        if not changes:
+            return
+        with self._lock:
+            self.layer_count += 1
+            for change in changes:
+                self.change_count += 1
+                record = change._asdict()
+                record['layer_id'] = layer_id
+                self._jsonl.write(json.dumps(record) + '\n')
+                location = change.path or 'line {0}'.format(change.line)
+                self._html.write('<tr><td>{0}</td><td>{1}</td><td class="path">{2}</td>'
+                                 '<td class="old">{3}</td><td class="new">{4}</td></tr>\n'.format(
+                                     html.escape(str(layer_id)), html.escape(str(change.rule_id)),
+                                     html.escape(location), html.escape(change.old),
+                                     html.escape(change.new)))
+
+    def close(self):
+        with self._lock:
+            self._html.write(HTML_FOOT.format(self.change_count, self.layer_count))
+            self._html.close()
+            self._jsonl.close()
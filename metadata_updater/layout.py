@@ -0,0 +1,161 @@
+################################################################################
+#
+# Copyright 2018 Crown copyright (c)
+# Land Information New Zealand and the New Zealand Government.
+# All rights reserved
+#
+# This program is released under the terms of the new BSD license. See the
+# LICENSE file for more information.
+#
+################################################################################
+
+"""
+Where the metadata documents of a run are written. The flat layout
+writes <type>_<id>_<title>.iso.xml to the destination directory. The
+sharded layout writes <type>_<id>.iso.xml to one of 256 subdirectories
+chosen by a hash of the layer id, keeping directories small and paths
+short. Either way an output manifest (layer id: path, type, version,
+sha1 and title) is written once per run, and files are resolved
+through it rather than by name
+"""
+
+import hashlib
+import json
+import os
+import threading
+import zlib
+
+OUTPUT_MANIFEST_FILE = 'output_manifest.json'
+
+FLAT = 'flat'
+SHARDED = 'sharded'
+LAYOUTS = (FLAT, SHARDED)
+
+
+def bucket(layer_id):
+    """
+    Return the subdirectory name (00 - ff) of the layer in the
+    sharded layout. The hash is stable across processes and hosts
+    """
+
+    return '{0:02x}'.format(zlib.crc32(str(int(layer_id)).encode('ascii')) & 0xff)
+
+
+def layer_file(destination_dir, layer, layout=FLAT):
+    """
+    Return the path of the layer's metadata document,
+    creating its subdirectory in the sharded layout
+    """
+
+    if layout == SHARDED:
+        directory = os.path.join(destination_dir, bucket(layer.id))
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, '{0}_{1}.iso.xml'.format(layer.type, layer.id))
+
+    from .metadata_updater import remove_illegal_chars
+
+    return os.path.join(destination_dir, '{0}_{1}_{2}.iso.xml'.format(
+        layer.type, layer.id, remove_illegal_chars(layer.title)))
+
+
+def file_sha1(file):
+    sha1 = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(64 * 1024), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def load_manifest(destination_dir):
+    """
+    Return the output manifest of the destination dir as
+    {layer id: entry}, or {} if there is none
+    """
+
+    try:
+        with open(os.path.join(destination_dir, OUTPUT_MANIFEST_FILE)) as f:
+            return {int(layer_id): entry for layer_id, entry in json.load(f)['layers'].items()}
+    except FileNotFoundError:
+        return {}
+
+
+def resolve(destination_dir, layer_id, manifest=None):
+    """
+    Return the path of the layer's metadata document in
+    the destination dir, or None if it is not in the manifest.
+    manifest is the dir's load_manifest, loaded if None
+    """
+
+    if manifest is None:
+        manifest = load_manifest(destination_dir)
+    entry = manifest.get(int(layer_id))
+    return os.path.join(destination_dir, entry['path']) if entry else None
+
+
+class OutputIndex():
+    """
+    Collects the documents written in a run and writes them to
+    the destination dir's output manifest at the end of the run.
+    Entries for layers not in the run are kept, so runs over
+    different layers (e.g. in service mode) add to the manifest
+    """
+
+    def __init__(self, destination_dir, layout=FLAT):
+        self.destination_dir = destination_dir
+        self.layout = layout
+        self.entries = {}
+        # The manifest as of the start of the run
+        self.manifest = load_manifest(destination_dir)
+        self._lock = threading.Lock()
+
+    def resolve(self, layer_id):
+        """
+        Return the path of the layer's document from an earlier run,
+        or earlier in this one, or None if there is no entry for it
+        """
+
+        with self._lock:
+            entry = self.entries.get(int(layer_id))
+        if entry:
+            return os.path.join(self.destination_dir, entry['path'])
+        return resolve(self.destination_dir, layer_id, self.manifest)
+
+    def add(self, layer, file):
+        version = getattr(layer, 'version', None)
+        with self._lock:
+            self.entries[int(layer.id)] = {
+                'path': os.path.relpath(file, self.destination_dir),
+                'type': layer.type,
+                'version': getattr(version, 'id', None),
+                'title': layer.title}
+
+    def add_manifest(self, directory):
+        """
+        Add the entries of another destination dir's manifest,
+        e.g. a shard's, with their paths relative to this one
+        """
+
+        prefix = os.path.relpath(directory, self.destination_dir)
+        with self._lock:
+            for layer_id, entry in load_manifest(directory).items():
+                self.entries[layer_id] = dict(entry, path=os.path.join(prefix, entry['path']))
+
+    def write(self):
+        """
+        Hash the documents, as they are at the end of the run,
+        and write the manifest
+        """
+
+        layers = load_manifest(self.destination_dir)
+        with self._lock:
+            for layer_id, entry in self.entries.items():
+                file = os.path.join(self.destination_dir, entry['path'])
+                if 'sha1' not in entry and os.path.isfile(file):
+                    entry['sha1'] = file_sha1(file)
+                layers[layer_id] = entry
+        manifest_file = os.path.join(self.destination_dir, OUTPUT_MANIFEST_FILE)
+        with open(manifest_file + '.tmp', 'w') as f:
+            json.dump({'layout': self.layout,
+                       'layers': {str(layer_id): layers[layer_id] for layer_id in sorted(layers)}},
+                      f, separators=(',', ':'))
+        os.replace(manifest_file + '.tmp', manifest_file)
@@ -9,12 +9,64 @@
 #
 ################################################################################
 
+import atexit
+import contextlib
+import json
 import logging
 import logging.handlers
+import os
+import queue
+import time
 
-def conf_logging(name):
+# Extra record attributes emitted as their own keys in structured output
+STAGE_FIELDS = ('layer_id', 'stage', 'duration', 'outcome', 'concurrency_limit')
+
+_listener = None
+_handlers = []
+_stage_observers = []
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format log records as single line JSON objects
+    so the log can be parsed for post run analysis
+    """
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'logger': record.name,
+            'function': record.funcName,
+            'message': record.getMessage()
+        }
+        for field in STAGE_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def stop_logging():
+    """
+    Stop the queue listener (if running), flushing any
+    queued records to the file and console handlers
+    """
+
+    global _listener
+
+    if _listener:
+        _listener.stop()
+        _listener = None
+
+
+def conf_logging(name, structured=False, asynchronous=False):
     ''' logging '''
 
+    global _listener
+
     # CREATE LOGGER
     log_file = 'metadata_updater.log'
     log_file_max_size = 1024 * 1024 * 20 # megabytes
@@ -23,18 +75,93 @@ def conf_logging(name):
     log_date_format = "%m/%d/%Y %I:%M:%S %p"
     log_filemode = 'w' # w: overwrite; a: append
 
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
+
+    # REMOVE HANDLERS FROM ANY PREVIOUS CALL
+    # so records are not written more than once
+    stop_logging()
+    for handler in _handlers:
+        logger.removeHandler(handler)
+        handler.close()
+    del _handlers[:]
+
     # SET UP LOGGER
-    logging.basicConfig(filename=log_file, format=log_format, filemode=log_filemode ,level=logging.DEBUG)
+    # RotatingFileHandler always appends, truncate here to honour the filemode
+    if log_filemode == 'w' and os.path.isfile(log_file):
+        open(log_file, 'w').close()
     rotate_file = logging.handlers.RotatingFileHandler(
         log_file, maxBytes=log_file_max_size, backupCount=log_num_backups
     )
-    logger = logging.getLogger(name)
-    logger.addHandler(rotate_file)
 
     # OUTPUT TO CONSOLE
+    # Stage timings are logged at DEBUG, for the log file only
     consoleHandler = logging.StreamHandler()
-    logFormatter = logging.Formatter(log_format)
-    consoleHandler.setFormatter(logFormatter)
-    logger.addHandler(consoleHandler)
-    
-    return logger
\ No newline at end of file
+    consoleHandler.setLevel(logging.INFO)
+
+    if structured:
+        rotate_file.setFormatter(JsonFormatter())
+    else:
+        rotate_file.setFormatter(logging.Formatter(log_format))
+    consoleHandler.setFormatter(logging.Formatter(log_format))
+
+    if asynchronous:
+        # Workers only enqueue records. Formatting and
+        # writing happens on the listener's thread
+        log_queue = queue.Queue()
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        _listener = logging.handlers.QueueListener(log_queue, rotate_file, consoleHandler,
+                                                   respect_handler_level=True)
+        _listener.start()
+        _handlers.extend([queue_handler, rotate_file, consoleHandler])
+        logger.addHandler(queue_handler)
+    else:
+        _handlers.extend([rotate_file, consoleHandler])
+        logger.addHandler(rotate_file)
+        logger.addHandler(consoleHandler)
+
+    return logger
+
+
+def add_stage_observer(observer):
+    """
+    Register an observer of the pipeline stages. observer(layer_id,
+    name, result) must return a context manager, which is entered
+    for the duration of each stage (on the stage's thread)
+    """
+
+    _stage_observers.append(observer)
+
+
+def remove_stage_observer(observer):
+    if observer in _stage_observers:
+        _stage_observers.remove(observer)
+
+
+@contextlib.contextmanager
+def stage(logger, layer_id, name):
+    """
+    Time a pipeline stage for a layer and log its outcome as
+    a record carrying layer_id, stage, duration and outcome.
+    The yielded dict can be used to set a non default outcome
+    """
+
+    result = {'outcome': 'ok'}
+    with contextlib.ExitStack() as observers:
+        for observer in list(_stage_observers):
+            observers.enter_context(observer(layer_id, name, result))
+        start = time.perf_counter()
+        try:
+            yield result
+        except Exception:
+            result['outcome'] = 'error'
+            raise
+        finally:
+            duration = round(time.perf_counter() - start, 6)
+            logger.debug('Dataset {0}: {1} {2} in {3:.3f}s'.format(layer_id, name,
+                                                                   result['outcome'], duration),
+                         extra={'layer_id': layer_id, 'stage': name,
+                                'duration': duration, 'outcome': result['outcome']})
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,133 @@
+################################################################################
+#
+# Copyright 2018 Crown copyright (c)
+# Land Information New Zealand and the New Zealand Government.
+# All rights reserved
+#
+# This program is released under the terms of the new BSD license. See the
+# LICENSE file for more information.
+#
+################################################################################
+
+import json
+import logging
+import os
+import shutil
+import threading
+
+from .layout import FLAT, SHARDED, layer_file
+
+logger = logging.getLogger(__name__)
+
+VALIDATORS_SUFFIX = '.validators.json'
+
+
+class MetadataCache():
+    """
+    Keeps the last downloaded copy of each layer's metadata with its
+    HTTP validators (ETag and Last-Modified) in a directory that
+    persists between runs. Later downloads are conditional
+    (If-None-Match / If-Modified-Since) and on a 304 the cached copy
+    is used, so only documents changed since the last run are
+    transferred. With the sharded layout the cached copies are kept
+    in the same hashed subdirectories as the output
+    """
+
+    def __init__(self, directory, client, layout=FLAT):
+        self.directory = directory
+        self.client = client
+        self.layout = layout
+        os.makedirs(directory, exist_ok=True)
+        self.not_modified = 0
+        self.downloaded = 0
+        self._lock = threading.Lock()
+
+    def document_file(self, layer):
+        if self.layout == SHARDED:
+            return layer_file(self.directory, layer, SHARDED)
+        return os.path.join(self.directory, '{0}_{1}.iso.xml'.format(layer.type, layer.id))
+
+    def validators(self, layer, url):
+        """
+        Return the validators stored for the layer's cached document,
+        or {} if it is not cached or was downloaded from another URL
+        """
+
+        document_file = self.document_file(layer)
+        try:
+            with open(document_file + VALIDATORS_SUFFIX) as f:
+                validators = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if validators.get('url') != url or not os.path.isfile(document_file):
+            return {}
+        return validators
+
+    def get_xml(self, layer, destination):
+        """
+        Write the layer's metadata to destination, downloading
+        it only if it has changed since it was cached. If the
+        conditional request fails it is downloaded uncached
+        """
+
+        import koordinates
+        import requests
+
+        try:
+            document_file = self.download(layer)
+        except (koordinates.exceptions.KoordinatesException, requests.RequestException) as e:
+            logger.warning('Metadata cache request for {0} {1} failed, downloading it uncached: '
+                           '{2}'.format(layer.type, layer.id, e))
+            return layer.metadata.get_xml(destination)
+        shutil.copyfile(document_file, destination)
+        return destination
+
+    def download(self, layer):
+        """
+        Make the conditional request for the layer's metadata,
+        updating the cached copy if it has changed. Returns
+        the cached copy
+        """
+
+        url = layer.metadata.native
+        document_file = self.document_file(layer)
+        validators = self.validators(layer, url)
+        headers = {'Accept': 'text/xml'}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+        response = self.client.request('GET', url, headers=headers, stream=True)
+        if response.status_code == 304:
+            response.close()
+            with self._lock:
+                self.not_modified += 1
+            logger.debug('Metadata of {0} {1} not modified, using cached copy'.format(layer.type, layer.id))
+            return document_file
+
+        # Downloaded to temporary files so an interrupted
+        # download never replaces the cached copy
+        download_file = '{0}.{1}.tmp'.format(document_file, threading.get_ident())
+        try:
+            with open(download_file, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    f.write(chunk)
+        except BaseException:
+            os.remove(download_file)
+            raise
+        finally:
+            response.close()
+        os.replace(download_file, document_file)
+        validators_file = document_file + VALIDATORS_SUFFIX
+        with open('{0}.{1}.tmp'.format(validators_file, threading.get_ident()), 'w') as f:
+            json.dump({'url': url, 'etag': response.headers.get('ETag'),
+                       'last_modified': response.headers.get('Last-Modified')}, f)
+        os.replace(f.name, validators_file)
+        with self._lock:
+            self.downloaded += 1
+        return document_file
+
+    def stats(self):
+        with self._lock:
+            return {'not_modified': self.not_modified, 'downloaded': self.downloaded}
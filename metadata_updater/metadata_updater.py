@@ -11,20 +11,23 @@
 #
 ################################################################################
 
-import koordinates
 import os
 import sys
-import fileinput
-import yaml
 import re
-import requests
 import logging
 import shutil
 import argparse
+import contextlib
 import _locale
-from lxml import etree as ET
 
-from .utils.xml_to_excel import parse_xml_file, write_to_excel, record_missing_metadata
+# koordinates, yaml and lxml are imported where they are
+# used to keep start up fast for small runs
+
+from .utils.xml_to_excel import parse_xml_file, write_to_excel, record_missing_metadata, \
+    SummaryWriter, MissingMetadataWriter, WriterGroup
+from . import run_context
+from .run_context import RunContext, RunOutputs
+from .rules import as_rule, compile_rules, RuleTimeout
 
 _locale._getdefaultlocale = (lambda *args: ['en_US', 'utf8'])
 
@@ -36,7 +39,6 @@ except:
     from . import log
     
 logger = logging.getLogger(__name__)
-ERRORS = 0
 NAMESPACES = {
     'gmd': 'http://www.isotc211.org/2005/gmd',
     'gco': 'http://www.isotc211.org/2005/gco',
@@ -65,9 +67,29 @@ class ConfigReader():
         if not os.path.exists(cwd):
             raise FileNotFoundError('Can not find config file')
 
+        import yaml
+
         with open(cwd, 'r') as f:
             config = yaml.safe_load(f)
 
+        self.load(config)
+
+    @classmethod
+    def from_dict(cls, config):
+        """
+        Create a config object from an already
+        parsed config (e.g. a dict from an orchestrator)
+        """
+
+        reader = cls.__new__(cls)
+        reader.load(config)
+        return reader
+
+    def load(self, config):
+        """
+        Set the config properties from the parsed config
+        """
+
         # CONNECTION
         if 'Connection' in config:
             if os.getenv('LDS_APIKEY', None):
@@ -83,12 +105,24 @@ class ConfigReader():
         # FIND AND REPLACE TEXT
         if 'Text' in config:
             self.text_mapping = config['Text']['Mapping']
+            self.regex_timeout_ms = config['Text'].get('Regex_timeout_ms')
+            self.strict_regex_check = config['Text'].get('Strict_regex_check', False)
         else:
             raise SystemExit('CONFIG ERROR: No "Text" section')
 
         # OUTPUT DIR
+        self.diff_report, self.metadata_cache, self.layout = False, None, 'flat'
         if 'Output' in config:
             self.destination_dir = config['Output']['Destination']
+            self.metadata_cache = config['Output'].get('Metadata_cache')
+            self.layout = config['Output'].get('Layout') or 'flat'
+            if self.layout not in ('flat', 'sharded'):
+                raise SystemExit('CONFIG ERROR: "Layout" must be ' \
+                '"flat" or "sharded". Got:"{}" instead'.format(self.layout))
+            self.diff_report = config['Output'].get('Diff_report', False)
+            if self.diff_report not in (True, False):
+                raise SystemExit('CONFIG ERROR: "Diff_report" must be ' \
+                '"True" or "False". Got:"{}" instead'.format(self.diff_report))
         else:
             self.destination_dir = os.getcwd()  + os.path.sep
 
@@ -113,24 +147,108 @@ class ConfigReader():
             raise SystemExit('CONFIG ERROR: No "Test" section')
         
         # IF SUMMARISE
+        self.summarise, self.summary_excel, self.summary_analytics = False, True, False
         if 'Summarise' in config:
             self.summarise = config['Summarise']['Summarise_metadata']
-            
-
-def post_metadata(draft, file):
+            self.summary_excel = config['Summarise'].get('Summary_excel', True)
+            if self.summary_excel not in (True, False):
+                raise SystemExit('CONFIG ERROR: "Summary_excel" must be ' \
+                '"True" or "False". Got:"{}" instead'.format(self.summary_excel))
+            self.summary_analytics = config['Summarise'].get('Analytics', False)
+            if self.summary_analytics not in (True, False):
+                raise SystemExit('CONFIG ERROR: "Analytics" must be ' \
+                '"True" or "False". Got:"{}" instead'.format(self.summary_analytics))
+
+        # VALIDATION OF EDITED DOCUMENTS
+        self.validation_schema, self.validation_schematron = None, None
+        if 'Validation' in config:
+            self.validation_schema = config['Validation'].get('Schema')
+            self.validation_schematron = config['Validation'].get('Schematron')
+
+        # SHARD, SET BY --shard
+        self.shard = None
+
+        # METADATA STORE
+        self.store_path, self.store_label = None, None
+        if 'Store' in config:
+            self.store_path = config['Store'].get('Path')
+            self.store_label = config['Store'].get('Label')
+
+        # LOGGING
+        self.log_format, self.log_queue = 'text', False
+        if 'Logging' in config:
+            self.log_format = config['Logging'].get('Format', 'text')
+            if self.log_format not in ('text', 'json'):
+                raise SystemExit('CONFIG ERROR: "Logging Format" must be ' \
+                '"text" or "json". Got:"{}" instead'.format(self.log_format))
+
+            self.log_queue = config['Logging'].get('Queue', False)
+            if self.log_queue not in (True, False):
+                raise SystemExit('CONFIG ERROR: "Logging Queue" must be ' \
+                '"True" or "False". Got:"{}" instead'.format(self.log_queue))
+
+        # SERVICE MODE
+        self.service_batch_size, self.service_batch_wait = 50, 5
+        if 'Service' in config:
+            self.service_batch_size = config['Service'].get('Batch_size', 50)
+            self.service_batch_wait = config['Service'].get('Batch_wait', 5)
+
+        # PERFORMANCE
+        self.transform_workers, self.network_workers = 1, 1
+        self.queue_size, self.max_rss_mb, self.publish_batch_size = None, None, 0
+        self.adaptive_concurrency, self.min_network_workers, self.latency_target_ms = False, 1, None
+        self.streaming_threshold_mb, self.compression, self.compress_uploads = None, False, False
+        self.track_publishes, self.publish_wait_timeout = False, None
+        self.priority, self.priority_window = [], 1000
+        if 'Performance' in config:
+            self.transform_workers = config['Performance'].get('Transform_workers', 1)
+            self.network_workers = config['Performance'].get('Network_workers', 1)
+            self.queue_size = config['Performance'].get('Queue_size')
+            self.max_rss_mb = config['Performance'].get('Max_rss_mb')
+            self.publish_batch_size = config['Performance'].get('Publish_batch_size') or 0
+            self.adaptive_concurrency = config['Performance'].get('Adaptive_concurrency', False)
+            if self.adaptive_concurrency not in (True, False):
+                raise SystemExit('CONFIG ERROR: "Adaptive_concurrency" must be ' \
+                '"True" or "False". Got:"{}" instead'.format(self.adaptive_concurrency))
+            self.min_network_workers = config['Performance'].get('Min_network_workers') or 1
+            self.latency_target_ms = config['Performance'].get('Latency_target_ms')
+            self.streaming_threshold_mb = config['Performance'].get('Streaming_threshold_mb')
+            self.compression = config['Performance'].get('Compression', False)
+            if self.compression not in (True, False):
+                raise SystemExit('CONFIG ERROR: "Compression" must be ' \
+                '"True" or "False". Got:"{}" instead'.format(self.compression))
+            self.compress_uploads = config['Performance'].get('Compress_uploads', False)
+            if self.compress_uploads not in (True, False):
+                raise SystemExit('CONFIG ERROR: "Compress_uploads" must be ' \
+                '"True" or "False". Got:"{}" instead'.format(self.compress_uploads))
+            self.track_publishes = config['Performance'].get('Track_publishes', False)
+            if self.track_publishes not in (True, False):
+                raise SystemExit('CONFIG ERROR: "Track_publishes" must be ' \
+                '"True" or "False". Got:"{}" instead'.format(self.track_publishes))
+            self.publish_wait_timeout = config['Performance'].get('Publish_wait_timeout')
+            self.priority = config['Performance'].get('Priority') or []
+            if isinstance(self.priority, str):
+                self.priority = [self.priority]
+            self.priority_window = config['Performance'].get('Priority_window') or 1000
+        if not self.queue_size:
+            self.queue_size = max(self.transform_workers, self.network_workers) * 4
+
+
+def post_metadata(draft, file, context=None):
     """
     Update the Data Service draft version for the 
     layer with the edited metadata
     """
 
-    global ERRORS
+    import koordinates
 
     try:
         xml = open(file).read()
         draft.set_metadata(xml.encode('utf-8'), version_id=draft.version.id)
         return True
     except koordinates.exceptions.ServerError as e:
-        ERRORS += 1
+        if context:
+            context.add_error(draft.id, 'post_metadata', str(e))
         logger.critical('metadata update for {0} fail with {1}'.format(draft.version.id,
                                                                         str(e)))
         return False
@@ -145,26 +263,36 @@ def remove_illegal_chars(title):
              title = title.replace(illegal, '')
     return title
 
-def get_metadata(layer, dir, overwrite):
+def get_metadata(layer, dir, overwrite, context=None, cache=None, layout='flat'):
     """
-    Download the layers metadata file
+    Download the layers metadata file to its path in the output
+    layout. If a MetadataCache is given it is only downloaded if
+    it has changed
     """
 
-    global ERRORS
+    from .layout import layer_file
 
-    title = remove_illegal_chars(layer.title)
-    file_destination = os.path.join(dir,'{0}_{1}_{2}.iso.xml'.format(layer.type,
-                                                                                        layer.id, 
-                                                                                        title))
+    file_destination = layer_file(dir, layer, layout)
 
     if overwrite:
         file_exists(file_destination)
+        # The layer's document from an earlier run moves if its title
+        # or the layout changed. Remove it so each layer has one document
+        previous = context.output_index.resolve(layer.id) if context and context.output_index else None
+        if previous and os.path.normpath(previous) != os.path.normpath(file_destination):
+            logger.info('{0} {1} moved from {2}'.format(layer.type, layer.id, previous))
+            file_exists(previous)
+            file_exists(previous + '._bak')
     
     try: 
-        layer.metadata.get_xml(file_destination)
+        if cache is not None:
+            cache.get_xml(layer, file_destination)
+        else:
+            layer.metadata.get_xml(file_destination)
     except AttributeError as e:
         logger.critical(f"Failed to get XML for layer with ID {layer.id}: {str(e)}")
-        ERRORS += 1
+        if context:
+            context.add_error(layer.id, 'get_metadata', str(e))
         return None
     return file_destination
 
@@ -179,49 +307,19 @@ def update_metadata(dest_file, mapping):
     all values of an xml element. It is not safe to use this for the
     when not using target_element and targeting the entire file
     """
-    tree = ET.parse(dest_file)
-    root = tree.getroot()
-    
-    # Extract namespaces and create a namespace dictionary
-    namespaces = {node[0]: node[1] for _, node in ET.iterparse(dest_file, events=['start-ns'])}
-    target_element = mapping.get('target_element')
-    search_text = mapping['search']
-    replace_text = mapping['replace']
-    ignore_case = mapping['ignore_case']
-
-    if file_has_text(search_text, ignore_case, dest_file, target_element):
-        if target_element:
-            # Target specific elements in the XML
-            elements = root.findall(target_element, namespaces)
-            for element in elements:
-                if element is not None and element.text:
-                    if ignore_case:
-                        search_pattern = re.compile(search_text, flags=re.IGNORECASE | re.DOTALL)
-                    else:
-                        search_pattern = re.compile(search_text, flags=re.DOTALL)
-                    
-                    # Ensure replacement is done only once
-                    element.text = re.sub(search_pattern, replace_text, element.text, count=1)
-        else:
-            # Perform a generic find and replace
-            with fileinput.FileInput(dest_file, inplace=True) as file:
-                for line in file:
-                    if ignore_case:
-                        line = re.sub(search_text, replace_text, line.rstrip(), flags=re.IGNORECASE)
-                    else:
-                        line = re.sub(search_text, replace_text, line.rstrip())
-                    print(line)
-            return
 
-    # Register namespaces to ensure correct prefixes
-    for prefix, uri in namespaces.items():
-        if prefix:  # Skip empty prefixes
-            ET.register_namespace(prefix, uri)
+    from .transform import Document
+
+    with open(dest_file, 'rb') as f:
+        document = Document(f.read())
 
-    tree.write(dest_file, encoding='utf-8', xml_declaration=True, pretty_print=True)
+    # mapping can be a config mapping dict or a compiled Rule
+    if document.apply(as_rule(mapping)):
+        with open(dest_file, 'wb') as f:
+            f.write(document.tobytes())
 
 
-def set_metadata(layer, file, publisher):
+def set_metadata(layer, file, publisher, context=None):
     """
     Wraps several update methods.
     Gets Draft version of the layer, updates the metadata, 
@@ -229,21 +327,22 @@ def set_metadata(layer, file, publisher):
     """
 
     # GET A DRAFT VERSION OF THE LAYER
-    draft = get_draft(layer)
+    draft = get_draft(layer, context)
     if not draft:
         return False
     # UPDATE METADATA
-    success = post_metadata(draft, file)
+    success = post_metadata(draft, file, context)
     # IMPORT DRAFT  File 
     if success:
         add_to_pub_group(publisher, draft)
     return success
 
-def delete_draft(layer, version):
+def delete_draft(layer, version, context=None):
     """
     Delete a draft version 
     """
-    global ERRORS
+
+    import koordinates
 
     try:
         layer.delete_version(version)
@@ -252,16 +351,15 @@ def delete_draft(layer, version):
         return True
     except koordinates.exceptions.ServerError as e:
         logger.critical('{0}'.format(e))
-        ERRORS += 1
+        if context:
+            context.add_error(layer.id, 'delete_draft', str(e))
         return False
 
-def get_draft(layer):
+def get_draft(layer, context=None):
     """
     If no draft exists, create one. 
     Else return the current draft. 
     """
-    
-    global ERRORS
 
     if not draft_exists(layer):
         # Create new draft
@@ -273,18 +371,19 @@ def get_draft(layer):
         if draft.active_publish:
             # and someone has attempted to publish it
             #TODO // automate deletion of publish group and then draft
-            ERRORS += 1
+            if context:
+                context.add_error(layer.id, 'get_draft', 'draft is in a publish group')
             logger.critical('A draft already exists for {0} and is in a ' \
                             'publish group. THIS HAS NOT BEEN UPDATED '.format(layer.id))
             return None
         else:
-            del_draft = delete_draft(layer, draft.version)
+            del_draft = delete_draft(layer, draft.version, context)
             if not del_draft:
                 return None
             draft = layer.create_draft_version()
             return draft
     else:   #A draft exists but we know nothing of its state/ history
-        del_draft = delete_draft(layer, draft.version)
+        del_draft = delete_draft(layer, draft.version, context)
         if not del_draft:
             return None
         draft = layer.create_draft_version()
@@ -326,13 +425,13 @@ def file_exists(file):
     if os.path.isfile(file):
         os.remove(file)
 
-def get_layer(client, id):
+def get_layer(client, id, context=None):
     """
     Get an object representing the layer as
     per the layer id parameter
     """
 
-    global ERRORS
+    import koordinates
 
     # FETCH LAYER OBJECT AND METADATA FILE
     logger.info('Processing dataset: {0}'.format(id))
@@ -342,7 +441,8 @@ def get_layer(client, id):
         return layer
     except koordinates.exceptions.ServerError as e:
         logger.critical('{0}'.format(e))
-        ERRORS += 1
+        if context:
+            context.add_error(id, 'get_layer', str(e))
 # 
 # def update_doc():
 #     """ 
@@ -357,15 +457,23 @@ def get_layer(client, id):
 #     """
 #     pass
 
-def iterate_all(client):
+def iterate_all(client, catalog=None):
     """
     Iterate through the entire Data Service catalog.
     Returns a generator of all layer / table ids
     *Currently only layers and tables are handled
+    If a catalog dict is given the fields layers are
+    prioritised by are added to it by layer id
     """
 
+    import koordinates
+
     for item in client.catalog.list():
         if type(item) == type(koordinates.layers.Layer()):
+            if catalog is not None:
+                from .priority import catalog_entry
+
+                catalog[item.id] = catalog_entry(item)
             yield item.id
         else:
             try:
@@ -374,14 +482,30 @@ def iterate_all(client):
             except:
                 pass
 
+def as_layer_id(value):
+    """
+    Return the layer id (an int or a string of digits) as
+    an int. Raises ValueError if it is not a layer id
+    """
+
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value.strip())
+    raise ValueError('Not a layer id: {0!r}'.format(value))
+
 def iterate_selective(layers): 
     """
     Iterate through user supplied (via config.yaml)
-    dataset IDs. Returns a generator of layer ids to process
+    dataset IDs. Returns a generator of layer ids to process.
+    Ids that are not layer ids are logged and skipped
     """
 
     for layer_id in layers:
-        yield layer_id
+        try:
+            yield as_layer_id(layer_id)
+        except ValueError as e:
+            logger.error('Skipping layer: {0}'.format(e))
 
 def file_has_text(search_text, ignore_case, file):
     """
@@ -395,27 +519,34 @@ def file_has_text(search_text, ignore_case, file, target_element=None):
     Test for the search text in the file or within a specified XML element.
     Because there is no point updating and posting a file
     if there are no changes to be made.
+    The search text can be a pattern already compiled with its flags
     """
 
+    if hasattr(search_text, 'search'):
+        search_pattern = search_text
+    else:
+        search_pattern = re.compile(search_text, re.IGNORECASE if ignore_case else 0)
+
     if target_element:
-        # Parse the XML file
-        tree = ET.parse(file)
-        root = tree.getroot()
-        element = root.find(target_element, NAMESPACES)
-        if element is not None and element.text:
-            flags = re.IGNORECASE if ignore_case else 0
-            if re.search(search_text, element.text, flags=flags):
-                return True
-        return False
+        from .streaming import PathMatcher, find_text
+
+        if PathMatcher.supports(target_element):
+            # Only parse as far as the element
+            text = find_text(file, target_element)
+        else:
+            from lxml import etree as ET
+
+            # Parse the XML file
+            tree = ET.parse(file)
+            root = tree.getroot()
+            element = root.find(target_element, NAMESPACES)
+            text = element.text if element is not None else None
+        return bool(text and search_pattern.search(text))
     else:
         # Generic text search in the file
         with open(file, 'r') as f:
             for line in f:
-                if ignore_case:
-                    match = re.search(search_text, line, flags=re.IGNORECASE)
-                else:
-                    match = re.search(search_text, line)
-                if match:
+                if search_pattern.search(line):
                     return True
             return False
 
@@ -432,7 +563,9 @@ def get_client(domain, api_key):
     """
     Return Koordinates API client
     """
-    
+
+    import koordinates
+
     return koordinates.Client(domain, api_key)
 
 
@@ -442,145 +575,642 @@ def parse_args(args):
                             default=None,
                             nargs='?',
                             help="Path to config file")
-    return cli_parser.parse_args()
+    cli_parser.add_argument('--service',
+                            default=None,
+                            help='Run as a service processing layer ids from ' \
+                            '"stdin", "spool:<directory>" or "socket:<path>"')
+    cli_parser.add_argument('--profile',
+                            default=None,
+                            choices=['cpu', 'memory', 'both'],
+                            help='Profile the run with cProfile (cpu), tracemalloc ' \
+                            '(memory) or both. Results are written to the output directory')
+    cli_parser.add_argument('--shard',
+                            default=None,
+                            type=parse_shard,
+                            metavar='K/N',
+                            help='Process only the K-th of N shards of the layers, ' \
+                            'without publishing, for running one update across hosts')
+    cli_parser.add_argument('--merge-shards',
+                            action='store_true',
+                            help='Combine the outputs of all shards and publish their drafts')
+    return cli_parser.parse_args(args)
 
-def main():
+def parse_shard(text):
+    from .sharding import parse_shard
+
+    return parse_shard(text)
+
+class Runner():
     """
-    Script for updating LDS Metadata. Written for the purpose
-    of replacing CC3 text with CC4 text but with scope for 
-    extending to other metadata updating tasks     
+    Run the metadata update for a config. The runner holds
+    the config, API client and compiled rules and can be run
+    repeatedly in one process, each run returning its own RunResult.
+    The client can be injected (e.g. a shared or test client)
     """
 
-    global ERRORS
+    def __init__(self, config, client=None):
+        from .transform import Transformer
+
+        if isinstance(config, dict):
+            config = ConfigReader.from_dict(config)
+        self.config = config
+        self.client = client or get_client(config.domain, config.api_key)
+        if config.summary_analytics:
+            from .analytics import require_numpy
+
+            # A config error before any layer is processed
+            require_numpy()
+        self.rules = compile_rules(config.text_mapping,
+                                   config.regex_timeout_ms / 1000.0 if config.regex_timeout_ms else None,
+                                   config.strict_regex_check)
+        self.validator = None
+        if config.validation_schema or config.validation_schematron:
+            from .validation import Validator
+
+            self.validator = Validator(config.validation_schema, config.validation_schematron)
+            # Compiled here so a bad schema is a config error before any layer is processed
+            self.validator.compile()
+        self.transformer = Transformer(self.rules, config.transform_workers, config.diff_report,
+                                       self.validator)
+        self.limiter = None
+        if config.adaptive_concurrency:
+            from . import concurrency
+
+            self.limiter = concurrency.AdaptiveLimiter(
+                min(config.min_network_workers, config.network_workers), config.network_workers,
+                latency_target=config.latency_target_ms / 1000.0 if config.latency_target_ms else None)
+            concurrency.install(self.client, self.limiter)
+        self.transfer_stats = None
+        if config.compression:
+            from . import compression
+
+            self.transfer_stats = compression.TransferStats()
+            compression.install(self.client, self.transfer_stats, config.compress_uploads)
+        self.metadata_cache = None
+        if config.metadata_cache:
+            from .metadata_cache import MetadataCache
+
+            self.metadata_cache = MetadataCache(config.metadata_cache, self.client, config.layout)
+        # Called with each published (or failed) layer when publishes are tracked
+        self.publish_listeners = []
+        # Catalog fields of the layers listed or fetched, to order them by the priority keys
+        self.catalog_entries = {}
+        # Layers fetched for their catalog fields, by id, until they are processed
+        self.prefetched = {}
+        if config.priority:
+            from .priority import sort_key
+
+            for key in config.priority:
+                sort_key(key)
+
+    def close(self):
+        """
+        Shut down the transform worker processes
+        """
+
+        self.transformer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def layer_ids(self):
+        """
+        Return a generator of the layer ids to process as per config
+        """
+
+        if self.config.layers in ('ALL', 'all', 'All'):
+            return iterate_all(self.client, self.catalog_entries if self.config.priority else None)
+        return iterate_selective(self.config.layers)
+
+    def prioritise(self, layer_ids):
+        """
+        Return a generator of the layer ids ordered by the configured
+        priority keys within windows of Priority_window ids, so the
+        ids are never all held. The catalog fields recorded as layers
+        are listed or fetched, in this or previous runs, are used and
+        layers with none are fetched for them
+        """
+
+        from . import priority
+
+        config = self.config
+        cache = priority.CatalogCache(os.path.join(config.destination_dir, priority.CATALOG_CACHE_FILE))
+        for window in priority.windows(layer_ids, config.priority_window):
+            entries, fetched = {}, 0
+            for layer_id in window:
+                entry = self.catalog_entries.get(int(layer_id)) or cache.entries.get(int(layer_id))
+                if entry is None:
+                    fetched += 1
+                    entry = self.fetch_catalog_entry(layer_id)
+                if entry is not None:
+                    entries[int(layer_id)] = entry
+            logger.info('Ordered {0} layer(s) by {1}, fetching the catalog fields of {2}'.format(
+                len(window), ', '.join(config.priority), fetched))
+            missing = [str(layer_id) for layer_id in window if int(layer_id) not in entries]
+            if missing:
+                logger.warning('No catalog fields for layer(s) {0}, processed last in their '
+                               'window'.format(', '.join(missing)))
+            yield from priority.order_layers(window, config.priority, entries)
+
+    def fetch_catalog_entry(self, layer_id):
+        """
+        Get the layer for its catalog fields, keeping it to be
+        processed. Returns the catalog entry or None on failure
+        """
+
+        import koordinates
+
+        from .priority import catalog_entry
 
-    cli_parser = parse_args(sys.argv[1:])
-    config_file = cli_parser.config_file
+        try:
+            layer = self.client.layers.get(str(layer_id))
+        except koordinates.exceptions.KoordinatesException as e:
+            logger.debug('Failed to get the catalog fields of layer {0}: {1}'.format(layer_id, e))
+            return None
+        self.prefetched[int(layer_id)] = layer
+        self.catalog_entries[int(layer_id)] = catalog_entry(layer)
+        return self.catalog_entries[int(layer_id)]
 
-    layer_count, layers_edited_count = 0,0
+    def save_catalog_entries(self):
+        """
+        Add the catalog fields recorded in the run to the
+        destination dir's cache, for later runs to be ordered by
+        """
 
-    # CONFIG LOGGING
-    log.conf_logging('root')
+        from . import priority
 
-    #CHECK PYTHON VERSION
-    if sys.version_info<(3,3):
-        raise SystemExit('Error, Python interpreter must be 3.3 or higher')
+        if not self.catalog_entries:
+            return
+        cache = priority.CatalogCache(os.path.join(self.config.destination_dir,
+                                                   priority.CATALOG_CACHE_FILE))
+        cache.update(self.catalog_entries)
+        cache.save()
+        self.catalog_entries.clear()
+
+    def run(self, layer_ids=None, outputs=None):
+        """
+        Process the layers (or those in the config if 
+        layer_ids is None), write summaries and publish.
+        If RunOutputs are given they are written to and
+        left open, else the run opens and closes its own
+        """
+
+        from .pipeline import PublishBatcher
+
+        config = self.config
+        if config.shard:
+            from . import sharding
+
+        # CREATE DATA OUT DIR
+        os.makedirs(config.destination_dir, exist_ok = True) 
+
+        # SUMMARIES ARE STREAMED TO THE WORKBOOKS AS LAYERS ARE PROCESSED
+        # Every output opened is closed, in reverse order, even if the run fails
+        with contextlib.ExitStack() as tracking:
+            publish_tracker = self.open_publish_tracker()
+            if publish_tracker is not None:
+                tracking.callback(publish_tracker.close)
+            with contextlib.ExitStack() as sinks:
+                if config.priority:
+                    sinks.callback(self.save_catalog_entries)
+                if outputs is None:
+                    outputs = self.open_outputs()
+                    sinks.callback(outputs.close)
+                else:
+                    sinks.callback(outputs.checkpoint)
+                context = RunContext(outputs.summary_sink, outputs.missing_metadata_sink,
+                                     metadata_store=outputs.metadata_store,
+                                     diff_report=outputs.diff_report,
+                                     output_index=outputs.output_index, publish_tracker=publish_tracker)
+
+                # PUBLISHER (SHARDS RECORD THEIR DRAFTS FOR THE MERGE TO PUBLISH)
+                if config.shard:
+                    publisher = sharding.ManifestPublisher()
+                else:
+                    publisher = PublishBatcher(lambda group: self.publish(group, context),
+                                               config.publish_batch_size)
+
+                if config.test_dry_run:
+                    logger.info('RUNNING IN TEST DRY RUN MODE')
+
+                # ITERATE OVER LAYERS
+                if layer_ids is None:
+                    layer_ids = self.layer_ids()
+                if config.shard:
+                    layer_ids = sharding.shard_layer_ids(layer_ids, config.shard)
+                if config.priority:
+                    layer_ids = self.prioritise(layer_ids)
+
+                if config.transform_workers > 1 or config.network_workers > 1:
+                    self.run_concurrent(layer_ids, publisher, context)
+                else:
+                    for layer_id in layer_ids:
+                        self.process_layer(layer_id, publisher, context)
+
+            # PUBLISH (ANY DRAFTS NOT PUBLISHED IN A BATCH)
+            if not config.test_dry_run:
+                publisher.flush()
+            self.wait_for_publishes(context)
+
+        if self.limiter:
+            logger.info('Concurrency: {0}'.format(self.limiter.stats()))
+        if self.metadata_cache:
+            logger.info('Metadata cache: {0}'.format(self.metadata_cache.stats()))
+        if self.transfer_stats:
+            logger.info('Transfer: {0}'.format(self.transfer_stats.stats()))
+
+        if config.shard:
+            sharding.write_manifest(config.destination_dir, config.shard, publisher, context.result())
+
+        return context.result()
+
+    def run_concurrent(self, layer_ids, publisher, context):
+        """
+        Process the layers in a pipeline of bounded stages. Layers 
+        are fetched and posted on network_workers threads and 
+        transformed by the transformer's worker processes
+        """
+
+        from .pipeline import Pipeline
+
+        config = self.config
+        max_rss = config.max_rss_mb * 1024 * 1024 if config.max_rss_mb else None
+        Pipeline(self, publisher, context, config.network_workers,
+                 config.queue_size, max_rss).run(layer_ids)
+
+    def process_layer(self, layer_id, publisher, context):
+        """
+        Get, summarise, edit and post the metadata 
+        for a single layer
+        """
+
+        fetched = self.fetch_layer(layer_id, context)
+        if not fetched:
+            return
+        layer, file = fetched
+        self.finish_layer(layer_id, layer, file, None, publisher, context)
 
-    # READ CONFIG IN
-    config = ConfigReader(config_file)
-    mapping = config.text_mapping
-    # CREATE DATA OUT DIR
-    os.makedirs(config.destination_dir, exist_ok = True) 
-    # API CLIENT
-    client = get_client(config.domain, config.api_key)
-    # PUBLISHER
-    publisher = koordinates.Publish()
-
-    #SUMMARISED DATA
-    xml_data = [] 
-    missing_metadata = []
-
-    if config.test_dry_run:
-        logger.info('RUNNING IN TEST DRY RUN MODE')
-
-    # ITERATE OVER LAYERS
-    if config.layers in ('ALL', 'all', 'All'):
-        layer_ids = iterate_all(client)
-    else: 
-        layer_ids = iterate_selective(config.layers)
+    def fetch_layer(self, layer_id, context):
+        """
+        Get the layer and its metadata file, summarising the metadata 
+        if configured. Returns (layer, file) or None on failure 
+        """
+
+        config = self.config
 
-    for layer_id in layer_ids:
-        layer_count += 1
+        context.add_layer()
         get_layer_attempts = 0
 
-        # GET LAYER OBJECT
+        # GET LAYER OBJECT (UNLESS FETCHED FOR ITS CATALOG FIELDS)
         # lds is returning 504s (issue #15)
-        while get_layer_attempts <= 3:
-            get_layer_attempts += 1 
-            layer = get_layer(client, layer_id) 
-            if layer: 
-                break
+        with log.stage(logger, layer_id, 'get_layer') as stage:
+            layer = self.prefetched.pop(layer_id, None) if config.priority else None
+            while not layer and get_layer_attempts <= 3:
+                get_layer_attempts += 1 
+                # Only the last attempt's failure is an error of the layer
+                layer = get_layer(self.client, layer_id, context if get_layer_attempts > 3 else None)
+                if layer: 
+                    break
+            if not layer:
+                stage['outcome'] = 'failed'
         if not layer:
-            ERRORS += 1
             logger.critical('Failed to get layer {0}. THIS LAYER HAS NOT BEEN PROCESSED'. format(layer_id))
-            continue
+            return None
+        if config.priority:
+            from .priority import catalog_entry
+
+            # Recorded for later runs to be ordered by
+            self.catalog_entries[int(layer.id)] = catalog_entry(layer)
 
         # GET METADATA
-        file = get_metadata(layer, config.destination_dir, config.test_overwrite)
+        with log.stage(logger, layer_id, 'get_metadata') as stage:
+            file = get_metadata(layer, config.destination_dir, config.test_overwrite, context,
+                                self.metadata_cache, config.layout)
+            if not file:
+                stage['outcome'] = 'missing'
+        if file and context.output_index is not None:
+            context.output_index.add(layer, file)
         if not file:
             # Metadata does not exist for this entry - it has been logged as CRITICAL
-            missing_metadata.append({'layer_id': layer.id, 
-                                     'layer_title': layer.title, 
-                                     'layer_url': layer.url,
-                                      '__license_type': layer.license.type if layer.license and layer.license.type else None,
-                                      '__license_url': layer.license.url if layer.license and layer.license.url else None, 
-                                      '__is_public': 'True' if layer.public_access is not None else 'False'})
-            continue
+            context.record_outcome(layer_id, run_context.MISSING_METADATA, 'get_metadata')
+            context.add_missing_metadata({'layer_id': layer.id, 
+                                          'layer_title': layer.title, 
+                                          'layer_url': layer.url,
+                                          '__license_type': layer.license.type if layer.license and layer.license.type else None,
+                                          '__license_url': layer.license.url if layer.license and layer.license.url else None, 
+                                          '__is_public': 'True' if layer.public_access is not None else 'False'})
+            return None
 
         # IF SUMMARISE, STORE ORIGINAL METADATA 
+        data = None
         if config.summarise:
-            data = parse_xml_file(file)
+            with log.stage(logger, layer_id, 'summarise'):
+                data = parse_xml_file(file)
             # Adding a few non-metadata fields to the summary
-            data['__layer_id'] = layer_id
-            data['__license_type'] = layer.license.type if layer.license and layer.license.type else None
-            data['__license_url'] =layer.license.url if layer.license and layer.license.url else None
-            data['__num_downloads'] =layer.num_downloads
-            data['__first_published_at'] =layer.first_published_at.strftime('%Y-%m-%d')
-            data['__is_public'] = True if layer.public_access is not None else False
-
-            xml_data.append(data)
-
-        # TEST IF SEARCH TEXT IN FILE (IN ORDER OF PRIORITY)
-        text_found, backup_created = False, False
-        for i in range(1,len(mapping)+1):
-            if file_has_text(mapping[i]['search'], mapping[i]['ignore_case'], file, mapping[i]['target_element']):
-                text_found = True
+            data.layer_id = layer_id
+            data.license_type = layer.license.type if layer.license and layer.license.type else None
+            data.license_url = layer.license.url if layer.license and layer.license.url else None
+            data.num_downloads = layer.num_downloads
+            data.first_published_at = layer.first_published_at.strftime('%Y-%m-%d')
+            data.is_public = True if layer.public_access is not None else False
+
+            context.add_summary(data)
+
+        # IF STORING, INDEX THE ORIGINAL METADATA
+        if context.metadata_store is not None:
+            with log.stage(logger, layer_id, 'store'):
+                version = getattr(layer, 'version', None)
+                context.metadata_store.add_document(layer_id, file, data, getattr(version, 'id', None),
+                                                    layer.type)
+
+        return layer, file
+
+    def submit_transform(self, file):
+        """
+        Submit the metadata file to the transformer. Returns
+        a future of the (edited document, applied rule ids).
+        Files of at least the streaming threshold are streamed
+        to an edited file, whose path is returned in place
+        of the edited document
+        """
+
+        threshold = self.config.streaming_threshold_mb
+        if threshold is not None and os.path.getsize(file) >= threshold * 1024 * 1024:
+            return self.transformer.submit_file(file, file + '.edited')
+        with open(file, 'rb') as f:
+            return self.transformer.submit(f.read())
+
+    def finish_layer(self, layer_id, layer, file, transform, publisher, context):
+        """
+        Write the transformed metadata and back up the original
+        then post the edited metadata to the layer's draft. If
+        transform is None the file is transformed here
+        """
+
+        config = self.config
+
+        # APPLY TEXT MAPPINGS (IN ORDER OF PRIORITY)
+        with log.stage(logger, layer_id, 'update_metadata') as stage:
+            if transform is None:
+                transform = self.submit_transform(file)
+            try:
+                result = transform.result()
+            except RuleTimeout as e:
+                # Reported against the layer rather than stopping the run
+                stage['outcome'] = 'timeout'
+                context.add_error(layer_id, 'update_metadata', str(e))
+                logger.critical('Dataset {0}: {1}. THIS LAYER HAS NOT BEEN EDITED'.format(layer_id, e))
+                return
+            edited, applied = result[:2]
+            if edited is None:
+                stage['outcome'] = 'unchanged'
+            else:
                 # Only creating a backup if the original is edited 
-                if not backup_created:
-                    create_backup(file, config.test_overwrite)
-                    backup_created = True
-                update_metadata(file, mapping[i])
+                create_backup(file, config.test_overwrite)
+                if isinstance(edited, bytes):
+                    with open(file, 'wb') as f:
+                        f.write(edited)
+                else:
+                    os.replace(edited, file)
 
-        if not text_found:
+        if edited is None:
+            context.record_outcome(layer_id, run_context.UNCHANGED)
             logger.info('Dataset {0}: Skipping, no changes to be made'. format(layer_id))
-            continue
-
+            return
 
-            
+        # VALIDATE BEFORE ANY DRAFT IS CREATED
+        if self.validator is not None:
+            with log.stage(logger, layer_id, 'validate') as stage:
+                errors = self.transformer.validate(file)
+                if errors:
+                    stage['outcome'] = 'invalid'
+            if errors:
+                context.add_error(layer_id, 'validate', '; '.join(errors), run_context.INVALID)
+                logger.critical('Dataset {0}: edited metadata is not valid and has not been '
+                                'uploaded: {1}'.format(layer_id, '; '.join(errors)))
+                return
 
         if config.test_dry_run:
             # i.e Do not update data service metadata
-            continue
-
-        if set_metadata(layer, file, publisher):
-            layers_edited_count +=1
-    
-    # SUMMARISE WRITE METADATA TO XML 
-    if config.summarise:
-        workbook_file = os.path.join(config.destination_dir, 'metadata_summary.xlsx')
-        write_to_excel(xml_data, workbook_file)
+            context.record_outcome(layer_id, run_context.DRY_RUN)
+            self.report_changes(layer_id, result, context)
+            return
 
+        with log.stage(logger, layer_id, 'set_metadata') as stage:
+            if set_metadata(layer, file, publisher, context):
+                context.add_edited(layer_id)
+                self.report_changes(layer_id, result, context)
+            else:
+                stage['outcome'] = 'failed'
+                context.record_outcome(layer_id, run_context.FAILED, 'set_metadata')
+
+    def report_changes(self, layer_id, result, context):
+        """
+        Add the changes the transform made to the diff report. Only
+        called once the edit is posted (or would be in a dry run), so
+        layers that fail validation or upload are not reported
+        """
+
+        if context.diff_report is not None:
+            context.diff_report.add(layer_id, result[2])
+
+    def open_summaries(self):
+        """
+        Return writers for the metadata summary and missing
+        metadata workbooks, which rows are streamed to. If
+        analytics are configured the summaries are also
+        written as columns for the analytics report
+        """
+
+        writers = []
+        if self.config.summary_excel:
+            workbook_file = os.path.join(self.config.destination_dir, 'metadata_summary.xlsx')
+            writers.append(SummaryWriter(workbook_file))
+        if self.config.summary_analytics:
+            from .analytics import ColumnStore, SUMMARY_COLUMNS_DIR
+
+            writers.append(ColumnStore(os.path.join(self.config.destination_dir, SUMMARY_COLUMNS_DIR)))
+        summary_writer = WriterGroup(*writers)
         # Those entries with no metadata associated
-        missing_metadata_file =os.path.join(config.destination_dir, 'layers_missing_metadata.xlsx')
-        record_missing_metadata(missing_metadata, missing_metadata_file)
-        
- 
-    # PUBLISH
-    if layers_edited_count > 0 and not config.test_dry_run:
+        missing_metadata_file =os.path.join(self.config.destination_dir, 'layers_missing_metadata.xlsx')
+        return summary_writer, MissingMetadataWriter(missing_metadata_file)
+
+    def open_outputs(self):
+        """
+        Return the RunOutputs (summary writers, if summarising, diff
+        report and metadata store, if configured, and the output
+        index) for one or more runs
+        """
+
+        os.makedirs(self.config.destination_dir, exist_ok=True)
+        sinks = self.open_summaries() if self.config.summarise else ()
+        return RunOutputs(*sinks, diff_report=self.open_diff_report(), metadata_store=self.open_store(),
+                          output_index=self.open_output_index())
+
+    def open_store(self):
+        """
+        Return the metadata store with a run started,
+        or None if no store is configured
+        """
+
+        if not self.config.store_path:
+            return None
+        from .store import MetadataStore
+
+        store = MetadataStore(self.config.store_path)
+        store.start_run(self.config.store_label)
+        return store
+
+    def open_output_index(self):
+        """
+        Return the index of the documents written, from which
+        the output manifest is written at the end of the run
+        """
+
+        from .layout import OutputIndex
+
+        return OutputIndex(self.config.destination_dir, self.config.layout)
+
+    def open_publish_tracker(self):
+        """
+        Return the tracker of the run's publish groups,
+        or None if publishes are not tracked
+        """
+
+        if not self.config.track_publishes or self.config.test_dry_run:
+            return None
+        from .publish_tracker import PublishTracker
+
+        return PublishTracker(self.client, self.config.network_workers,
+                              listeners=self.publish_listeners)
+
+    def wait_for_publishes(self, context):
+        """
+        Wait, for at most the configured timeout, until the run's
+        publish groups have finished then stop tracking them
+        """
+
+        tracker = context.publish_tracker
+        if tracker is None:
+            return
+        if not tracker.wait(self.config.publish_wait_timeout):
+            logger.warning('Publishing not finished after {0}s, no longer '
+                           'tracked'.format(self.config.publish_wait_timeout))
+        tracker.close()
+        logger.info('Publishing: {0}'.format(tracker.stats()))
+
+    def open_diff_report(self):
+        """
+        Return the report of the changes made to each layer,
+        or None if no report is configured
+        """
+
+        if not self.config.diff_report:
+            return None
+        from .diff_report import DiffReport
+
+        return DiffReport(self.config.destination_dir, 'dry run' if self.config.test_dry_run else None)
+
+    def write_summaries(self, context):
+        """
+        Save the metadata summary and missing metadata workbooks
+        and the summary columns
+        """
+
+        context.xml_data.close()
+        context.missing_metadata.close()
+
+    def publish(self, publisher, context):
+        """
+        Create the publish group for all edited drafts
+        """
+
+        import koordinates
+
         try:
-            r = client.publishing.create(publisher)
-            logger.info('{0} layer(s) processed | {1} layer(s) edited'. format(layer_count, 
-                                                                               layers_edited_count))
+            r = self.client.publishing.create(publisher)
+            context.add_publish(getattr(r, 'id', None))
+            if context.publish_tracker is not None:
+                context.publish_tracker.track(r, context)
+            logger.info('{0} layer(s) processed | {1} layer(s) edited'. format(context.layer_count, 
+                                                                               context.layers_edited_count))
         except koordinates.exceptions.ServerError as e:
             logger.critical('Publishing failed with fail with {0}'.format(str(e)))
-            ERRORS += 1 
+            self.publish_failed(publisher, context, str(e))
         except koordinates.exceptions.BadRequest as e:
             logger.critical('Publishing failed with fail with {0}'.format(str(e)))
-            ERRORS += 1
+            self.publish_failed(publisher, context, str(e))
+
+    def publish_failed(self, publisher, context, message):
+        """
+        Record the failed publish against each layer in the group
+        """
+
+        from .publish_tracker import ITEM_URL
+
+        matches = [ITEM_URL.search(str(item)) for item in getattr(publisher, 'items', None) or []]
+        layer_ids = [int(match.group(1)) for match in matches if match]
+        for layer_id in layer_ids:
+            context.add_error(layer_id, 'publish', message)
+        if not layer_ids:
+            context.add_error(None, 'publish', message)
+
+def main():
+    """
+    Script for updating LDS Metadata. Written for the purpose
+    of replacing CC3 text with CC4 text but with scope for 
+    extending to other metadata updating tasks     
+    """
+
+    cli_parser = parse_args(sys.argv[1:])
+    config_file = cli_parser.config_file
+
+    #CHECK PYTHON VERSION
+    if sys.version_info<(3,3):
+        raise SystemExit('Error, Python interpreter must be 3.3 or higher')
+
+    # READ CONFIG IN
+    config = ConfigReader(config_file)
+    if cli_parser.shard:
+        from .sharding import shard_dir
+
+        if cli_parser.merge_shards:
+            raise SystemExit('Error, --shard and --merge-shards can not be used together')
+        config.shard = cli_parser.shard
+        config.destination_dir = shard_dir(config.destination_dir, config.shard)
+
+    # CONFIG LOGGING
+    log.conf_logging('root', structured=config.log_format == 'json',
+                     asynchronous=config.log_queue)
+
+    # PROFILE IF REQUESTED
+    profiler = contextlib.ExitStack()
+    if cli_parser.profile:
+        from .profiling import Profiler
+
+        profiler.enter_context(Profiler(cli_parser.profile, config.destination_dir))
+
+    with profiler, Runner(config) as runner:
+        if cli_parser.service:
+            from . import service
+
+            results = service.run_service(runner, cli_parser.service,
+                                          config.service_batch_size, config.service_batch_wait)
+            errors = sum(result.errors for result in results)
+        elif cli_parser.merge_shards:
+            from .sharding import merge_shards
+
+            errors = merge_shards(runner).errors
+        else:
+            errors = runner.run().errors
 
-    if ERRORS > 0:
+    if errors > 0:
         # print as well as log out
-        print ('Process failed with {0} error(s). Please see log for critical messages'.format(ERRORS))
-        logger.critical('Process failed with {0} error(s)'.format(ERRORS))
+        print ('Process failed with {0} error(s). Please see log for critical messages'.format(errors))
+        logger.critical('Process failed with {0} error(s)'.format(errors))
     else: 
         print('COMPLETE. No errors')
         logger.info('COMPLETE. No errors')
@@ -0,0 +1,237 @@
+################################################################################
+#
+# Copyright 2018 Crown copyright (c)
+# Land Information New Zealand and the New Zealand Government.
+# All rights reserved
+#
+# This program is released under the terms of the new BSD license. See the
+# LICENSE file for more information.
+#
+################################################################################
+
+import gc
+import logging
+import os
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Put on a stage's queue, once per worker, when there is no more input
+END_OF_INPUT = object()
+
+# Seconds between checks of the RSS while waiting for it to fall
+RSS_POLL_INTERVAL = 0.1
+
+
+def current_rss():
+    """
+    Return the resident set size of this process in bytes,
+    or None where it can not be read (i.e. not Linux)
+    """
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class PublishBatcher():
+    """
+    Collects edited drafts into publish groups. With a batch_size
+    each group is published as soon as it is full, so the publish
+    item list does not grow with the number of layers. Otherwise
+    all drafts are published as one group on flush. Can be used
+    where a koordinates Publish is expected by add_to_pub_group
+    """
+
+    def __init__(self, publish, batch_size=0):
+        import koordinates
+
+        self._new_publish = koordinates.Publish
+        self._publish = publish
+        self.batch_size = batch_size
+        self.group = self._new_publish()
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def add_layer_item(self, draft):
+        self._add(self.group.add_layer_item, draft)
+
+    def add_table_item(self, draft):
+        self._add(self.group.add_table_item, draft)
+
+    def _add(self, add_item, draft):
+        group = None
+        with self._lock:
+            add_item(draft)
+            self.count += 1
+            if self.batch_size and self.count >= self.batch_size:
+                group = self._take_group()
+        # Published outside the lock, so other threads
+        # can add drafts to the next group meanwhile
+        if group is not None:
+            self._publish(group)
+
+    def _take_group(self):
+        group, self.group, self.count = self.group, self._new_publish(), 0
+        return group
+
+    def flush(self):
+        """
+        Publish any drafts not yet published
+        """
+
+        with self._lock:
+            group = self._take_group() if self.count else None
+        if group is not None:
+            self._publish(group)
+
+
+class Pipeline():
+    """
+    Process layers in stages connected by bounded queues
+
+        enumerate -> download -> transform -> upload -> publish
+
+    Layer ids are enumerated on the calling thread. Layers and their
+    metadata are downloaded on `workers` threads, which submit the
+    documents to the runner's transformer. The edited documents are
+    written and posted on another `workers` threads which add the
+    drafts to the publisher. A full queue blocks the stage feeding
+    it, so no more than queue_size layers wait between stages however
+    many layers there are. If max_rss (bytes) is set no more layers
+    are started while the process RSS is above it
+    """
+
+    def __init__(self, runner, publisher, context, workers=1, queue_size=8, max_rss=None):
+        self.runner = runner
+        self.publisher = publisher
+        self.context = context
+        self.workers = workers
+        self.max_rss = max_rss
+        self.download_queue = queue.Queue(maxsize=queue_size)
+        self.upload_queue = queue.Queue(maxsize=queue_size)
+        self.in_flight = 0
+        self.error = None
+        self._rss_warned = False
+        self._in_flight_changed = threading.Condition()
+        self._failed = threading.Event()
+
+    def run(self, layer_ids):
+        """
+        Process the layers. Returns once every layer has been
+        uploaded. An exception raised in any stage stops the
+        enumeration and is raised here once the stages have drained
+        """
+
+        downloaders = self.start_workers(self.download, 'download')
+        uploaders = self.start_workers(self.upload, 'upload')
+
+        try:
+            for layer_id in layer_ids:
+                if self._failed.is_set():
+                    break
+                self.wait_for_memory()
+                with self._in_flight_changed:
+                    self.in_flight += 1
+                self.download_queue.put(layer_id)
+        except BaseException:
+            # The layer ids failed. Stop the stages, which drain their
+            # queues, and raise once they have, not while they still
+            # write to the run's outputs
+            self._failed.set()
+            raise
+        finally:
+            for _ in downloaders:
+                self.download_queue.put(END_OF_INPUT)
+            for thread in downloaders:
+                thread.join()
+            for _ in uploaders:
+                self.upload_queue.put(END_OF_INPUT)
+            for thread in uploaders:
+                thread.join()
+
+        if self.error:
+            raise self.error
+
+    def start_workers(self, target, name):
+        threads = [threading.Thread(target=target, name='{0}-{1}'.format(name, i), daemon=True)
+                   for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def wait_for_memory(self):
+        """
+        Block while the RSS is over the ceiling and layers are still
+        in flight. If nothing is in flight the memory can not be freed
+        by waiting, so a warning is logged (once) and processing continues
+        """
+
+        if not self.max_rss:
+            return
+        rss = current_rss()
+        if rss is None or rss <= self.max_rss:
+            return
+        with self._in_flight_changed:
+            while self.in_flight and not self._failed.is_set():
+                self._in_flight_changed.wait(RSS_POLL_INTERVAL)
+                rss = current_rss()
+                if rss <= self.max_rss:
+                    return
+        gc.collect()
+        rss = current_rss()
+        if rss > self.max_rss and not self._rss_warned:
+            self._rss_warned = True
+            logger.warning('RSS of {0:.0f} MB exceeds the {1:.0f} MB ceiling with no layers in ' \
+                           'flight'.format(rss / 1048576.0, self.max_rss / 1048576.0))
+
+    def done(self):
+        with self._in_flight_changed:
+            self.in_flight -= 1
+            self._in_flight_changed.notify_all()
+
+    def fail(self, error):
+        if not self._failed.is_set():
+            self.error = error
+            self._failed.set()
+        logger.critical('Pipeline stopped: {0}'.format(error))
+
+    def download(self):
+        while True:
+            layer_id = self.download_queue.get()
+            if layer_id is END_OF_INPUT:
+                return
+            if self._failed.is_set():
+                # Drain the queue so enumeration is not blocked
+                self.done()
+                continue
+            try:
+                fetched = self.runner.fetch_layer(layer_id, self.context)
+                if not fetched:
+                    self.done()
+                    continue
+                layer, file = fetched
+                transform = self.runner.submit_transform(file)
+            except Exception as e:
+                self.done()
+                self.fail(e)
+                continue
+            self.upload_queue.put((layer_id, layer, file, transform))
+
+    def upload(self):
+        while True:
+            item = self.upload_queue.get()
+            if item is END_OF_INPUT:
+                return
+            try:
+                if not self._failed.is_set():
+                    layer_id, layer, file, transform = item
+                    self.runner.finish_layer(layer_id, layer, file, transform,
+                                             self.publisher, self.context)
+            except Exception as e:
+                self.fail(e)
+            finally:
+                self.done()
@@ -0,0 +1,116 @@
+################################################################################
+#
+# Copyright 2018 Crown copyright (c)
+# Land Information New Zealand and the New Zealand Government.
+# All rights reserved
+#
+# This program is released under the terms of the new BSD license. See the
+# LICENSE file for more information.
+#
+################################################################################
+
+"""
+Ordering of the layers of a run by importance, so the most important
+layers are processed (and their edits published) first. The ordering
+uses the fields of each layer in the Data Service catalog, which are
+recorded as the catalog is listed or layers are fetched and cached in
+the destination dir, so later runs over selected layers are ordered
+without further requests. Layers are ordered within windows of ids,
+so the ids of a run are never all held at once
+"""
+
+import itertools
+import json
+import os
+
+CATALOG_CACHE_FILE = 'catalog_priority.json'
+
+# Keys layers can be ordered by, each putting the most important first
+KEYS = ('num_downloads', 'public_access', 'published_at', 'license:<type>')
+
+
+def catalog_entry(item):
+    """
+    Return the fields of the catalog item (a koordinates Layer)
+    the layers are ordered by
+    """
+
+    license = getattr(item, 'license', None)
+    published_at = getattr(item, 'published_at', None)
+    return {'num_downloads': getattr(item, 'num_downloads', None),
+            'public_access': getattr(item, 'public_access', None),
+            'license_type': getattr(license, 'type', None),
+            'published_at': published_at.timestamp() if published_at else None}
+
+
+def sort_key(key):
+    """
+    Return a function of a catalog entry for the priority key that
+    sorts more important layers first. Raises SystemExit for an
+    unknown key
+    """
+
+    if key == 'num_downloads':
+        return lambda entry: -(entry.get('num_downloads') or 0)
+    if key == 'public_access':
+        return lambda entry: 0 if entry.get('public_access') else 1
+    if key == 'published_at':
+        # Most recently published first
+        return lambda entry: -(entry.get('published_at') or 0)
+    if key.startswith('license:') and key[len('license:'):]:
+        license_type = key[len('license:'):]
+        return lambda entry: 0 if entry.get('license_type') == license_type else 1
+    raise SystemExit('CONFIG ERROR: "Priority" keys must be one of {0}. Got:"{1}" '
+                     'instead'.format(', '.join(KEYS), key))
+
+
+class CatalogCache():
+    """
+    The catalog entries of the layers, by layer id,
+    kept in a JSON file between runs
+    """
+
+    def __init__(self, file):
+        self.file = file
+        try:
+            with open(file) as f:
+                self.entries = {int(layer_id): entry for layer_id, entry in json.load(f).items()}
+        except FileNotFoundError:
+            self.entries = {}
+
+    def update(self, entries):
+        self.entries.update(entries)
+
+    def save(self):
+        with open(self.file + '.tmp', 'w') as f:
+            json.dump({str(layer_id): entry for layer_id, entry in sorted(self.entries.items())},
+                      f, separators=(',', ':'))
+        os.replace(self.file + '.tmp', self.file)
+
+
+def windows(layer_ids, size):
+    """
+    Return a generator of lists of up to size of the layer ids
+    """
+
+    layer_ids = iter(layer_ids)
+    while True:
+        window = list(itertools.islice(layer_ids, size))
+        if not window:
+            return
+        yield window
+
+
+def order_layers(layer_ids, keys, entries):
+    """
+    Return the layer ids ordered by the priority keys, most
+    important first. The first key takes precedence and ties keep
+    their given order. Layers with no catalog entry come last
+    """
+
+    functions = [sort_key(key) for key in keys]
+    known, unknown = [], []
+    for layer_id in layer_ids:
+        (known if int(layer_id) in entries else unknown).append(layer_id)
+    known.sort(key=lambda layer_id: tuple(function(entries[int(layer_id)]) for function in functions))
+    return known + unknown
@@ -0,0 +1,205 @@
+################################################################################
+#
+# Copyright 2018 Crown copyright (c)
+# Land Information New Zealand and the New Zealand Government.
+# All rights reserved
+#
+# This program is released under the terms of the new BSD license. See the
+# LICENSE file for more information.
+#
+################################################################################
+
+import contextlib
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+from . import log
+
+logger = logging.getLogger(__name__)
+
+PROFILE_MODES = ('cpu', 'memory', 'both')
+
+# Number of functions / allocation sites written to the text reports
+TOP_COUNT = 50
+
+
+class StackSampler():
+    """
+    Sample the Python stacks of all threads at an interval and count
+    them as collapsed stacks ("frame;frame;frame count"), the input
+    format of flamegraph.pl and speedscope. Each stack is rooted at
+    the pipeline stage its thread was in when sampled
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stacks = {}
+        self.thread_stages = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.sample, name='StackSampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def sample(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append('{0} ({1}:{2})'.format(code.co_name,
+                                                         os.path.basename(code.co_filename),
+                                                         code.co_firstlineno))
+                    frame = frame.f_back
+                frames.append('stage:{0}'.format(self.thread_stages.get(thread_id, 'none')))
+                stack = ';'.join(reversed(frames))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def write(self, file):
+        with open(file, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('{0} {1}\n'.format(stack, count))
+
+
+class Profiler():
+    """
+    Profile a run with cProfile (cpu), tracemalloc (memory) or both,
+    attributing time and memory to the pipeline stages via the stage
+    observer hook. Results are written to the output directory on exit:
+
+        profile_cpu.pstats      cProfile stats of the calling thread
+        profile_cpu.txt         top functions by cumulative time
+        profile_cpu.collapsed   sampled stacks of all threads, for flame graphs
+        profile_memory.txt      top allocation sites and peak traced memory
+        profile_memory.snapshot tracemalloc snapshot (tracemalloc.Snapshot.load)
+        profile_stages.json     per stage count, wall time, cpu time and memory
+
+    Work done in transform worker processes is not profiled
+    """
+
+    def __init__(self, mode, output_dir, sample_interval=0.01, traceback_limit=10):
+        if mode not in PROFILE_MODES:
+            raise ValueError('Profile mode must be one of {0}'.format(', '.join(PROFILE_MODES)))
+        self.cpu = mode in ('cpu', 'both')
+        self.memory = mode in ('memory', 'both')
+        self.output_dir = output_dir
+        self.traceback_limit = traceback_limit
+        self.stages = {}
+        self.profile = cProfile.Profile() if self.cpu else None
+        self.sampler = StackSampler(sample_interval) if self.cpu else None
+        self._lock = threading.Lock()
+        self._started_tracemalloc = False
+
+    @contextlib.contextmanager
+    def observe_stage(self, layer_id, name, result):
+        """
+        Stage observer. Records the stage's wall and thread cpu time
+        and the change in traced memory while it ran. Memory is
+        traced process wide so is approximate when stages overlap
+        """
+
+        thread_id = threading.get_ident()
+        if self.sampler:
+            previous_stage = self.sampler.thread_stages.get(thread_id)
+            self.sampler.thread_stages[thread_id] = name
+        memory = tracemalloc.get_traced_memory()[0] if self.memory else 0
+        cpu = time.thread_time()
+        wall = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.thread_time() - cpu
+            memory = tracemalloc.get_traced_memory()[0] - memory if self.memory else 0
+            if self.sampler and previous_stage:
+                self.sampler.thread_stages[thread_id] = previous_stage
+            elif self.sampler:
+                self.sampler.thread_stages.pop(thread_id, None)
+            with self._lock:
+                stats = self.stages.setdefault(name, {'count': 0, 'wall_time': 0.0, 'cpu_time': 0.0,
+                                                      'memory_delta': 0, 'max_memory_delta': 0,
+                                                      'outcomes': {}})
+                stats['count'] += 1
+                stats['wall_time'] += wall
+                stats['cpu_time'] += cpu
+                stats['memory_delta'] += memory
+                stats['max_memory_delta'] = max(stats['max_memory_delta'], memory)
+                outcome = result['outcome']
+                stats['outcomes'][outcome] = stats['outcomes'].get(outcome, 0) + 1
+
+    def start(self):
+        log.add_stage_observer(self.observe_stage)
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start(self.traceback_limit)
+            self._started_tracemalloc = True
+        if self.cpu:
+            self.sampler.start()
+            self.profile.enable()
+
+    def stop(self):
+        """
+        Stop profiling and write the results
+        """
+
+        if self.cpu:
+            self.profile.disable()
+            self.sampler.stop()
+        log.remove_stage_observer(self.observe_stage)
+        snapshot, peak_memory = None, None
+        if self.memory:
+            snapshot = tracemalloc.take_snapshot()
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+        self.write(snapshot, peak_memory)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def output_file(self, name):
+        return os.path.join(self.output_dir, name)
+
+    def write(self, snapshot=None, peak_memory=None):
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        if self.cpu:
+            self.profile.dump_stats(self.output_file('profile_cpu.pstats'))
+            report = io.StringIO()
+            pstats.Stats(self.profile, stream=report).sort_stats('cumulative').print_stats(TOP_COUNT)
+            with open(self.output_file('profile_cpu.txt'), 'w') as f:
+                f.write(report.getvalue())
+            self.sampler.write(self.output_file('profile_cpu.collapsed'))
+
+        if snapshot is not None:
+            snapshot.dump(self.output_file('profile_memory.snapshot'))
+            with open(self.output_file('profile_memory.txt'), 'w') as f:
+                f.write('Peak traced memory: {0:.1f} KiB\n\n'.format(peak_memory / 1024.0))
+                f.write('Top {0} allocation sites by size:\n'.format(TOP_COUNT))
+                for stat in snapshot.statistics('lineno')[:TOP_COUNT]:
+                    f.write('{0}\n'.format(stat))
+
+        with open(self.output_file('profile_stages.json'), 'w') as f:
+            json.dump({'peak_memory': peak_memory, 'stages': self.stages}, f, indent=2, sort_keys=True)
+
+        logger.info('Profile written to {0}'.format(self.output_dir))
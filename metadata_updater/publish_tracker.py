@@ -0,0 +1,231 @@
+################################################################################
+#
+# Copyright 2018 Crown copyright (c)
+# Land Information New Zealand and the New Zealand Government.
+# All rights reserved
+#
+# This program is released under the terms of the new BSD license. See the
+# LICENSE file for more information.
+#
+################################################################################
+
+"""
+Tracking of the publish groups created in a run until their layers
+are live. Creating a publish group only schedules it on the Data
+Service, where a large group can take a long time to complete
+"""
+
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import re
+import threading
+import time
+
+from . import run_context
+
+logger = logging.getLogger(__name__)
+
+# Seconds before a publish group is first polled, doubled
+# after each poll it is still publishing, up to the max
+POLL_INTERVAL = 1.0
+MAX_POLL_INTERVAL = 30.0
+
+# Publish group state while its items are being published
+PUBLISHING = 'publishing'
+
+ITEM_URL = re.compile(r'/(?:layers|tables)/(\d+)/versions/(\d+)/')
+
+
+class PublishTracker():
+    """
+    Polls publish groups, on a pool of worker threads, until they
+    are no longer publishing. Each group is polled with exponential
+    backoff from interval to max_interval. Once a group has finished
+    each of its items is checked to be the published version of its
+    layer, the layer's outcome is set to published or failed and the
+    time from the group being created to it finishing (time to live)
+    is logged and passed to each listener as an item dict
+    """
+
+    def __init__(self, client, workers=4, interval=None, max_interval=None, listeners=()):
+        self.client = client
+        self.interval = interval or POLL_INTERVAL
+        self.max_interval = max_interval or MAX_POLL_INTERVAL
+        self.listeners = list(listeners)
+        self.groups = {}
+        self.items = []
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            workers, thread_name_prefix='publish-tracker')
+        self._condition = threading.Condition()
+        self._polls = []
+        self._sequence = itertools.count()
+        # Groups not yet finished and item checks in flight
+        self._pending = 0
+        self._scheduler = None
+        self._closed = False
+
+    def track(self, publish, context=None):
+        """
+        Track the publish group (as returned by client.publishing.create),
+        recording the outcome of its layers in the RunContext if given
+        """
+
+        group = {'id': publish.id,
+                 'url': publish.url,
+                 'items': list(getattr(publish, 'items', None) or []),
+                 'state': getattr(publish, 'state', None) or PUBLISHING,
+                 'created': time.monotonic(),
+                 'interval': self.interval,
+                 'polls': 0,
+                 'context': context}
+        with self._condition:
+            self.groups[group['id']] = group
+            self._pending += 1
+            if group['state'] != PUBLISHING:
+                self._finish(group)
+            else:
+                self._schedule(group)
+            if self._scheduler is None:
+                self._scheduler = threading.Thread(target=self._run, name='publish-scheduler',
+                                                   daemon=True)
+                self._scheduler.start()
+
+    def _schedule(self, group):
+        heapq.heappush(self._polls, (time.monotonic() + group['interval'],
+                                     next(self._sequence), group['id']))
+        self._condition.notify_all()
+
+    def _run(self):
+        """
+        Submit each group's poll to the workers when it is due
+        """
+
+        with self._condition:
+            while not self._closed:
+                if not self._polls:
+                    self._condition.wait()
+                    continue
+                due, _, group_id = self._polls[0]
+                delay = due - time.monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                heapq.heappop(self._polls)
+                self._executor.submit(self._poll, self.groups[group_id])
+
+    def _poll(self, group):
+        import koordinates
+        import requests
+
+        try:
+            state = self.client.request('GET', group['url']).json().get('state')
+        except (koordinates.exceptions.KoordinatesException, requests.RequestException, ValueError) as e:
+            logger.warning('Polling publish group {0} failed with {1}'.format(group['id'], e))
+            state = PUBLISHING
+        with self._condition:
+            group['polls'] += 1
+            if state == PUBLISHING:
+                group['interval'] = min(group['interval'] * 2, self.max_interval)
+                self._schedule(group)
+            else:
+                group['state'] = state
+                self._finish(group)
+
+    def _finish(self, group):
+        """
+        Check each of the finished group's items. Called
+        under the condition's lock
+        """
+
+        if self._closed:
+            return
+        group['time_to_live'] = round(time.monotonic() - group['created'], 3)
+        logger.info('Publish group {0} {1} after {2:.1f}s'.format(group['id'], group['state'],
+                                                                  group['time_to_live']))
+        self._pending += len(group['items']) - 1
+        for url in group['items']:
+            self._executor.submit(self._check_item, group, url)
+        self._condition.notify_all()
+
+    def _check_item(self, group, url):
+        import koordinates
+        import requests
+
+        match = ITEM_URL.search(url)
+        item = {'publish_id': group['id'],
+                'layer_id': int(match.group(1)) if match else None,
+                'version_id': int(match.group(2)) if match else None,
+                'time_to_live': group['time_to_live'],
+                'outcome': run_context.FAILED,
+                'message': None}
+        try:
+            version = self.client.request('GET', url).json()
+            if version.get('this_version') and version.get('this_version') == version.get('published_version'):
+                item['outcome'] = run_context.PUBLISHED
+            else:
+                item['message'] = 'not published, publish group {0}'.format(group['state'])
+        except (koordinates.exceptions.KoordinatesException, requests.RequestException, ValueError) as e:
+            item['message'] = 'publish could not be checked: {0}'.format(e)
+
+        context = group['context']
+        if item['outcome'] == run_context.PUBLISHED:
+            if context is not None:
+                context.record_outcome(item['layer_id'], run_context.PUBLISHED, 'publish')
+            logger.info('Dataset {0}: live after {1:.1f}s'.format(item['layer_id'], item['time_to_live']),
+                        extra={'layer_id': item['layer_id'], 'stage': 'publish',
+                               'duration': item['time_to_live'], 'outcome': item['outcome']})
+        else:
+            if context is not None:
+                context.add_error(item['layer_id'], 'publish', item['message'])
+            logger.critical('Dataset {0}: {1}'.format(item['layer_id'], item['message']),
+                            extra={'layer_id': item['layer_id'], 'stage': 'publish',
+                                   'duration': item['time_to_live'], 'outcome': item['outcome']})
+        for listener in self.listeners:
+            try:
+                listener(item)
+            except Exception:
+                logger.exception('Publish listener failed for {0}'.format(item['layer_id']))
+
+        with self._condition:
+            self.items.append(item)
+            self._pending -= 1
+            self._condition.notify_all()
+
+    def wait(self, timeout=None):
+        """
+        Block until every tracked group has finished and its items
+        are checked, or timeout seconds. Returns True if all finished
+        """
+
+        with self._condition:
+            return self._condition.wait_for(lambda: self._pending == 0, timeout)
+
+    def stats(self):
+        """
+        Return counts of the groups and items and the
+        mean and max time to live of the published items
+        """
+
+        with self._condition:
+            live = [item['time_to_live'] for item in self.items
+                    if item['outcome'] == run_context.PUBLISHED]
+            return {'groups': len(self.groups),
+                    'publishing': sum(1 for group in self.groups.values()
+                                      if group['state'] == PUBLISHING),
+                    'published': len(live),
+                    'failed': len(self.items) - len(live),
+                    'polls': sum(group['polls'] for group in self.groups.values()),
+                    'mean_time_to_live': round(sum(live) / len(live), 3) if live else None,
+                    'max_time_to_live': max(live) if live else None}
+
+    def close(self):
+        """
+        Stop polling. Groups still publishing are no longer tracked
+        """
+
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,479 @@
+################################################################################
+#
+# Copyright 2018 Crown copyright (c)
+# Land Information New Zealand and the New Zealand Government.
+# All rights reserved
+#
+# This program is released under the terms of the new BSD license. See the
+# LICENSE file for more information.
+#
+################################################################################
+
+import collections
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+
+class UnsafePattern(ValueError):
+    """
+    A search pattern that can take exponential time to fail to match
+    """
+
+
+class RuleTimeout(Exception):
+    """
+    A rule's search or replacement ran for longer than its timeout
+    """
+
+    def __init__(self, rule_id, timeout):
+        super(RuleTimeout, self).__init__(rule_id, timeout)
+        self.rule_id = rule_id
+        self.timeout = timeout
+
+    def __str__(self):
+        return 'Mapping {0} search timed out after {1}s'.format(self.rule_id, self.timeout)
+
+
+# A construct that can make a search take exponential time to fail
+# to match. definite is False for constructs that only may, e.g.
+# alternatives that could match the same text within a repeat
+Risk = collections.namedtuple('Risk', 'description definite')
+
+# Characters probed to compare the characters parts of a pattern match
+PROBES = ''.join(map(chr, range(256))) + '\u0101\u0663\u2003\u4e2d'
+
+CATEGORIES = {'CATEGORY_DIGIT': r'\d', 'CATEGORY_NOT_DIGIT': r'\D',
+              'CATEGORY_SPACE': r'\s', 'CATEGORY_NOT_SPACE': r'\S',
+              'CATEGORY_WORD': r'\w', 'CATEGORY_NOT_WORD': r'\W'}
+
+
+def _repeats(sre_parse):
+    return (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, 'POSSESSIVE_REPEAT', None))
+
+
+def _zero_width(sre_parse):
+    return (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT)
+
+
+def _matches(sre_parse, op, av, char):
+    """
+    Test if the single character item matches char. Items
+    that are not understood are assumed to match anything
+    """
+
+    if op == sre_parse.LITERAL:
+        return ord(char) == av
+    if op == sre_parse.NOT_LITERAL:
+        return ord(char) != av
+    if op == sre_parse.RANGE:
+        return av[0] <= ord(char) <= av[1]
+    if op == sre_parse.CATEGORY and str(av) in CATEGORIES:
+        return re.match(CATEGORIES[str(av)], char) is not None
+    if op == sre_parse.IN:
+        negate = bool(av) and av[0][0] == sre_parse.NEGATE
+        return any(_matches(sre_parse, item_op, item_av, char)
+                   for item_op, item_av in av[negate:]) != negate
+    return True
+
+
+def _charset(sre_parse, op, av):
+    return {char for char in PROBES if _matches(sre_parse, op, av, char)}
+
+
+def _min_width(sre_parse, items):
+    width = 0
+    for op, av in items:
+        if op in _repeats(sre_parse):
+            width += av[0] * _min_width(sre_parse, av[2])
+        elif op == sre_parse.SUBPATTERN:
+            width += _min_width(sre_parse, av[-1])
+        elif op == getattr(sre_parse, 'ATOMIC_GROUP', None):
+            width += _min_width(sre_parse, av)
+        elif op == sre_parse.BRANCH:
+            width += min(_min_width(sre_parse, alternative) for alternative in av[1])
+        elif op in (sre_parse.LITERAL, sre_parse.NOT_LITERAL, sre_parse.ANY, sre_parse.IN):
+            width += 1
+    return width
+
+
+def _chars(sre_parse, items, first=False):
+    """
+    Return the probe characters the parsed items can match,
+    or if first only those they can start with
+    """
+
+    chars = set()
+    for op, av in items:
+        if op in _repeats(sre_parse):
+            chars |= _chars(sre_parse, av[2], first)
+        elif op == sre_parse.SUBPATTERN:
+            chars |= _chars(sre_parse, av[-1], first)
+        elif op == getattr(sre_parse, 'ATOMIC_GROUP', None):
+            chars |= _chars(sre_parse, av, first)
+        elif op == sre_parse.BRANCH:
+            for alternative in av[1]:
+                chars |= _chars(sre_parse, alternative, first)
+        elif op in _zero_width(sre_parse):
+            continue
+        elif op in (sre_parse.LITERAL, sre_parse.NOT_LITERAL, sre_parse.ANY, sre_parse.IN):
+            chars |= _charset(sre_parse, op, av)
+        else:
+            # e.g. a back reference
+            chars |= set(PROBES)
+        if first and _min_width(sre_parse, [(op, av)]):
+            break
+    return chars
+
+
+def _flatten(sre_parse, items):
+    """
+    Return the parsed items with the groups replaced by their contents
+    """
+
+    flat = []
+    for op, av in items:
+        if op == sre_parse.SUBPATTERN:
+            flat.extend(_flatten(sre_parse, av[-1]))
+        else:
+            flat.append((op, av))
+    return flat
+
+
+def _unbounded(sre_parse, items):
+    """
+    Test if the parsed items contain a backtracking unbounded repeat
+    """
+
+    for op, av in items:
+        if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            if av[1] == sre_parse.MAXREPEAT or _unbounded(sre_parse, av[2]):
+                return True
+        elif op == sre_parse.SUBPATTERN:
+            if _unbounded(sre_parse, av[-1]):
+                return True
+        elif op == sre_parse.BRANCH:
+            if any(_unbounded(sre_parse, alternative) for alternative in av[1]):
+                return True
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            if _unbounded(sre_parse, av[1]):
+                return True
+    return False
+
+
+def _nested(sre_parse, body):
+    """
+    Return the Risk of the repeats within the body of an unbounded
+    repeat, or None. A repeat within it is safe if each iteration
+    also needs a character the inner repeat can not match, e.g. the
+    comma of (?:[^,]*,)*, so the text is only split one way
+    """
+
+    sequence = _flatten(sre_parse, body)
+    for index, (op, av) in enumerate(sequence):
+        if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[1] == sre_parse.MAXREPEAT:
+            chars = _chars(sre_parse, av[2])
+            separated = any(_min_width(sre_parse, [other]) and
+                            not _chars(sre_parse, [other], first=True) & chars
+                            for other in sequence[:index] + sequence[index + 1:])
+            if not separated:
+                return Risk('a repeat within a repeat over the same characters, e.g. (a+)+', True)
+        elif _unbounded(sre_parse, [(op, av)]):
+            return Risk('a repeat within a repeat, e.g. (a|b+)+', False)
+    return None
+
+
+def _backtracking(sre_parse, items, repeated=False):
+    """
+    Return the Risk of the first construct in the parsed pattern
+    that can backtrack exponentially, or None. repeated is True
+    within the body of an unbounded repeat
+    """
+
+    for op, av in items:
+        if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            low, high, body = av
+            unbounded = high == sre_parse.MAXREPEAT
+            risk = (_nested(sre_parse, body) if unbounded else None) or \
+                _backtracking(sre_parse, body, repeated or unbounded)
+            if risk:
+                return risk
+        elif op == sre_parse.SUBPATTERN:
+            risk = _backtracking(sre_parse, av[-1], repeated)
+            if risk:
+                return risk
+        elif op == sre_parse.BRANCH:
+            alternatives = av[1]
+            if repeated and _overlapping(sre_parse, alternatives):
+                return Risk('alternatives that can match the same text within a repeat, e.g. (a|aa)+',
+                            False)
+            for alternative in alternatives:
+                risk = _backtracking(sre_parse, alternative, repeated)
+                if risk:
+                    return risk
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            risk = _backtracking(sre_parse, av[1], repeated)
+            if risk:
+                return risk
+        # Atomic groups and possessive repeats do not backtrack
+    return None
+
+
+def _overlapping(sre_parse, alternatives):
+    """
+    Test if two of the branch alternatives could match at the same
+    place. Only alternatives starting with different literal
+    characters are known not to
+    """
+
+    firsts = []
+    for alternative in alternatives:
+        alternative = list(alternative)
+        if not alternative:
+            return True
+        op, av = alternative[0]
+        if op != sre_parse.LITERAL or av in firsts:
+            return True
+        firsts.append(av)
+    return False
+
+
+def backtracking_risk(pattern):
+    """
+    Return the Risk of the construct in the regular expression
+    that can make it take exponential time to fail to match,
+    e.g. nested repeats, or None if there is none
+    """
+
+    try:
+        from re import _parser as sre_parse
+    except ImportError:
+        # Python < 3.11
+        import sre_parse
+
+    return _backtracking(sre_parse, sre_parse.parse(pattern))
+
+
+class GuardedPattern():
+    """
+    A compiled pattern whose search and sub raise RuleTimeout when a
+    match takes longer than timeout seconds. Requires the regex
+    module, a drop in replacement for re with match timeouts
+    """
+
+    __slots__ = ('pattern', 'flags', 'rule_id', 'timeout', '_compiled')
+
+    def __init__(self, pattern, flags, rule_id, timeout):
+        import regex
+
+        self.pattern = pattern
+        self.flags = flags
+        self.rule_id = rule_id
+        self.timeout = timeout
+        self._compiled = regex.compile(pattern, flags)
+
+    def search(self, string):
+        try:
+            return self._compiled.search(string, timeout=self.timeout)
+        except TimeoutError:
+            raise RuleTimeout(self.rule_id, self.timeout)
+
+    def sub(self, repl, string, count=0):
+        try:
+            return self._compiled.sub(repl, string, count, timeout=self.timeout)
+        except TimeoutError:
+            raise RuleTimeout(self.rule_id, self.timeout)
+
+    def __reduce__(self):
+        return (GuardedPattern, (self.pattern, self.flags, self.rule_id, self.timeout))
+
+
+def check_pattern(pattern, rule_id, timeout=None, strict=False):
+    """
+    Raise UnsafePattern if there is no timeout and the pattern will
+    backtrack exponentially, or with strict may. Otherwise warn of it
+    """
+
+    risk = backtracking_risk(pattern)
+    if not risk:
+        return
+    if timeout:
+        logger.warning('Mapping {0} search "{1}" has {2}. Searches are stopped after '
+                       '{3}s'.format(rule_id, pattern, risk.description, timeout))
+    elif risk.definite or strict:
+        raise UnsafePattern('Mapping {0} search "{1}" has {2}, which can take exponential '
+                            'time to fail to match'.format(rule_id, pattern, risk.description))
+    else:
+        logger.warning('Mapping {0} search "{1}" may have {2}, which can take exponential '
+                       'time to fail to match. Set "Regex_timeout_ms" to limit '
+                       'it'.format(rule_id, pattern, risk.description))
+
+
+def compile_pattern(pattern, flags, rule_id, timeout=None):
+    """
+    Compile the rule's pattern, with a match timeout if given
+    """
+
+    compiled = re.compile(pattern, flags)
+    if timeout:
+        return GuardedPattern(pattern, flags, rule_id, timeout)
+    return compiled
+
+
+class Rule():
+    """
+    A text mapping from the config with its regular
+    expressions compiled once for reuse across layers.
+    With a timeout (seconds) each search and replacement
+    raises RuleTimeout if it takes longer
+    """
+
+    __slots__ = ('rule_id', 'search', 'replace', 'ignore_case', 'target_element',
+                 'search_pattern', 'element_pattern')
+
+    def __init__(self, rule_id, search, replace, ignore_case=False, target_element=None, timeout=None,
+                 strict=False):
+        self.rule_id = rule_id
+        self.search = search
+        self.replace = replace
+        self.ignore_case = ignore_case
+        self.target_element = target_element
+
+        flags = re.IGNORECASE if ignore_case else 0
+        check_pattern(search, rule_id, timeout, strict)
+        # Used to test for text and for file wide, line by line, replacement
+        self.search_pattern = compile_pattern(search, flags, rule_id, timeout)
+        # Used for replacement within an element's text
+        self.element_pattern = compile_pattern(search, flags | re.DOTALL, rule_id, timeout)
+
+    @classmethod
+    def from_mapping(cls, mapping, rule_id=None, timeout=None, strict=False):
+        return cls(rule_id,
+                   mapping['search'],
+                   mapping['replace'],
+                   mapping.get('ignore_case', False),
+                   mapping.get('target_element'),
+                   timeout,
+                   strict)
+
+    def __repr__(self):
+        return 'Rule({0!r}, {1!r})'.format(self.rule_id, self.search)
+
+
+class XsltRule():
+    """
+    A mapping from the config that applies an XSLT stylesheet to the
+    whole document, for structural edits (e.g. replacing an element
+    and its children) that can not be made with a regex. The stylesheet
+    is compiled once. If search is given the stylesheet is only applied
+    to documents containing the search text. Parameters are passed to
+    the stylesheet as string parameters
+    """
+
+    __slots__ = ('rule_id', 'xslt', 'search', 'ignore_case', 'parameters',
+                 'target_element', 'search_pattern', 'timeout', 'transform')
+
+    def __init__(self, rule_id, xslt, search=None, ignore_case=False, parameters=None, timeout=None,
+                 strict=False):
+        from lxml import etree as ET
+
+        self.rule_id = rule_id
+        self.xslt = xslt
+        self.search = search
+        self.ignore_case = ignore_case
+        self.parameters = parameters or {}
+        self.timeout = timeout
+        # Applies to the whole document
+        self.target_element = None
+        self.search_pattern = None
+        if search:
+            check_pattern(search, rule_id, timeout, strict)
+            self.search_pattern = compile_pattern(search, re.IGNORECASE if ignore_case else 0,
+                                                  rule_id, timeout)
+        self.transform = ET.XSLT(ET.parse(xslt))
+
+    @classmethod
+    def from_mapping(cls, mapping, rule_id=None, timeout=None, strict=False):
+        return cls(rule_id,
+                   mapping['xslt'],
+                   mapping.get('search'),
+                   mapping.get('ignore_case', False),
+                   mapping.get('parameters'),
+                   timeout,
+                   strict)
+
+    def apply(self, tree):
+        """
+        Return the tree transformed by the stylesheet
+        """
+
+        from lxml import etree as ET
+
+        return self.transform(tree, **{name: ET.XSLT.strparam(str(value))
+                                       for name, value in self.parameters.items()})
+
+    def __reduce__(self):
+        # The compiled stylesheet can not be pickled, so
+        # it is compiled again in each worker process
+        return (XsltRule, (self.rule_id, self.xslt, self.search, self.ignore_case, self.parameters,
+                           self.timeout))
+
+    def __repr__(self):
+        return 'XsltRule({0!r}, {1!r})'.format(self.rule_id, self.xslt)
+
+
+def rule_from_mapping(mapping, rule_id=None, timeout=None, strict=False):
+    """
+    Return the config mapping dict as an XsltRule if
+    it has an xslt stylesheet, otherwise as a Rule
+    """
+
+    if mapping.get('xslt'):
+        return XsltRule.from_mapping(mapping, rule_id, timeout, strict)
+    return Rule.from_mapping(mapping, rule_id, timeout, strict)
+
+
+def as_rule(mapping):
+    """
+    Return the mapping as a Rule. Accepts a Rule,
+    an XsltRule or a single config mapping dict
+    """
+
+    if isinstance(mapping, (Rule, XsltRule)):
+        return mapping
+    return rule_from_mapping(mapping)
+
+
+def compile_rules(text_mapping, timeout=None, strict=False):
+    """
+    Compile the config's Text Mapping into a list of
+    rules in the order they are to be applied. With a
+    timeout (seconds) each search is limited to it.
+    Without one, searches that will backtrack exponentially
+    are a config error, and with strict those that may
+    """
+
+    import importlib.util
+
+    from lxml import etree as ET
+
+    if timeout and importlib.util.find_spec('regex') is None:
+        raise SystemExit('CONFIG ERROR: "Regex_timeout_ms" requires the regex module. Install '
+                         'it with "pip install metadata_updater[regex]"')
+    try:
+        return [rule_from_mapping(text_mapping[i], i, timeout, strict) for i in range(1, len(text_mapping) + 1)]
+    except KeyError as e:
+        raise SystemExit('CONFIG ERROR: Text Mapping must be numbered sequentially ' \
+                         'starting at 1. Missing mapping {0}'.format(e))
+    except re.error as e:
+        raise SystemExit('CONFIG ERROR: Text Mapping search is not a valid ' \
+                         'regular expression: {0}'.format(e))
+    except UnsafePattern as e:
+        raise SystemExit('CONFIG ERROR: {0}. Rewrite the search or set ' \
+                         '"Regex_timeout_ms"'.format(e))
+    except OSError as e:
+        raise SystemExit('CONFIG ERROR: Text Mapping xslt could not be read: {0}'.format(e))
+    except (ET.XMLSyntaxError, ET.XSLTParseError) as e:
+        raise SystemExit('CONFIG ERROR: Text Mapping xslt is not a valid ' \
+                         'stylesheet: {0}'.format(e))
@@ -0,0 +1,201 @@
+################################################################################
+#
+# Copyright 2018 Crown copyright (c)
+# Land Information New Zealand and the New Zealand Government.
+# All rights reserved
+#
+# This program is released under the terms of the new BSD license. See the
+# LICENSE file for more information.
+#
+################################################################################
+
+import collections
+import contextlib
+import threading
+
+# Layer outcomes
+EDITED = 'edited'
+UNCHANGED = 'unchanged'
+DRY_RUN = 'dry_run'
+MISSING_METADATA = 'missing_metadata'
+FAILED = 'failed'
+INVALID = 'invalid'
+PUBLISHED = 'published'
+
+
+# Returned by Runner.run
+RunResult = collections.namedtuple('RunResult', ['layer_count', 'layers_edited_count',
+                                                 'errors', 'outcomes', 'publish_ids'])
+
+
+class LayerOutcome():
+    """
+    Record of how a single layer was processed
+    """
+
+    __slots__ = ('layer_id', 'outcome', 'stage', 'message')
+
+    def __init__(self, layer_id, outcome, stage=None, message=None):
+        self.layer_id = layer_id
+        self.outcome = outcome
+        self.stage = stage
+        self.message = message
+
+    def as_dict(self):
+        return {'layer_id': self.layer_id,
+                'outcome': self.outcome,
+                'stage': self.stage,
+                'message': self.message}
+
+    def __repr__(self):
+        return 'LayerOutcome({0!r}, {1!r})'.format(self.layer_id, self.outcome)
+
+
+class RunOutputs():
+    """
+    The summary workbooks, diff report, metadata store run and output
+    index written by a run. A run opens and closes its own unless it
+    is given some, which lets a caller (i.e. the service) keep them
+    open over several runs so each run adds to, rather than
+    overwrites, the previous run's output and all are one store run
+    """
+
+    def __init__(self, summary_sink=None, missing_metadata_sink=None, diff_report=None,
+                 metadata_store=None, output_index=None):
+        self.summary_sink = summary_sink
+        self.missing_metadata_sink = missing_metadata_sink
+        self.diff_report = diff_report
+        self.metadata_store = metadata_store
+        self.output_index = output_index
+
+    def checkpoint(self):
+        """
+        Commit the documents stored so far, e.g. after each batch
+        """
+
+        if self.metadata_store is not None:
+            self.metadata_store.commit()
+
+    def close(self):
+        # Each is closed, in reverse order, even if closing another fails
+        with contextlib.ExitStack() as stack:
+            if self.output_index is not None:
+                stack.callback(self.output_index.write)
+            for output in (self.metadata_store, self.diff_report, self.missing_metadata_sink,
+                           self.summary_sink):
+                if output is not None:
+                    stack.callback(output.close)
+
+
+class RunContext():
+    """
+    State of a single run. Holds the counters, per layer
+    outcomes and collected summaries. An instance is passed
+    through the pipeline so concurrent runs in the one process
+    do not share state. All updates are made under a lock.
+    Summaries are collected in lists unless sinks (objects with
+    an append method, e.g. a workbook writer) are supplied to
+    stream them to. Downloaded documents are added to the
+    metadata_store and output_index, the changes made to the
+    diff_report and the publish groups created to the
+    publish_tracker, if they are supplied
+    """
+
+    def __init__(self, summary_sink=None, missing_metadata_sink=None, metadata_store=None,
+                 diff_report=None, output_index=None, publish_tracker=None):
+        self._lock = threading.Lock()
+        self.errors = 0
+        self.layer_count = 0
+        self.layers_edited_count = 0
+        self.outcomes = {}
+        self.xml_data = summary_sink if summary_sink is not None else []
+        self.missing_metadata = missing_metadata_sink if missing_metadata_sink is not None else []
+        self.publish_ids = []
+        self.metadata_store = metadata_store
+        self.diff_report = diff_report
+        self.output_index = output_index
+        self.publish_tracker = publish_tracker
+
+    def add_error(self, layer_id=None, stage=None, message=None, outcome=FAILED):
+        """
+        Count an error. If a layer id is supplied the layer's
+        outcome is recorded as failed (or the outcome given,
+        e.g. invalid)
+        """
+
+        with self._lock:
+            self.errors += 1
+            if layer_id is not None:
+                self.outcomes[layer_id] = LayerOutcome(layer_id, outcome, stage, message)
+
+    def add_layer(self):
+        with self._lock:
+            self.layer_count += 1
+
+    def add_edited(self, layer_id):
+        with self._lock:
+            self.layers_edited_count += 1
+            self.outcomes[layer_id] = LayerOutcome(layer_id, EDITED)
+
+    def record_outcome(self, layer_id, outcome, stage=None, message=None):
+        """
+        Record the outcome for a layer. A failure already
+        recorded against the layer is not overwritten
+        """
+
+        with self._lock:
+            current = self.outcomes.get(layer_id)
+            if current and current.outcome == FAILED:
+                return
+            self.outcomes[layer_id] = LayerOutcome(layer_id, outcome, stage, message)
+
+    def add_result(self, result):
+        """
+        Add the counts, outcomes and publish ids of another
+        run's result (a RunResult or its _asdict) to this run
+        """
+
+        if isinstance(result, RunResult):
+            result = result._asdict()
+        with self._lock:
+            self.layer_count += result['layer_count']
+            self.layers_edited_count += result['layers_edited_count']
+            self.errors += result['errors']
+            for outcome in result['outcomes']:
+                self.outcomes[outcome['layer_id']] = LayerOutcome(**outcome)
+            self.publish_ids.extend(result['publish_ids'])
+
+    def add_summary(self, data):
+        with self._lock:
+            self.xml_data.append(data)
+
+    def add_missing_metadata(self, entry):
+        with self._lock:
+            self.missing_metadata.append(entry)
+
+    def add_publish(self, publish_id):
+        with self._lock:
+            self.publish_ids.append(publish_id)
+
+    def outcome_counts(self):
+        """
+        Return a dict of outcome: number of layers
+        """
+
+        counts = {}
+        with self._lock:
+            for layer_outcome in self.outcomes.values():
+                counts[layer_outcome.outcome] = counts.get(layer_outcome.outcome, 0) + 1
+        return counts
+
+    def result(self):
+        """
+        Return a RunResult snapshot of the run
+        """
+
+        with self._lock:
+            return RunResult(self.layer_count,
+                             self.layers_edited_count,
+                             self.errors,
+                             [o.as_dict() for o in self.outcomes.values()],
+                             list(self.publish_ids))
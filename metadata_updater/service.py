@@ -0,0 +1,291 @@
+################################################################################
+#
+# Copyright 2018 Crown copyright (c)
+# Land Information New Zealand and the New Zealand Government.
+# All rights reserved
+#
+# This program is released under the terms of the new BSD license. See the
+# LICENSE file for more information.
+#
+################################################################################
+
+import abc
+import json
+import logging
+import os
+import queue
+import signal
+import socket
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Put on the work queue by a source when it has no more input
+END_OF_INPUT = object()
+
+
+def parse_layer_ids(line):
+    """
+    Return the layer ids in a line of input. A line can be a bare
+    id, {"layer_id": id}, {"layer_ids": [id, ...]} or a JSON list.
+    Values that are not layer ids are logged and ignored
+    """
+
+    from .metadata_updater import as_layer_id
+
+    line = line.strip()
+    if not line:
+        return []
+    try:
+        value = json.loads(line)
+    except ValueError:
+        value = line
+    if isinstance(value, dict):
+        if 'layer_ids' in value:
+            value = value['layer_ids']
+        elif 'layer_id' in value:
+            value = [value['layer_id']]
+        else:
+            logger.warning('Ignoring input with no layer id: {0}'.format(line))
+            return []
+    if not isinstance(value, list):
+        value = [value]
+    layer_ids = []
+    for layer_id in value:
+        try:
+            layer_ids.append(as_layer_id(layer_id))
+        except ValueError:
+            logger.warning('Ignoring input that is not a layer id: {0!r}'.format(layer_id))
+    return layer_ids
+
+
+class Source(abc.ABC):
+    """
+    Base class for a source of layer ids. A source reads
+    input on its own thread and puts layer ids on the work queue
+    """
+
+    def __init__(self):
+        self.work_queue = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, work_queue):
+        self.work_queue = work_queue
+        self._thread = threading.Thread(target=self.read, name=type(self).__name__, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def put_line(self, line):
+        for layer_id in parse_layer_ids(line):
+            # Blocks when the queue is full
+            self.work_queue.put(layer_id)
+
+    @abc.abstractmethod
+    def read(self):
+        """
+        Read input, putting its layer ids on the work queue,
+        until stopped or (optionally) the input ends
+        """
+
+
+class StdinSource(Source):
+    """
+    Read JSON lines of layer ids from stdin (or another stream).
+    The end of the stream ends the service
+    """
+
+    def __init__(self, stream=None):
+        super(StdinSource, self).__init__()
+        self.stream = stream or sys.stdin
+
+    def read(self):
+        for line in self.stream:
+            if self._stop.is_set():
+                break
+            self.put_line(line)
+        self.work_queue.put(END_OF_INPUT)
+
+
+class SpoolDirectorySource(Source):
+    """
+    Poll a spool directory for files of layer ids, one per line.
+    Files are read in order of modification time and deleted once
+    queued. Files starting with "." are ignored so writers can write
+    to a hidden file and rename it into place
+    """
+
+    def __init__(self, path, poll_interval=1.0):
+        super(SpoolDirectorySource, self).__init__()
+        self.path = path
+        self.poll_interval = poll_interval
+        os.makedirs(path, exist_ok=True)
+
+    def spooled_files(self):
+        files = []
+        for name in os.listdir(self.path):
+            file = os.path.join(self.path, name)
+            if not name.startswith('.') and os.path.isfile(file):
+                files.append(file)
+        return sorted(files, key=os.path.getmtime)
+
+    def read(self):
+        while not self._stop.is_set():
+            for file in self.spooled_files():
+                with open(file, 'r') as f:
+                    for line in f:
+                        self.put_line(line)
+                os.remove(file)
+            self._stop.wait(self.poll_interval)
+
+
+class UnixSocketSource(Source):
+    """
+    Listen on a Unix domain socket for JSON lines of layer ids.
+    Any number of clients can connect and write to the socket
+    """
+
+    def __init__(self, path):
+        super(UnixSocketSource, self).__init__()
+        self.path = path
+
+    def handle(self, connection):
+        with connection, connection.makefile('r') as stream:
+            for line in stream:
+                self.put_line(line)
+
+    def read(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        server.listen()
+        server.settimeout(1.0)
+        try:
+            while not self._stop.is_set():
+                try:
+                    connection, _ = server.accept()
+                except socket.timeout:
+                    continue
+                connection.settimeout(None)
+                threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+        finally:
+            server.close()
+            os.remove(self.path)
+
+
+def make_source(spec):
+    """
+    Return a source as per the --service argument:
+    "stdin", "spool:<directory>" or "socket:<path>"
+    """
+
+    kind, _, path = spec.partition(':')
+    if kind == 'stdin':
+        return StdinSource()
+    if kind == 'spool' and path:
+        return SpoolDirectorySource(path)
+    if kind == 'socket' and path:
+        return UnixSocketSource(path)
+    raise SystemExit('Error, --service must be "stdin", "spool:<directory>" ' \
+                     'or "socket:<path>". Got:"{0}" instead'.format(spec))
+
+
+class Service():
+    """
+    Continuously process layer ids from a source with a warm
+    Runner. Ids are collected into micro batches of up to
+    batch_size ids or batch_wait seconds, and each batch is
+    run (and its edits published) as one run. The summary
+    workbooks and diff report are kept open for the life of
+    the service so each batch adds to them
+    """
+
+    def __init__(self, runner, source, batch_size=50, batch_wait=5.0, queue_size=10000):
+        self.runner = runner
+        self.source = source
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.work_queue = queue.Queue(maxsize=queue_size)
+        self.results = []
+        self._stop = threading.Event()
+        self._end_of_input = False
+
+    def stop(self):
+        self._stop.set()
+        self.source.stop()
+
+    def next_batch(self):
+        """
+        Return the next batch of unique layer ids. Waits for at
+        least one id. Returns None when the service is to stop
+        """
+
+        batch = []
+        while not batch:
+            if self._stop.is_set() or self._end_of_input:
+                return None
+            try:
+                layer_id = self.work_queue.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            if layer_id is END_OF_INPUT:
+                self._end_of_input = True
+                return None
+            batch.append(layer_id)
+
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                layer_id = self.work_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if layer_id is END_OF_INPUT:
+                self._end_of_input = True
+                break
+            if layer_id not in batch:
+                batch.append(layer_id)
+        return batch
+
+    def serve(self):
+        """
+        Process batches until stopped or the source has no more input
+        """
+
+        outputs = self.runner.open_outputs()
+        self.source.start(self.work_queue)
+        logger.info('Service started. Waiting for layers from {0}'.format(type(self.source).__name__))
+        try:
+            while True:
+                batch = self.next_batch()
+                if batch is None:
+                    break
+                result = self.runner.run(batch, outputs)
+                self.results.append(result)
+                logger.info('Batch of {0} layer(s) processed | {1} layer(s) edited | ' \
+                            '{2} error(s)'.format(result.layer_count, result.layers_edited_count,
+                                                  result.errors))
+        finally:
+            self.source.stop()
+            outputs.close()
+        logger.info('Service stopped')
+        return self.results
+
+
+def run_service(runner, spec, batch_size=50, batch_wait=5.0):
+    """
+    Run the service until interrupted (SIGINT / SIGTERM)
+    or the source has no more input
+    """
+
+    service = Service(runner, make_source(spec), batch_size, batch_wait)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: service.stop())
+    return service.serve()
@@ -0,0 +1,239 @@
+################################################################################
+#
+# Copyright 2018 Crown copyright (c)
+# Land Information New Zealand and the New Zealand Government.
+# All rights reserved
+#
+# This program is released under the terms of the new BSD license. See the
+# LICENSE file for more information.
+#
+################################################################################
+
+"""
+Split one run across processes or hosts. Each of the N shards is run
+with --shard K/N and processes the layers whose id hashes to it,
+writing its outputs to <Destination>/shard-K-of-N. Shards do not
+publish, they record their edited drafts and result in a manifest.
+Once all shards have run, --merge-shards combines their summaries,
+results, change reports and output manifests and publishes the drafts.
+Metadata stores are not merged: each shard adds its own run to its
+Store. Index the merged destination with "metadata_updater_store
+<store> index <destination>" to store the run's documents as one run
+"""
+
+import argparse
+import collections
+import glob
+import itertools
+import json
+import logging
+import os
+import threading
+import zlib
+
+from . import metadata_updater
+from .pipeline import PublishBatcher
+from .run_context import RunContext
+from .utils.xml_to_excel import MISSING_METADATA_HEADERS, SUMMARY_KEYS, SummaryRecord
+
+logger = logging.getLogger(__name__)
+
+SHARD_MANIFEST_FILE = 'shard_manifest.json'
+
+# index is 1 based
+Shard = collections.namedtuple('Shard', 'index count')
+
+
+def parse_shard(text):
+    """
+    Return "K/N" as a Shard. For use as an argparse type
+    """
+
+    try:
+        index, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('shard must be K/N, e.g. 3/8. Got "{0}"'.format(text))
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError('shard K/N must have 1 <= K <= N. Got "{0}"'.format(text))
+    return Shard(index, count)
+
+
+def shard_of(layer_id, count):
+    """
+    Return the (1 based) shard the layer belongs to. The hash
+    is stable across processes, hosts and Python versions
+    """
+
+    return zlib.crc32(str(int(layer_id)).encode('ascii')) % count + 1
+
+
+def shard_layer_ids(layer_ids, shard):
+    """
+    Yield only the layer ids belonging to the shard
+    """
+
+    return (layer_id for layer_id in layer_ids if shard_of(layer_id, shard.count) == shard.index)
+
+
+def shard_dir(destination_dir, shard):
+    return os.path.join(destination_dir, 'shard-{0}-of-{1}'.format(shard.index, shard.count))
+
+
+class ManifestPublisher():
+    """
+    Records the edited drafts of a shard, in place of publishing
+    them. Can be used where a koordinates Publish is expected
+    """
+
+    def __init__(self):
+        self.drafts = []
+        self._lock = threading.Lock()
+
+    def add_layer_item(self, draft):
+        self._add(draft, 'layer')
+
+    def add_table_item(self, draft):
+        self._add(draft, 'table')
+
+    def _add(self, draft, item_type):
+        with self._lock:
+            self.drafts.append({'id': draft.id, 'type': item_type, 'version_id': draft.version.id})
+
+    def flush(self):
+        pass
+
+
+def write_manifest(directory, shard, publisher, result):
+    """
+    Write the shard's manifest: its edited drafts and RunResult
+    """
+
+    with open(os.path.join(directory, SHARD_MANIFEST_FILE), 'w') as f:
+        json.dump({'shard': list(shard), 'drafts': publisher.drafts, 'result': result._asdict()},
+                  f, indent=2)
+
+
+def load_manifests(destination_dir):
+    """
+    Return the shard manifests in the destination dir, in shard
+    order. Raises SystemExit unless every shard has a manifest
+    """
+
+    manifests = {}
+    for file in glob.glob(os.path.join(destination_dir, 'shard-*-of-*', SHARD_MANIFEST_FILE)):
+        with open(file) as f:
+            manifest = json.load(f)
+        manifest['directory'] = os.path.dirname(file)
+        manifests[Shard(*manifest['shard'])] = manifest
+    if not manifests:
+        raise SystemExit('Error, no shard manifests found in {0}'.format(destination_dir))
+    counts = set(shard.count for shard in manifests)
+    if len(counts) > 1:
+        raise SystemExit('Error, manifests from runs of {0} shards found in {1}'.format(
+            ' and '.join(str(count) for count in sorted(counts)), destination_dir))
+    count = counts.pop()
+    missing = [str(index) for index in range(1, count + 1) if Shard(index, count) not in manifests]
+    if missing:
+        raise SystemExit('Error, shard(s) {0} of {1} have not completed'.format(', '.join(missing), count))
+    return [manifests[shard] for shard in sorted(manifests)]
+
+
+def merge_summaries(directory, context):
+    """
+    Add a shard's summaries and missing metadata to the context
+    """
+
+    import openpyxl
+
+    from .analytics import ColumnStore, SUMMARY_COLUMNS_DIR
+
+    # The workbook holds the summaries as parsed, the columns only if it was not written
+    summary_file = os.path.join(directory, 'metadata_summary.xlsx')
+    columns_dir = os.path.join(directory, SUMMARY_COLUMNS_DIR)
+    if os.path.isfile(summary_file):
+        workbook = openpyxl.load_workbook(summary_file, read_only=True)
+        for values in workbook.active.iter_rows(min_row=2, values_only=True):
+            context.add_summary(SummaryRecord.from_mapping(dict(zip(SUMMARY_KEYS, values))))
+        workbook.close()
+    elif os.path.isdir(columns_dir):
+        for data in ColumnStore.load(columns_dir).rows():
+            context.add_summary(SummaryRecord.from_mapping(data))
+
+    missing_metadata_file = os.path.join(directory, 'layers_missing_metadata.xlsx')
+    if os.path.isfile(missing_metadata_file):
+        workbook = openpyxl.load_workbook(missing_metadata_file, read_only=True)
+        for values in workbook.active.iter_rows(min_row=2, values_only=True):
+            context.add_missing_metadata(dict(zip(MISSING_METADATA_HEADERS, values)))
+        workbook.close()
+
+
+def merge_diff_report(directory, diff_report):
+    """
+    Add the changes in a shard's change report to the diff report
+    """
+
+    from .diff_report import JSONL_FILE
+    from .transform import Change
+
+    jsonl_file = os.path.join(directory, JSONL_FILE)
+    if not os.path.isfile(jsonl_file):
+        return
+    with open(jsonl_file, encoding='utf-8') as f:
+        records = (json.loads(line) for line in f if line.strip())
+        # The changes of each layer are written together
+        for layer_id, layer_records in itertools.groupby(records, lambda record: record['layer_id']):
+            diff_report.add(layer_id, [Change(**{field: record[field] for field in Change._fields})
+                                       for record in layer_records])
+
+
+def merge_shards(runner):
+    """
+    Combine the results, summaries, change reports and output
+    manifests of all shards in the runner's destination dir and,
+    unless a dry run, publish their edited drafts in groups of the
+    configured publish batch size. Returns the combined RunResult
+    """
+
+    import koordinates
+
+    config = runner.config
+    manifests = load_manifests(config.destination_dir)
+
+    sinks = runner.open_summaries() if config.summarise else ()
+    context = RunContext(*sinks, publish_tracker=runner.open_publish_tracker())
+    output_index = runner.open_output_index()
+    diff_report = runner.open_diff_report()
+    for manifest in manifests:
+        context.add_result(manifest['result'])
+        output_index.add_manifest(manifest['directory'])
+        if config.summarise:
+            merge_summaries(manifest['directory'], context)
+        if diff_report is not None:
+            merge_diff_report(manifest['directory'], diff_report)
+    if config.summarise:
+        runner.write_summaries(context)
+    if diff_report is not None:
+        diff_report.close()
+    output_index.write()
+
+    if not config.test_dry_run:
+        publisher = PublishBatcher(lambda group: runner.publish(group, context),
+                                   config.publish_batch_size)
+        for manifest in manifests:
+            for item in manifest['drafts']:
+                try:
+                    draft = runner.client.layers.get_draft(item['id'])
+                except (koordinates.exceptions.NotFound, koordinates.exceptions.ServerError) as e:
+                    logger.critical('Failed to get the draft of {0} to publish: {1}'.format(item['id'], e))
+                    context.add_error(item['id'], 'publish', str(e))
+                    continue
+                if draft.version.id != item['version_id']:
+                    logger.warning('Draft of {0} is version {1}, the shard edited version {2}'.format(
+                        item['id'], draft.version.id, item['version_id']))
+                metadata_updater.add_to_pub_group(publisher, draft)
+        publisher.flush()
+    runner.wait_for_publishes(context)
+
+    logger.info('Merged {0} shard(s): {1} layer(s) processed | {2} layer(s) edited'.format(
+        len(manifests), context.layer_count, context.layers_edited_count))
+    return context.result()
@@ -0,0 +1,297 @@
+#!/usr/bin/python3
+
+################################################################################
+#
+# Copyright 2018 Crown copyright (c)
+# Land Information New Zealand and the New Zealand Government.
+# All rights reserved
+#
+# This program is released under the terms of the new BSD license. See the
+# LICENSE file for more information.
+#
+################################################################################
+
+"""
+Local SQLite store of the metadata downloaded by each run. Each
+document is stored with its summary fields, version id and hash
+and indexed with FTS5, so the catalog can be searched and runs
+compared without downloading the metadata again
+
+    metadata_updater_store metadata.sqlite search 'useLimitation: "Attribution 3.0"'
+    metadata_updater_store metadata.sqlite search 'Kelp' --ids
+    metadata_updater_store metadata.sqlite diff
+    metadata_updater_store metadata.sqlite index ./data --label merged
+"""
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+
+from .utils.xml_to_excel import SUMMARY_FIELDS, parse_xml_file
+
+# Increment when the tables change
+SCHEMA_VERSION = 1
+
+# The metadata fields are indexed as FTS columns so a
+# query can be limited to one (i.e. 'useLimitation: CC')
+TEXT_FIELDS = [field.key for field in SUMMARY_FIELDS if field.path and not field.numeric]
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    started_at TEXT NOT NULL,
+    label TEXT
+);
+CREATE TABLE IF NOT EXISTS documents (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    layer_id INTEGER NOT NULL,
+    layer_type TEXT,
+    version_id INTEGER,
+    sha256 TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    fields TEXT NOT NULL,
+    UNIQUE (run_id, layer_id)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5({0}, document);
+'''.format(', '.join(TEXT_FIELDS))
+
+
+class MetadataStore():
+    """
+    SQLite store of metadata documents by run. Documents are added
+    from any thread and committed when the store is closed
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.run_id = None
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        try:
+            self._connection.executescript(SCHEMA)
+        except sqlite3.OperationalError as e:
+            self._connection.close()
+            raise SystemExit('Error, the metadata store requires SQLite with FTS5: {0}'.format(e))
+        version = self._connection.execute('PRAGMA user_version').fetchone()[0]
+        if version not in (0, SCHEMA_VERSION):
+            self._connection.close()
+            raise SystemExit('Error, {0} is metadata store version {1}, expected {2}'.format(
+                path, version, SCHEMA_VERSION))
+        self._connection.execute('PRAGMA user_version = {0}'.format(SCHEMA_VERSION))
+
+    def start_run(self, label=None):
+        """
+        Start a run that documents are added to. Returns the run id
+        """
+
+        with self._lock:
+            cursor = self._connection.execute(
+                'INSERT INTO runs (started_at, label) VALUES (?, ?)',
+                (datetime.datetime.now().isoformat(timespec='seconds'), label))
+            self.run_id = cursor.lastrowid
+        return self.run_id
+
+    def add_document(self, layer_id, file, summary=None, version_id=None, layer_type='layer'):
+        """
+        Store and index the metadata file against the current run.
+        summary is the file's parse_xml_file record, parsed if None
+        """
+
+        with open(file, 'rb') as f:
+            document = f.read()
+        if summary is None:
+            summary = parse_xml_file(file)
+        fields = {key: summary[key] for key in summary if summary[key] is not None}
+        with self._lock:
+            existing = self._connection.execute(
+                'SELECT rowid FROM documents WHERE run_id = ? AND layer_id = ?',
+                (self.run_id, layer_id)).fetchone()
+            if existing:
+                self._connection.execute('DELETE FROM documents WHERE rowid = ?', existing)
+                self._connection.execute('DELETE FROM documents_fts WHERE rowid = ?', existing)
+            cursor = self._connection.execute(
+                'INSERT INTO documents (run_id, layer_id, layer_type, version_id, sha256, size, fields) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (self.run_id, layer_id, layer_type, version_id, hashlib.sha256(document).hexdigest(),
+                 len(document), json.dumps(fields, default=str)))
+            self._connection.execute(
+                'INSERT INTO documents_fts (rowid, {0}, document) VALUES (?, {1}, ?)'.format(
+                    ', '.join(TEXT_FIELDS), ', '.join('?' * len(TEXT_FIELDS))),
+                [cursor.lastrowid] + [fields.get(key) for key in TEXT_FIELDS] +
+                [document.decode('utf-8', 'replace')])
+
+    def add_destination(self, destination_dir):
+        """
+        Add the documents listed in the destination dir's output
+        manifest, e.g. of merged shards, to the current run.
+        Returns the number of documents added
+        """
+
+        from .layout import load_manifest, resolve
+
+        manifest = load_manifest(destination_dir)
+        count = 0
+        for layer_id, entry in manifest.items():
+            file = resolve(destination_dir, layer_id, manifest)
+            if not os.path.isfile(file):
+                continue
+            self.add_document(layer_id, file, version_id=entry.get('version'),
+                              layer_type=entry.get('type', 'layer'))
+            count += 1
+        return count
+
+    def commit(self):
+        with self._lock:
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def runs(self):
+        """
+        Return [(run_id, started_at, label, document count)]
+        """
+
+        return self._connection.execute(
+            'SELECT r.run_id, r.started_at, r.label, COUNT(d.layer_id) FROM runs r '
+            'LEFT JOIN documents d ON d.run_id = r.run_id GROUP BY r.run_id ORDER BY r.run_id').fetchall()
+
+    def latest_runs(self, count=2):
+        """
+        Return the ids of the latest runs with documents, oldest first
+        """
+
+        rows = self._connection.execute(
+            'SELECT DISTINCT run_id FROM documents ORDER BY run_id DESC LIMIT ?', (count,)).fetchall()
+        return [row[0] for row in reversed(rows)]
+
+    def search(self, query, run_id=None, limit=50):
+        """
+        Return [(layer_id, title, snippet)] of the run's (the latest
+        if None) documents matching the FTS5 query, best match first
+        """
+
+        if run_id is None:
+            latest = self.latest_runs(1)
+            if not latest:
+                return []
+            run_id = latest[0]
+        return self._connection.execute(
+            "SELECT d.layer_id, documents_fts.title, "
+            "snippet(documents_fts, -1, '[', ']', '...', 12) FROM documents_fts "
+            "JOIN documents d ON d.rowid = documents_fts.rowid "
+            "WHERE documents_fts MATCH ? AND d.run_id = ? ORDER BY rank LIMIT ?",
+            (query, run_id, limit)).fetchall()
+
+    def diff(self, from_run=None, to_run=None):
+        """
+        Compare the documents of two runs (by default the latest two).
+        Returns a dict of the layer ids added, removed and changed, with
+        the summary fields that changed for each changed layer
+        """
+
+        if from_run is None or to_run is None:
+            latest = self.latest_runs(2)
+            if len(latest) < 2:
+                raise SystemExit('Error, the store needs two runs to diff')
+            from_run, to_run = latest
+
+        def documents(run_id):
+            return {layer_id: (sha256, version_id, json.loads(fields))
+                    for layer_id, sha256, version_id, fields in self._connection.execute(
+                        'SELECT layer_id, sha256, version_id, fields FROM documents WHERE run_id = ?',
+                        (run_id,))}
+
+        before, after = documents(from_run), documents(to_run)
+        changed = {}
+        for layer_id in sorted(set(before) & set(after)):
+            if before[layer_id][0] != after[layer_id][0]:
+                old_fields, new_fields = before[layer_id][2], after[layer_id][2]
+                changed[layer_id] = {
+                    'version_ids': [before[layer_id][1], after[layer_id][1]],
+                    'fields': sorted(key for key in set(old_fields) | set(new_fields)
+                                     if old_fields.get(key) != new_fields.get(key))
+                }
+        return {'from_run': from_run, 'to_run': to_run,
+                'added': sorted(set(after) - set(before)),
+                'removed': sorted(set(before) - set(after)),
+                'changed': changed}
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Search and compare the metadata stored by runs')
+    parser.add_argument('path', help='Path to the metadata store')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    commands = parser.add_subparsers(dest='command')
+    # add_subparsers only takes required on Python 3.7+
+    commands.required = True
+
+    commands.add_parser('runs', help='List the stored runs')
+
+    search = commands.add_parser('search', help='Full text search a run\'s documents')
+    search.add_argument('query', help='FTS5 query, i.e. \'useLimitation: "Attribution 3.0"\'')
+    search.add_argument('--run', type=int, default=None, help='Run id. Default the latest')
+    search.add_argument('--limit', type=int, default=50, help='Maximum number of results')
+    search.add_argument('--ids', action='store_true',
+                        help='Print only the layer ids, as a config "Layers" list')
+
+    diff = commands.add_parser('diff', help='Compare the documents of two runs')
+    diff.add_argument('--from', dest='from_run', type=int, default=None,
+                      help='Run id. Default the second latest')
+    diff.add_argument('--to', dest='to_run', type=int, default=None, help='Run id. Default the latest')
+
+    index = commands.add_parser('index', help='Store the documents in a destination dir\'s output manifest as a run')
+    index.add_argument('destination', help='Destination dir, e.g. of a merged sharded run')
+    index.add_argument('--label', default=None, help='Label of the run')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(sys.argv[1:] if args is None else args)
+    with MetadataStore(args.path) as store:
+        if args.command == 'runs':
+            result = store.runs()
+            lines = ['{0}  {1}  {2}  {3} document(s)'.format(*row) for row in result]
+        elif args.command == 'search':
+            try:
+                result = store.search(args.query, args.run, args.limit)
+            except sqlite3.OperationalError as e:
+                raise SystemExit('Error, invalid query: {0}'.format(e))
+            if args.ids:
+                result = [row[0] for row in result]
+                lines = ['[{0}]'.format(', '.join(str(layer_id) for layer_id in result))]
+            else:
+                lines = ['{0}  {1}\n    {2}'.format(layer_id, title, ' '.join(snippet.split()))
+                         for layer_id, title, snippet in result]
+        elif args.command == 'index':
+            run_id = store.start_run(args.label)
+            result = {'run_id': run_id, 'documents': store.add_destination(args.destination)}
+            lines = ['Run {0}: {1} document(s)'.format(run_id, result['documents'])]
+        else:
+            result = store.diff(args.from_run, args.to_run)
+            lines = ['Run {0} to run {1}'.format(result['from_run'], result['to_run']),
+                     'Added: {0}'.format(', '.join(map(str, result['added']))),
+                     'Removed: {0}'.format(', '.join(map(str, result['removed'])))]
+            lines += ['Changed {0}: {1}'.format(layer_id, ', '.join(change['fields']) or 'document')
+                      for layer_id, change in result['changed'].items()]
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print('\n'.join(lines))
+
+
+if __name__ == '__main__':
+    main()
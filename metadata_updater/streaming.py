@@ -0,0 +1,287 @@
+################################################################################
+#
+# Copyright 2018 Crown copyright (c)
+# Land Information New Zealand and the New Zealand Government.
+# All rights reserved
+#
+# This program is released under the terms of the new BSD license. See the
+# LICENSE file for more information.
+#
+################################################################################
+
+import itertools
+import os
+import re
+
+from lxml import etree as ET
+
+from .metadata_updater import NAMESPACES
+from .rules import XsltRule
+from .transform import Change, transform_document
+
+# A path step: a (prefixed) name or *
+STEP = re.compile(r'^(\*|([A-Za-z_][\w.-]*:)?[A-Za-z_][\w.-]*)$')
+
+
+class PathMatcher():
+    """
+    Match a target_element path against the tags of the open
+    elements as a document is streamed. Supports the ElementPath
+    subset used for target elements: child steps of prefixed names
+    or *, from the root ('./a/b' or 'a/b') or anywhere below it
+    ('.//a/b'). Raises ValueError for other paths
+    """
+
+    def __init__(self, path, namespaces):
+        self.path = path
+        self.descendant = path.startswith('.//')
+        steps = path[3:] if self.descendant else path[2:] if path.startswith('./') else path
+        self.steps = []
+        for step in steps.split('/'):
+            if not STEP.match(step):
+                raise ValueError('Unsupported path for streaming: {0}'.format(path))
+            if ':' in step:
+                prefix, name = step.split(':')
+                if prefix not in namespaces:
+                    raise ValueError('Unknown prefix in path: {0}'.format(path))
+                step = '{{{0}}}{1}'.format(namespaces[prefix], name)
+            self.steps.append(step)
+
+    @staticmethod
+    def supports(path):
+        try:
+            PathMatcher(path, NAMESPACES)
+            return True
+        except ValueError:
+            return False
+
+    def matches(self, tags):
+        """
+        Test the element whose tag is last in tags, the tags of
+        the open elements from the root, against the path
+        """
+
+        tags = tags[1:]
+        if len(tags) < len(self.steps) or (not self.descendant and len(tags) != len(self.steps)):
+            return False
+        return all(step == '*' or step == tag
+                   for step, tag in zip(self.steps, tags[len(tags) - len(self.steps):]))
+
+
+class ElementPass():
+    """
+    Apply a run of element rules while streaming the document from
+    source to destination. The output is written as the input is
+    parsed and processed elements are cleared, so memory is bounded
+    by the depth of the document rather than its size. A rule applies
+    if its search text is in the first element matching its target,
+    as for an in memory Document
+    """
+
+    def __init__(self, rules, changes=None):
+        self.rules = rules
+        self.changes = changes
+        self.matchers = None
+        self.active = {}
+        self.tags = []
+
+    def text(self, element, text):
+        """
+        Return the element's text with the rules applied
+        """
+
+        for rule, matcher in self.matchers:
+            if not matcher.matches(self.tags):
+                continue
+            if rule.rule_id not in self.active:
+                self.active[rule.rule_id] = bool(text and rule.search_pattern.search(text))
+            if self.active[rule.rule_id] and text:
+                edited = rule.element_pattern.sub(rule.replace, text, count=1)
+                if self.changes is not None and edited != text:
+                    self.changes.append(Change(rule.rule_id, '/'.join(self.prefixed_tags(element)),
+                                               element.sourceline, text, edited))
+                text = edited
+        return text
+
+    def prefixed_tags(self, element):
+        names = []
+        for tag, ancestor in zip(self.tags, reversed([element] + list(element.iterancestors()))):
+            qname = ET.QName(tag)
+            names.append('{0}:{1}'.format(ancestor.prefix, qname.localname) if ancestor.prefix
+                         else qname.localname)
+        return [''] + names
+
+    def run(self, source, destination):
+        """
+        Stream source to destination. Returns the ids of the rules applied
+        """
+
+        open_elements = []
+
+        def write_text(entry):
+            # An element's text is complete once its first child starts or it ends
+            if not entry['text_written']:
+                entry['text_written'] = True
+                text = self.text(entry['element'], entry['element'].text)
+                if text:
+                    xf.write(text)
+
+        def start_child(element):
+            # Write the parent's text and the previous sibling's tail then drop the sibling
+            parent = open_elements[-1]
+            write_text(parent)
+            previous = element.getprevious()
+            if previous is not None and previous.tail:
+                xf.write(previous.tail)
+            while element.getprevious() is not None:
+                del parent['element'][0]
+
+        with ET.xmlfile(destination, encoding='utf-8') as xf:
+            xf.write_declaration()
+            for event, element in ET.iterparse(source, events=('start', 'end', 'comment', 'pi'),
+                                               remove_blank_text=False, huge_tree=True):
+                if event == 'start':
+                    if self.matchers is None:
+                        namespaces = dict(NAMESPACES)
+                        namespaces.update({prefix: uri for prefix, uri in element.nsmap.items() if prefix})
+                        self.matchers = [(rule, PathMatcher(rule.target_element, namespaces))
+                                         for rule in self.rules]
+                    if open_elements:
+                        start_child(element)
+                        inherited = open_elements[-1]['element'].nsmap
+                    else:
+                        inherited = {}
+                    # xmlfile declares one prefix per namespace, the last given,
+                    # so the element's own prefix is kept by putting it last
+                    nsmap = {prefix: uri for prefix, uri in sorted(
+                        element.nsmap.items(), key=lambda item: item[0] == element.prefix)
+                             if inherited.get(prefix) != uri}
+                    writer = xf.element(element.tag, dict(element.attrib), nsmap=nsmap)
+                    writer.__enter__()
+                    self.tags.append(element.tag)
+                    open_elements.append({'element': element, 'writer': writer, 'text_written': False})
+                elif event == 'end':
+                    write_text(open_elements[-1])
+                    entry = open_elements.pop()
+                    if len(element) and element[-1].tail:
+                        xf.write(element[-1].tail)
+                    self.tags.pop()
+                    entry['writer'].__exit__(None, None, None)
+                    element.clear(keep_tail=True)
+                elif open_elements:
+                    # comment or processing instruction within the root
+                    start_child(element)
+                    xf.write(element, with_tail=False)
+                else:
+                    xf.write(element, with_tail=False)
+        return [rule.rule_id for rule in self.rules if self.active.get(rule.rule_id)]
+
+
+def text_pass(rules, source, destination, changes=None):
+    """
+    Apply a run of file wide rules line by line from source to
+    destination. Returns the ids of the rules applied. As in memory,
+    trailing whitespace is stripped from every line
+    """
+
+    applied = set()
+    with open(source, encoding='utf-8', newline=None) as src, \
+            open(destination, 'w', encoding='utf-8', newline='\n') as dst:
+        for number, line in enumerate(src, 1):
+            line = line.rstrip()
+            for rule in rules:
+                if not rule.search_pattern.search(line):
+                    continue
+                applied.add(rule.rule_id)
+                edited = rule.search_pattern.sub(rule.replace, line)
+                if changes is not None and edited != line:
+                    changes.append(Change(rule.rule_id, None, number, line, edited))
+                line = edited
+            dst.write(line + '\n')
+    return [rule.rule_id for rule in rules if rule.rule_id in applied]
+
+
+def supports_streaming(rules):
+    """
+    Test the rules can be applied to a stream. XSLT
+    rules need the whole document
+    """
+
+    return not any(isinstance(rule, XsltRule) for rule in rules) and \
+        all(PathMatcher.supports(rule.target_element) for rule in rules if rule.target_element)
+
+
+def transform_file(source, destination, rules, return_changes=False):
+    """
+    Apply the rules, in order, to the source file writing the result
+    to destination, without loading the document into memory. Each
+    run of consecutive file wide or element rules is one streaming
+    pass. Returns as transform_document but with the destination path
+    in place of the edited bytes (None, with no file written, if no
+    rule applied). A pass applying no rule is discarded. Rule sets
+    with XSLT rules or element paths that can not be streamed are
+    transformed in memory
+    """
+
+    changes = [] if return_changes else None
+    if not supports_streaming(rules):
+        with open(source, 'rb') as f:
+            result = transform_document(f.read(), rules, return_changes)
+        if result[0] is not None:
+            with open(destination, 'wb') as f:
+                f.write(result[0])
+            result = (destination,) + result[1:]
+        return result
+
+    applied, current, temporary, edited = [], source, [], None
+    try:
+        for is_element, group in itertools.groupby(rules, key=lambda rule: bool(rule.target_element)):
+            group = list(group)
+            output = '{0}.{1}.tmp'.format(destination, len(temporary))
+            temporary.append(output)
+            if is_element:
+                group_applied = ElementPass(group, changes).run(current, output)
+            else:
+                group_applied = text_pass(group, current, output, changes)
+            if group_applied:
+                applied.extend(group_applied)
+                current = output
+
+        if applied:
+            os.replace(current, destination)
+            edited = destination
+    finally:
+        # Including on a rule timing out
+        for file in temporary:
+            if os.path.exists(file):
+                os.remove(file)
+    if return_changes:
+        return edited, applied, changes
+    return edited, applied
+
+
+def find_text(file, target_element):
+    """
+    Return the text of the first element, in document order as for
+    ElementPath find, matching target_element. The match is found
+    when it starts, so an outer match comes before one nested in
+    it, and its text returned when it ends. The file is only
+    streamed as far as that element
+    """
+
+    matcher, tags, found = None, [], None
+    for event, element in ET.iterparse(file, events=('start', 'end'), huge_tree=True):
+        if event == 'start':
+            if matcher is None:
+                namespaces = dict(NAMESPACES)
+                namespaces.update({prefix: uri for prefix, uri in element.nsmap.items() if prefix})
+                matcher = PathMatcher(target_element, namespaces)
+            tags.append(element.tag)
+            if found is None and matcher.matches(tags):
+                found = element
+        else:
+            if element is found:
+                return element.text
+            tags.pop()
+            element.clear(keep_tail=True)
+    return None
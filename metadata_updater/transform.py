@@ -0,0 +1,259 @@
+################################################################################
+#
+# Copyright 2018 Crown copyright (c)
+# Land Information New Zealand and the New Zealand Government.
+# All rights reserved
+#
+# This program is released under the terms of the new BSD license. See the
+# LICENSE file for more information.
+#
+################################################################################
+
+import collections
+import concurrent.futures
+import difflib
+import io
+
+from lxml import etree as ET
+
+from .metadata_updater import NAMESPACES
+from .rules import XsltRule
+
+# Rule set, whether to record changes and the validator,
+# shipped once to each transform worker process
+_worker_rules = None
+_worker_record_changes = False
+_worker_validator = None
+
+# An edit made by a rule. Element rules record the element's path and
+# source line, file wide and XSLT rules the line number (path is None)
+# of the text before the rule was applied
+Change = collections.namedtuple('Change', 'rule_id path line old new')
+
+
+class Document():
+    """
+    An in memory metadata document. Element rules work on the
+    parsed tree and file wide rules on the text, so the document
+    is only parsed or serialised when switching between the two.
+    If record_changes is True each edit is recorded in changes
+    """
+
+    def __init__(self, data, record_changes=False):
+        self._data = data
+        self._tree = None
+        self._text = None
+        self.modified = False
+        self.changes = [] if record_changes else None
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            parser = ET.XMLParser(remove_blank_text=False)
+            self._tree = ET.ElementTree(ET.fromstring(self.tobytes(), parser))
+            self._text = None
+            self._data = None
+        return self._tree
+
+    @property
+    def text(self):
+        if self._text is None:
+            # Universal newlines, as per reading the file in text mode
+            self._text = io.StringIO(self.tobytes().decode('utf-8'), newline=None).getvalue()
+            self._tree = None
+            self._data = None
+        return self._text
+
+    def namespaces(self):
+        """
+        Return the namespace prefixes declared on the root
+        element, falling back to the standard ISO prefixes
+        """
+
+        namespaces = dict(NAMESPACES)
+        namespaces.update({prefix: uri for prefix, uri in self.tree.getroot().nsmap.items() if prefix})
+        return namespaces
+
+    def has_text(self, rule):
+        """
+        Test for the rule's search text in the document,
+        or the rule's target element if it has one. XSLT
+        rules without search text apply to any document
+        """
+
+        if rule.search_pattern is None:
+            return True
+        if rule.target_element:
+            element = self.tree.getroot().find(rule.target_element, NAMESPACES)
+            return bool(element is not None and element.text and
+                        rule.search_pattern.search(element.text))
+        return any(rule.search_pattern.search(line) for line in io.StringIO(self.text))
+
+    def apply(self, rule):
+        """
+        Apply the rule if its search text is found.
+        Returns True if the rule was applied
+        """
+
+        if not self.has_text(rule):
+            return False
+
+        if isinstance(rule, XsltRule):
+            return self.apply_xslt(rule)
+        if rule.target_element:
+            for element in self.tree.getroot().findall(rule.target_element, self.namespaces()):
+                if element is not None and element.text:
+                    # Ensure replacement is done only once
+                    text = rule.element_pattern.sub(rule.replace, element.text, count=1)
+                    if self.changes is not None and text != element.text:
+                        self.changes.append(Change(rule.rule_id, self.tree.getpath(element),
+                                                   element.sourceline, element.text, text))
+                    element.text = text
+        elif self.changes is None:
+            lines = [rule.search_pattern.sub(rule.replace, line.rstrip())
+                     for line in io.StringIO(self.text)]
+            self._text = '\n'.join(lines) + '\n'
+        else:
+            lines = []
+            for number, line in enumerate(io.StringIO(self.text), 1):
+                line = line.rstrip()
+                lines.append(rule.search_pattern.sub(rule.replace, line))
+                if lines[-1] != line:
+                    self.changes.append(Change(rule.rule_id, None, number, line, lines[-1]))
+            self._text = '\n'.join(lines) + '\n'
+        self.modified = True
+        return True
+
+    def apply_xslt(self, rule):
+        """
+        Transform the tree with the rule's stylesheet. Returns
+        True if the stylesheet changed the document
+        """
+
+        before = ET.tostring(self.tree)
+        result = rule.apply(self.tree)
+        after = ET.tostring(result)
+        if after == before:
+            return False
+        if self.changes is not None:
+            old, new = before.decode('utf-8').splitlines(), after.decode('utf-8').splitlines()
+            matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+                if tag != 'equal':
+                    self.changes.append(Change(rule.rule_id, None, i1 + 1,
+                                               '\n'.join(old[i1:i2]), '\n'.join(new[j1:j2])))
+        self._tree = result
+        self.modified = True
+        return True
+
+    def tobytes(self):
+        if self._data is not None:
+            return self._data
+        if self._tree is not None:
+            return ET.tostring(self._tree, encoding='UTF-8', xml_declaration=True, pretty_print=True)
+        return self._text.encode('utf-8')
+
+
+def transform_document(data, rules, return_changes=False):
+    """
+    Apply the rules, in order, to the document bytes. Returns
+    the edited document bytes (None if no rule applied) and
+    the ids of the rules that were applied. If return_changes
+    is True the list of Changes made is returned as well
+    """
+
+    document = Document(data, return_changes)
+    applied = [rule.rule_id for rule in rules if document.apply(rule)]
+    edited = document.tobytes() if document.modified else None
+    if return_changes:
+        return edited, applied, document.changes
+    return edited, applied
+
+
+def _init_worker(rules, record_changes=False, validator=None):
+    global _worker_rules, _worker_record_changes, _worker_validator
+    _worker_rules = rules
+    _worker_record_changes = record_changes
+    _worker_validator = validator
+
+
+def _transform_in_worker(data):
+    return transform_document(data, _worker_rules, _worker_record_changes)
+
+
+def _transform_file_in_worker(source, destination):
+    from .streaming import transform_file
+
+    return transform_file(source, destination, _worker_rules, _worker_record_changes)
+
+
+def _validate_in_worker(file):
+    return _worker_validator.validate(file)
+
+
+class Transformer():
+    """
+    Runs the CPU bound parse, match, edit and serialise stage.
+    With more than one worker documents are transformed in a
+    process pool so the work is not limited by the GIL.
+    The rule set and validator are sent to each worker
+    process once
+    """
+
+    def __init__(self, rules, workers=1, record_changes=False, validator=None):
+        self.rules = rules
+        self.workers = workers
+        self.record_changes = record_changes
+        self.validator = validator
+        self._executor = None
+        if workers > 1:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                workers, initializer=_init_worker, initargs=(rules, record_changes, validator))
+
+    def submit(self, data):
+        """
+        Return a future of transform_document(data, rules, record_changes)
+        """
+
+        if self._executor:
+            return self._executor.submit(_transform_in_worker, data)
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(transform_document(data, self.rules, self.record_changes))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def submit_file(self, source, destination):
+        """
+        Return a future of streaming.transform_file(source, destination,
+        rules, record_changes), for documents too large to hold in memory
+        """
+
+        if self._executor:
+            return self._executor.submit(_transform_file_in_worker, source, destination)
+        from .streaming import transform_file
+
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(transform_file(source, destination, self.rules, self.record_changes))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def validate(self, file):
+        """
+        Return the validator's errors for the document file
+        """
+
+        if self._executor:
+            return self._executor.submit(_validate_in_worker, file).result()
+        return self.validator.validate(file)
+
+    def transform(self, data):
+        return self.submit(data).result()
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
@@ -1,6 +1,166 @@
+import collections
 import os
+import threading
+from collections.abc import Mapping
 import xml.etree.ElementTree as ET
-import openpyxl
+
+# A metadata summary field. name is its SummaryRecord attribute, key its
+# key in the summary (as the analytics columns are named), header its
+# workbook column header and path the element it is extracted from (None
+# for the fields of the layer rather than its metadata). cell, if set,
+# converts the value for the workbook
+SummaryField = collections.namedtuple('SummaryField', 'name key header path numeric cell')
+# The namedtuple defaults argument needs Python 3.7+
+SummaryField.__new__.__defaults__ = (None, False, None)
+
+SUMMARY_FIELDS = [
+    SummaryField('layer_id', '__layer_id', '__layer_id'),
+    SummaryField('language', 'language', 'Language',
+                 './/gmd:language/gmd:LanguageCode'),
+    SummaryField('hierarchyLevel', 'hierarchyLevel', 'Hierarchy Level',
+                 './/gmd:hierarchyLevel/gmd:MD_ScopeCode'),
+    SummaryField('hierarchyLevelName', 'hierarchyLevelName', 'Hierarchy Level Name',
+                 './/gmd:hierarchyLevelName/gco:CharacterString'),
+    SummaryField('individualName', 'individualName', 'Individual Name',
+                 './/gmd:contact/gmd:CI_ResponsibleParty/gmd:individualName/gco:CharacterString'),
+    SummaryField('organisationName', 'organisationName', 'Organisation Name',
+                 './/gmd:contact/gmd:CI_ResponsibleParty/gmd:organisationName/gco:CharacterString'),
+    SummaryField('positionName', 'positionName', 'Position Name',
+                 './/gmd:contact/gmd:CI_ResponsibleParty/gmd:positionName/gco:CharacterString'),
+    SummaryField('phone', 'phone', 'Phone',
+                 './/gmd:contact/gmd:CI_ResponsibleParty/gmd:contactInfo/gmd:CI_Contact/gmd:phone/gmd:CI_Telephone/gmd:voice/gco:CharacterString'),
+    SummaryField('email', 'email', 'Email',
+                 './/gmd:contact/gmd:CI_ResponsibleParty/gmd:contactInfo/gmd:CI_Contact/gmd:address/gmd:CI_Address/gmd:electronicMailAddress/gco:CharacterString'),
+    SummaryField('address', 'address', 'Address',
+                 './/gmd:contact/gmd:CI_ResponsibleParty/gmd:contactInfo/gmd:CI_Contact/gmd:address/gmd:CI_Address/gmd:deliveryPoint/gco:CharacterString'),
+    SummaryField('city', 'city', 'City',
+                 './/gmd:contact/gmd:CI_ResponsibleParty/gmd:contactInfo/gmd:CI_Contact/gmd:address/gmd:CI_Address/gmd:city/gco:CharacterString'),
+    SummaryField('postalCode', 'postalCode', 'Postal Code',
+                 './/gmd:contact/gmd:CI_ResponsibleParty/gmd:contactInfo/gmd:CI_Contact/gmd:address/gmd:CI_Address/gmd:postalCode/gco:CharacterString'),
+    SummaryField('country', 'country', 'Country',
+                 './/gmd:contact/gmd:CI_ResponsibleParty/gmd:contactInfo/gmd:CI_Contact/gmd:address/gmd:CI_Address/gmd:country/gmd:Country'),
+    SummaryField('abstract', 'abstract', 'Abstract',
+                 './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:abstract/gco:CharacterString'),
+    SummaryField('title', 'title', 'Title',
+                 './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:citation/gmd:CI_Citation/gmd:title/gco:CharacterString'),
+    SummaryField('purpose', 'purpose', 'Purpose',
+                 './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:purpose/gco:CharacterString'),
+    SummaryField('credit', 'credit', 'Credit',
+                 './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:credit/gco:CharacterString'),
+    SummaryField('status', 'status', 'Status',
+                 './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:status/gmd:MD_ProgressCode'),
+    SummaryField('dateStamp', 'dateStamp', 'Date Stamp',
+                 './/gmd:dateStamp/gco:Date'),
+    SummaryField('metadataStandardName', 'metadataStandardName', 'Metadata Standard Name',
+                 './/gmd:metadataStandardName/gco:CharacterString'),
+    SummaryField('metadataStandardVersion', 'metadataStandardVersion', 'Metadata Standard Version',
+                 './/gmd:metadataStandardVersion/gco:CharacterString'),
+    SummaryField('environmentDescription', 'environmentDescription', 'Environment Description',
+                 './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:environmentDescription/gco:CharacterString'),
+    SummaryField('topologyLevel', 'topologyLevel', 'Topology Level',
+                 './/gmd:spatialRepresentationInfo/gmd:MD_VectorSpatialRepresentation/gmd:topologyLevel/gmd:MD_TopologyLevelCode'),
+    SummaryField('geometricObjectType', 'geometricObjectType', 'Geometric Object Type',
+                 './/gmd:spatialRepresentationInfo/gmd:MD_VectorSpatialRepresentation/gmd:geometricObjects/gmd:MD_GeometricObjects/gmd:geometricObjectType/gmd:MD_GeometricObjectTypeCode'),
+    SummaryField('geometricObjectCount', 'geometricObjectCount', 'Geometric Object Count',
+                 './/gmd:spatialRepresentationInfo/gmd:MD_VectorSpatialRepresentation/gmd:geometricObjects/gmd:MD_GeometricObjects/gmd:geometricObjectCount/gco:Integer', numeric=True),
+    SummaryField('referenceSystemCode', 'referenceSystemCode', 'Reference System Code',
+                 './/gmd:referenceSystemInfo/gmd:MD_ReferenceSystem/gmd:referenceSystemIdentifier/gmd:RS_Identifier/gmd:code/gco:CharacterString'),
+    SummaryField('referenceSystemCodeSpace', 'referenceSystemCodeSpace', 'Reference System Code Space',
+                 './/gmd:referenceSystemInfo/gmd:MD_ReferenceSystem/gmd:referenceSystemIdentifier/gmd:RS_Identifier/gmd:codeSpace/gco:CharacterString'),
+    SummaryField('referenceSystemVersion', 'referenceSystemVersion', 'Reference System Version',
+                 './/gmd:referenceSystemInfo/gmd:MD_ReferenceSystem/gmd:referenceSystemIdentifier/gmd:RS_Identifier/gmd:version/gco:CharacterString'),
+    SummaryField('keyword', 'keyword', 'Keyword',
+                 './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:descriptiveKeywords/gmd:MD_Keywords/gmd:keyword/gco:CharacterString'),
+    SummaryField('useLimitation', 'useLimitation', 'Use Limitation',
+                 './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:resourceConstraints/gmd:MD_Constraints/gmd:useLimitation/gco:CharacterString'),
+    SummaryField('spatialRepresentationType', 'spatialRepresentationType', 'Spatial Representation Type',
+                 './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:spatialRepresentationType/gmd:MD_SpatialRepresentationTypeCode'),
+    SummaryField('distance', 'distance', 'Distance',
+                 './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:spatialResolution/gmd:MD_Resolution/gmd:distance/gco:Distance', numeric=True),
+    SummaryField('characterSet', 'characterSet', 'Character Set',
+                 './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:characterSet/gmd:MD_CharacterSetCode'),
+    SummaryField('topicCategory', 'topicCategory', 'Topic Category',
+                 './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:topicCategory/gmd:MD_TopicCategoryCode'),
+    SummaryField('extentTypeCode', 'extentTypeCode', 'Extent Type Code',
+                 './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:extent/gmd:EX_Extent/gmd:geographicElement/gmd:EX_GeographicBoundingBox/gmd:extentTypeCode/gco:Boolean'),
+    SummaryField('westBoundLongitude', 'westBoundLongitude', 'West Bound Longitude',
+                 './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:extent/gmd:EX_Extent/gmd:geographicElement/gmd:EX_GeographicBoundingBox/gmd:westBoundLongitude/gco:Decimal', numeric=True),
+    SummaryField('eastBoundLongitude', 'eastBoundLongitude', 'East Bound Longitude',
+                 './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:extent/gmd:EX_Extent/gmd:geographicElement/gmd:EX_GeographicBoundingBox/gmd:eastBoundLongitude/gco:Decimal', numeric=True),
+    SummaryField('southBoundLatitude', 'southBoundLatitude', 'South Bound Latitude',
+                 './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:extent/gmd:EX_Extent/gmd:geographicElement/gmd:EX_GeographicBoundingBox/gmd:southBoundLatitude/gco:Decimal', numeric=True),
+    SummaryField('northBoundLatitude', 'northBoundLatitude', 'North Bound Latitude',
+                 './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:extent/gmd:EX_Extent/gmd:geographicElement/gmd:EX_GeographicBoundingBox/gmd:northBoundLatitude/gco:Decimal', numeric=True),
+    SummaryField('distributionFormatName', 'distributionFormatName', 'Distribution Format Name',
+                 './/gmd:distributionInfo/gmd:MD_Distribution/gmd:distributionFormat/gmd:MD_Format/gmd:name/gco:CharacterString'),
+    SummaryField('distributionFormatVersion', 'distributionFormatVersion', 'Distribution Format Version',
+                 './/gmd:distributionInfo/gmd:MD_Distribution/gmd:distributionFormat/gmd:MD_Format/gmd:version/gco:CharacterString'),
+    SummaryField('transferSize', 'transferSize', 'Transfer Size',
+                 './/gmd:distributionInfo/gmd:MD_Distribution/gmd:transferOptions/gmd:MD_DigitalTransferOptions/gmd:transferSize/gco:Real', numeric=True),
+    SummaryField('lineageStatement', 'lineageStatement', 'Lineage Statement',
+                 './/gmd:dataQualityInfo/gmd:DQ_DataQuality/gmd:lineage/gmd:LI_Lineage/gmd:statement/gco:CharacterString'),
+    SummaryField('license_type', '__license_type', '__license_type'),
+    SummaryField('license_url', '__license_url', '__license_url'),
+    SummaryField('num_downloads', '__num_downloads', '__num_downloads', numeric=True),
+    SummaryField('first_published_at', '__first_published_at', '__first_published_at'),
+    SummaryField('is_public', '__is_public', '__is_public', cell=str),
+]
+
+SUMMARY_HEADERS = [field.header for field in SUMMARY_FIELDS]
+SUMMARY_KEYS = [field.key for field in SUMMARY_FIELDS]
+SUMMARY_NAMES = {field.key: field.name for field in SUMMARY_FIELDS}
+
+NAMESPACES = {
+    'gmd': 'http://www.isotc211.org/2005/gmd',
+    'gco': 'http://www.isotc211.org/2005/gco',
+    'srv': 'http://www.isotc211.org/2005/srv',
+    'gml': 'http://www.opengis.net/gml',
+    'xlink': 'http://www.w3.org/1999/xlink'
+}
+
+
+class SummaryRecord(Mapping):
+    """
+    A layer's metadata summary. The values are held in slots, one per
+    SUMMARY_FIELDS entry, rather than a dict per layer. They can also
+    be read and set by key (i.e. record['__layer_id']) so a record can
+    be used where a summary dict was
+    """
+
+    __slots__ = tuple(field.name for field in SUMMARY_FIELDS)
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+    @classmethod
+    def from_mapping(cls, data):
+        return cls(**{field.name: data.get(field.key) for field in SUMMARY_FIELDS})
+
+    def __getitem__(self, key):
+        return getattr(self, SUMMARY_NAMES[key])
+
+    def __setitem__(self, key, value):
+        setattr(self, SUMMARY_NAMES[key], value)
+
+    def __iter__(self):
+        return iter(SUMMARY_KEYS)
+
+    def __len__(self):
+        return len(SUMMARY_FIELDS)
+
+    def __repr__(self):
+        return 'SummaryRecord({0})'.format(', '.join('{0}={1!r}'.format(name, getattr(self, name))
+                                                     for name in self.__slots__))
+
+    def row(self):
+        """
+        Return the summary as a row in the order of SUMMARY_HEADERS
+        """
+
+        return [field.cell(getattr(self, field.name)) if field.cell else getattr(self, field.name)
+                for field in SUMMARY_FIELDS]
+
 
 def parse_xml_file(file_path):
     """
@@ -9,143 +169,116 @@ def parse_xml_file(file_path):
 
     tree = ET.parse(file_path)
     root = tree.getroot()
-    namespaces = {
-        'gmd': 'http://www.isotc211.org/2005/gmd',
-        'gco': 'http://www.isotc211.org/2005/gco',
-        'srv': 'http://www.isotc211.org/2005/srv',
-        'gml': 'http://www.opengis.net/gml',
-        'xlink': 'http://www.w3.org/1999/xlink'
-    }
-
-    def get_text(element, path):
-        found = root.find(path, namespaces)
+
+    def get_text(path):
+        found = root.find(path, NAMESPACES)
         return found.text if found is not None else ''
 
-    data = {
-        'language': get_text(root, './/gmd:language/gmd:LanguageCode'),
-        'hierarchyLevel': get_text(root, './/gmd:hierarchyLevel/gmd:MD_ScopeCode'),
-        'hierarchyLevelName': get_text(root, './/gmd:hierarchyLevelName/gco:CharacterString'),
-        'individualName': get_text(root, './/gmd:contact/gmd:CI_ResponsibleParty/gmd:individualName/gco:CharacterString'),
-        'organisationName': get_text(root, './/gmd:contact/gmd:CI_ResponsibleParty/gmd:organisationName/gco:CharacterString'),
-        'positionName': get_text(root, './/gmd:contact/gmd:CI_ResponsibleParty/gmd:positionName/gco:CharacterString'),
-        'phone': get_text(root, './/gmd:contact/gmd:CI_ResponsibleParty/gmd:contactInfo/gmd:CI_Contact/gmd:phone/gmd:CI_Telephone/gmd:voice/gco:CharacterString'),
-        'email': get_text(root, './/gmd:contact/gmd:CI_ResponsibleParty/gmd:contactInfo/gmd:CI_Contact/gmd:address/gmd:CI_Address/gmd:electronicMailAddress/gco:CharacterString'),
-        'address': get_text(root, './/gmd:contact/gmd:CI_ResponsibleParty/gmd:contactInfo/gmd:CI_Contact/gmd:address/gmd:CI_Address/gmd:deliveryPoint/gco:CharacterString'),
-        'city': get_text(root, './/gmd:contact/gmd:CI_ResponsibleParty/gmd:contactInfo/gmd:CI_Contact/gmd:address/gmd:CI_Address/gmd:city/gco:CharacterString'),
-        'postalCode': get_text(root, './/gmd:contact/gmd:CI_ResponsibleParty/gmd:contactInfo/gmd:CI_Contact/gmd:address/gmd:CI_Address/gmd:postalCode/gco:CharacterString'),
-        'country': get_text(root, './/gmd:contact/gmd:CI_ResponsibleParty/gmd:contactInfo/gmd:CI_Contact/gmd:address/gmd:CI_Address/gmd:country/gmd:Country'),
-        'abstract': get_text(root, './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:abstract/gco:CharacterString'),
-        'title': get_text(root, './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:citation/gmd:CI_Citation/gmd:title/gco:CharacterString'),
-        'purpose': get_text(root, './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:purpose/gco:CharacterString'),
-        'credit': get_text(root, './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:credit/gco:CharacterString'),
-        'status': get_text(root, './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:status/gmd:MD_ProgressCode'),
-        'dateStamp': get_text(root, './/gmd:dateStamp/gco:Date'),
-        'metadataStandardName': get_text(root, './/gmd:metadataStandardName/gco:CharacterString'),
-        'metadataStandardVersion': get_text(root, './/gmd:metadataStandardVersion/gco:CharacterString'),
-        'environmentDescription': get_text(root, './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:environmentDescription/gco:CharacterString'),
-        'topologyLevel': get_text(root, './/gmd:spatialRepresentationInfo/gmd:MD_VectorSpatialRepresentation/gmd:topologyLevel/gmd:MD_TopologyLevelCode'),
-        'geometricObjectType': get_text(root, './/gmd:spatialRepresentationInfo/gmd:MD_VectorSpatialRepresentation/gmd:geometricObjects/gmd:MD_GeometricObjects/gmd:geometricObjectType/gmd:MD_GeometricObjectTypeCode'),
-        'geometricObjectCount': get_text(root, './/gmd:spatialRepresentationInfo/gmd:MD_VectorSpatialRepresentation/gmd:geometricObjects/gmd:MD_GeometricObjects/gmd:geometricObjectCount/gco:Integer'),
-        'referenceSystemCode': get_text(root, './/gmd:referenceSystemInfo/gmd:MD_ReferenceSystem/gmd:referenceSystemIdentifier/gmd:RS_Identifier/gmd:code/gco:CharacterString'),
-        'referenceSystemCodeSpace': get_text(root, './/gmd:referenceSystemInfo/gmd:MD_ReferenceSystem/gmd:referenceSystemIdentifier/gmd:RS_Identifier/gmd:codeSpace/gco:CharacterString'),
-        'referenceSystemVersion': get_text(root, './/gmd:referenceSystemInfo/gmd:MD_ReferenceSystem/gmd:referenceSystemIdentifier/gmd:RS_Identifier/gmd:version/gco:CharacterString'),
-        'keyword': get_text(root, './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:descriptiveKeywords/gmd:MD_Keywords/gmd:keyword/gco:CharacterString'),
-        'useLimitation': get_text(root, './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:resourceConstraints/gmd:MD_Constraints/gmd:useLimitation/gco:CharacterString'),
-        'spatialRepresentationType': get_text(root, './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:spatialRepresentationType/gmd:MD_SpatialRepresentationTypeCode'),
-        'distance': get_text(root, './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:spatialResolution/gmd:MD_Resolution/gmd:distance/gco:Distance'),
-        'characterSet': get_text(root, './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:characterSet/gmd:MD_CharacterSetCode'),
-        'topicCategory': get_text(root, './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:topicCategory/gmd:MD_TopicCategoryCode'),
-        'extentTypeCode': get_text(root, './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:extent/gmd:EX_Extent/gmd:geographicElement/gmd:EX_GeographicBoundingBox/gmd:extentTypeCode/gco:Boolean'),
-        'westBoundLongitude': get_text(root, './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:extent/gmd:EX_Extent/gmd:geographicElement/gmd:EX_GeographicBoundingBox/gmd:westBoundLongitude/gco:Decimal'),
-        'eastBoundLongitude': get_text(root, './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:extent/gmd:EX_Extent/gmd:geographicElement/gmd:EX_GeographicBoundingBox/gmd:eastBoundLongitude/gco:Decimal'),
-        'southBoundLatitude': get_text(root, './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:extent/gmd:EX_Extent/gmd:geographicElement/gmd:EX_GeographicBoundingBox/gmd:southBoundLatitude/gco:Decimal'),
-        'northBoundLatitude': get_text(root, './/gmd:identificationInfo/gmd:MD_DataIdentification/gmd:extent/gmd:EX_Extent/gmd:geographicElement/gmd:EX_GeographicBoundingBox/gmd:northBoundLatitude/gco:Decimal'),
-        'distributionFormatName': get_text(root, './/gmd:distributionInfo/gmd:MD_Distribution/gmd:distributionFormat/gmd:MD_Format/gmd:name/gco:CharacterString'),
-        'distributionFormatVersion': get_text(root, './/gmd:distributionInfo/gmd:MD_Distribution/gmd:distributionFormat/gmd:MD_Format/gmd:version/gco:CharacterString'),
-        'transferSize': get_text(root, './/gmd:distributionInfo/gmd:MD_Distribution/gmd:transferOptions/gmd:MD_DigitalTransferOptions/gmd:transferSize/gco:Real'),
-        'lineageStatement': get_text(root, './/gmd:dataQualityInfo/gmd:DQ_DataQuality/gmd:lineage/gmd:LI_Lineage/gmd:statement/gco:CharacterString')
-    }
-
-    return data
+    return SummaryRecord(**{field.name: get_text(field.path) for field in SUMMARY_FIELDS if field.path})
 
-def write_to_excel(data_list, output_file):
+MISSING_METADATA_HEADERS = ["layer_id", "layer_title", "layer_url", "__license_type", "__license_url", "__is_public"]
+
+
+def summary_row(data):
     """
-    Write a metadata summary to an excel Workbook
+    Return the metadata summary (a SummaryRecord or
+    dict) as a row in the order of SUMMARY_HEADERS
+    """
+
+    if not isinstance(data, SummaryRecord):
+        data = SummaryRecord.from_mapping(data)
+    return data.row()
+
+
+class WorkbookWriter():
+    """
+    Stream rows to an excel Workbook as they are appended.
+    The workbook is write only so rows are written out rather
+    than held in memory, and the file is saved on close
+    """
+
+    def __init__(self, output_file, headers):
+        import openpyxl
+
+        self.output_file = output_file
+        self.row_count = 0
+        self._lock = threading.Lock()
+        self._workbook = openpyxl.Workbook(write_only=True)
+        self._sheet = self._workbook.create_sheet()
+        self._sheet.append(headers)
+
+    def row(self, data):
+        return data
+
+    def append(self, data):
+        row = self.row(data)
+        with self._lock:
+            self._sheet.append(row)
+            self.row_count += 1
+
+    def close(self):
+        with self._lock:
+            self._workbook.save(self.output_file)
+
+
+class SummaryWriter(WorkbookWriter):
+    """
+    Stream metadata summaries (as returned by parse_xml_file
+    plus the layer fields) to the summary workbook
+    """
+
+    def __init__(self, output_file):
+        super(SummaryWriter, self).__init__(output_file, SUMMARY_HEADERS)
+
+    def row(self, data):
+        return summary_row(data)
+
+
+class MissingMetadataWriter(WorkbookWriter):
+    """
+    Stream the layers found without metadata to a workbook
+    """
+
+    def __init__(self, output_file):
+        super(MissingMetadataWriter, self).__init__(output_file, MISSING_METADATA_HEADERS)
+
+    def row(self, entry):
+        return [entry.get(header) for header in MISSING_METADATA_HEADERS]
+
+    def close(self):
+        try:
+            super(MissingMetadataWriter, self).close()
+        except Exception as e:
+            print(f"Failed to write to Excel: {e}")
+
+
+class WriterGroup():
+    """
+    Append to and close several writers as one, i.e. to stream
+    summaries to the workbook and the analytics column store
     """
 
-    workbook = openpyxl.Workbook()
-    sheet = workbook.active
+    def __init__(self, *writers):
+        self.writers = writers
 
-    headers = [
-        '__layer_id' , 'Language', 'Hierarchy Level', 'Hierarchy Level Name', 'Individual Name', 'Organisation Name',
-        'Position Name', 'Phone', 'Email', 'Address', 'City', 'Postal Code', 'Country', 'Abstract',
-        'Title', 'Purpose', 'Credit', 'Status', 'Date Stamp', 'Metadata Standard Name',
-        'Metadata Standard Version', 'Environment Description', 'Topology Level', 'Geometric Object Type',
-        'Geometric Object Count', 'Reference System Code', 'Reference System Code Space', 'Reference System Version',
-        'Keyword', 'Use Limitation', 'Spatial Representation Type', 'Distance', 'Character Set',
-        'Topic Category', 'Extent Type Code', 'West Bound Longitude', 'East Bound Longitude', 'South Bound Latitude',
-        'North Bound Latitude', 'Distribution Format Name', 'Distribution Format Version', 'Transfer Size', 
-        'Lineage Statement', '__license_type', '__license_url', '__num_downloads', '__first_published_at', '__is_public'
-    ]
+    def append(self, data):
+        for writer in self.writers:
+            writer.append(data)
 
+    def close(self):
+        for writer in self.writers:
+            writer.close()
 
 
-    sheet.append(headers)
+def write_to_excel(data_list, output_file):
+    """
+    Write a metadata summary to an excel Workbook
+    """
 
+    writer = SummaryWriter(output_file)
     for data in data_list:
-        row = [
-            data['__layer_id'],
-            data['language'],
-            data['hierarchyLevel'],
-            data['hierarchyLevelName'],
-            data['individualName'],
-            data['organisationName'],
-            data['positionName'],
-            data['phone'],
-            data['email'],
-            data['address'],
-            data['city'],
-            data['postalCode'],
-            data['country'],
-            data['abstract'],
-            data['title'],
-            data['purpose'],
-            data['credit'],
-            data['status'],
-            data['dateStamp'],
-            data['metadataStandardName'],
-            data['metadataStandardVersion'],
-            data['environmentDescription'],
-            data['topologyLevel'],
-            data['geometricObjectType'],
-            data['geometricObjectCount'],
-            data['referenceSystemCode'],
-            data['referenceSystemCodeSpace'],
-            data['referenceSystemVersion'],
-            data['keyword'],
-            data['useLimitation'],
-            data['spatialRepresentationType'],
-            data['distance'],
-            data['characterSet'],
-            data['topicCategory'],
-            data['extentTypeCode'],
-            data['westBoundLongitude'],
-            data['eastBoundLongitude'],
-            data['southBoundLatitude'],
-            data['northBoundLatitude'],
-            data['distributionFormatName'],
-            data['distributionFormatVersion'],
-            data['transferSize'],
-            data['lineageStatement'],
-            data['__license_type'],
-            data['__license_url'],
-            data['__num_downloads'] ,
-            data['__first_published_at'],
-            str(data['__is_public'])
-        ]
-        sheet.append(row)
-
-    workbook.save(output_file)
+        writer.append(data)
+    writer.close()
 
 
 def record_missing_metadata(data, missing_metadata_file):
@@ -153,17 +286,11 @@ def record_missing_metadata(data, missing_metadata_file):
     Record information in a spread sheet for any layers found
     that have not metadata attached
     """
-    headers = ["layer_id", "layer_title", "layer_url", "__license_type", "__license_url", "__is_public"]
 
     try:
-        workbook = openpyxl.Workbook()
-        sheet = workbook.active
-        sheet.append(headers)  # Add header
-
+        writer = MissingMetadataWriter(missing_metadata_file)
         for entry in data:
-            row = [entry.get(header) for header in headers]
-            sheet.append(row)
-        
-        workbook.save(missing_metadata_file)
+            writer.append(entry)
+        writer.close()
     except Exception as e:
-        print(f"Failed to write to Excel: {e}")
\ No newline at end of file
+        print(f"Failed to write to Excel: {e}")
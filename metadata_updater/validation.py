@@ -0,0 +1,100 @@
+################################################################################
+#
+# Copyright 2018 Crown copyright (c)
+# Land Information New Zealand and the New Zealand Government.
+# All rights reserved
+#
+# This program is released under the terms of the new BSD license. See the
+# LICENSE file for more information.
+#
+################################################################################
+
+"""
+Local validation of edited metadata documents against an XML schema
+(e.g. the ISO 19139 gmd.xsd) and optionally a Schematron, so a
+document broken by a mapping is rejected before a draft is created
+rather than by the Data Service after it
+"""
+
+import threading
+
+from lxml import etree as ET
+
+# Compiled schemas by (schema file, schematron file), shared by every
+# Validator in the process. Each entry has a lock as a compiled schema
+# keeps the error log of its last validation
+_compiled = {}
+_compiled_lock = threading.Lock()
+
+# Errors reported for an invalid document
+MAX_ERRORS = 10
+
+SVRL_NAMESPACES = {'svrl': 'http://purl.oclc.org/dsdl/svrl'}
+
+
+def compile_schemas(schema_file, schematron_file=None):
+    """
+    Return the (XMLSchema, Schematron, lock) for the files, compiling
+    them on first use in the process. A missing or invalid file
+    is a config error
+    """
+
+    key = (schema_file, schematron_file)
+    with _compiled_lock:
+        if key not in _compiled:
+            try:
+                schema = ET.XMLSchema(ET.parse(schema_file)) if schema_file else None
+                schematron = None
+                if schematron_file:
+                    from lxml import isoschematron
+
+                    schematron = isoschematron.Schematron(ET.parse(schematron_file), store_report=True)
+            except OSError as e:
+                raise SystemExit('CONFIG ERROR: Validation schema could not be read: {0}'.format(e))
+            except (ET.XMLSyntaxError, ET.XMLSchemaParseError, ET.SchematronParseError) as e:
+                raise SystemExit('CONFIG ERROR: Validation schema is not valid: {0}'.format(e))
+            _compiled[key] = (schema, schematron, threading.Lock())
+        return _compiled[key]
+
+
+class Validator():
+    """
+    Validates documents against the schema and Schematron. The
+    compiled schemas are shared by all threads of the process and,
+    as they can not be pickled, compiled once in each transform
+    worker process the Validator is sent to
+    """
+
+    def __init__(self, schema_file=None, schematron_file=None):
+        self.schema_file = schema_file
+        self.schematron_file = schematron_file
+
+    def compile(self):
+        return compile_schemas(self.schema_file, self.schematron_file)
+
+    def validate(self, file):
+        """
+        Return the validation errors of the document
+        file, an empty list if it is valid
+        """
+
+        schema, schematron, lock = self.compile()
+        try:
+            tree = ET.parse(file, ET.XMLParser(huge_tree=True))
+        except ET.XMLSyntaxError as e:
+            return ['not well formed: {0}'.format(e)]
+
+        errors = []
+        with lock:
+            if schema is not None and not schema.validate(tree):
+                errors.extend('line {0}: {1}'.format(entry.line, entry.message)
+                              for entry in schema.error_log)
+            if schematron is not None and not schematron.validate(tree):
+                report = schematron.validation_report
+                for failed in report.iterfind('.//svrl:failed-assert', SVRL_NAMESPACES):
+                    text = ' '.join(failed.findtext('svrl:text', '', SVRL_NAMESPACES).split())
+                    errors.append('{0}: {1}'.format(failed.get('location'), text))
+        return errors[:MAX_ERRORS]
+
+    def __repr__(self):
+        return 'Validator({0!r}, {1!r})'.format(self.schema_file, self.schematron_file)
@@ -14,7 +14,7 @@ setup(
     author="splanzer",
     author_email="splanzer@linz.govt.nz",
     url="https://github.com/linz/lds-metadata-updater",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks"]),
     package_data={
         # Include .yml files in dist-packaging
         "lds-metadata-updater": ["*.yml"],
@@ -22,10 +22,16 @@ setup(
     include_package_data=True,
     entry_points={
         "console_scripts": [
-            "metadata_updater=metadata_updater:main"
+            "metadata_updater=metadata_updater:main",
+            "metadata_updater_report=metadata_updater.analytics:main",
+            "metadata_updater_store=metadata_updater.store:main"
         ],
     },
     install_requires=requirements,
+    extras_require={
+        "analytics": ["numpy"],
+        "regex": ["regex"],
+    },
     classifiers=[
         "Development Status :: 4 - Beta",
         "Environment :: Console",
@@ -0,0 +1,26 @@
+<?xml version="1.0" encoding="UTF-8"?>
+<!-- Replaces the legal constraints of CC3 licensed metadata with the licence parameter -->
+<xsl:stylesheet version="1.0"
+    xmlns:xsl="http://www.w3.org/1999/XSL/Transform"
+    xmlns:gmd="http://www.isotc211.org/2005/gmd"
+    xmlns:gco="http://www.isotc211.org/2005/gco">
+
+  <xsl:param name="licence" select="'Released under Creative Commons Attribution 4.0 International'"/>
+
+  <xsl:template match="@*|node()">
+    <xsl:copy>
+      <xsl:apply-templates select="@*|node()"/>
+    </xsl:copy>
+  </xsl:template>
+
+  <xsl:template match="gmd:resourceConstraints[gmd:MD_LegalConstraints/gmd:useLimitation/gco:CharacterString[contains(., 'Creative Commons Attribution 3.0')]]">
+    <gmd:resourceConstraints>
+      <gmd:MD_LegalConstraints>
+        <gmd:useLimitation><gco:CharacterString><xsl:value-of select="$licence"/></gco:CharacterString></gmd:useLimitation>
+        <gmd:useConstraints><gmd:MD_RestrictionCode codeList="http://asdd.ga.gov.au/asdd/profileinfo/gmxCodelists.xml#MD_RestrictionCode" codeListValue="license">license</gmd:MD_RestrictionCode></gmd:useConstraints>
+        <gmd:otherConstraints><gco:CharacterString>https://creativecommons.org/licenses/by/4.0/</gco:CharacterString></gmd:otherConstraints>
+      </gmd:MD_LegalConstraints>
+    </gmd:resourceConstraints>
+  </xsl:template>
+
+</xsl:stylesheet>
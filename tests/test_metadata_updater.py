@@ -6,11 +6,51 @@ import os
 import shutil
 import types
 import logging
+import logging.handlers
 import argparse
+import json
+import threading
+import koordinates
+from lxml import etree as ET
+import tempfile
+import time
+import io
+import re
+import contextlib
+import datetime
+import importlib.util
+from unittest import mock
 
 sys.path.append('../')  
 from metadata_updater import metadata_updater
 from metadata_updater import log
+from metadata_updater import run_context
+from metadata_updater import service
+from metadata_updater import rules
+from metadata_updater import transform
+from metadata_updater import streaming
+from metadata_updater import layout
+from metadata_updater import profiling
+from metadata_updater import analytics
+from metadata_updater import store
+from metadata_updater import sharding
+from metadata_updater import concurrency
+from metadata_updater import compression
+from metadata_updater import validation
+from metadata_updater import publish_tracker
+from metadata_updater import priority
+from metadata_updater import pipeline
+from metadata_updater.utils import xml_to_excel
+try:
+    from benchmarks import import_time
+    from benchmarks import corpus
+    from benchmarks import mock_service
+except ImportError:
+    # benchmarks (the document corpus and mock Data Service) is not
+    # installed with the package, only present in a source checkout
+    import_time = corpus = mock_service = None
+
+requires_benchmarks = unittest.skipIf(mock_service is None, 'benchmarks is not importable')
 
 # These tests make no API calls but rely on data in the
 # /test/data dir
@@ -207,6 +247,1558 @@ class TestMetadataUpdaterSelectiveLayers(unittest.TestCase):
         gen = metadata_updater.iterate_selective([123, 456, 789])
         self.assertEqual(list(gen), [123, 456, 789])
 
+class TestMetadataUpdaterRunContext(unittest.TestCase):
+
+    def test_run_context_concurrent_counts(self):
+        """
+        Test counters are not lost when updated
+        from many threads at once
+        """
+
+        context = run_context.RunContext()
+
+        def work():
+            for _ in range(1000):
+                context.add_layer()
+                context.add_error()
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(context.layer_count, 8000)
+        self.assertEqual(context.errors, 8000)
+
+    def test_run_context_failure_not_overwritten(self):
+        """
+        Test a layer recorded as failed is not 
+        later reported with another outcome
+        """
+
+        context = run_context.RunContext()
+        context.add_error(123, 'get_draft', 'draft is in a publish group')
+        context.record_outcome(123, run_context.UNCHANGED)
+        self.assertEqual(context.outcomes[123].outcome, run_context.FAILED)
+        self.assertEqual(context.outcome_counts(), {run_context.FAILED: 1})
+
+    def test_runs_do_not_share_state(self):
+        """
+        Test errors in one run are not 
+        counted against another
+        """
+
+        class Draft():
+            id = 123
+            version = types.SimpleNamespace(id=1)
+            def set_metadata(self, *args, **kwargs):
+                raise koordinates.exceptions.ServerError('504')
+
+        file = os.path.join(os.getcwd(), 'data/TEST_metadata_file.iso.xml')
+        context_a, context_b = run_context.RunContext(), run_context.RunContext()
+        self.assertFalse(metadata_updater.post_metadata(Draft(), file, context_a))
+        self.assertEqual(context_a.errors, 1)
+        self.assertEqual(context_b.errors, 0)
+        self.assertEqual(context_a.outcomes[123].stage, 'post_metadata')
+
+class FakeLayer():
+    """
+    Stand in for a koordinates layer that serves
+    the test metadata file
+    """
+
+    def __init__(self, id, source):
+        self.id = id
+        self.type = 'layer'
+        self.title = 'test layer {0}'.format(id)
+        self.url = 'https://example.com/layers/{0}/'.format(id)
+        self.license = None
+        self.public_access = None
+        self.num_downloads = 0
+        self.first_published_at = datetime.date(2018, 1, 1)
+        self.metadata = types.SimpleNamespace(
+            get_xml=lambda destination: shutil.copyfile(source, destination))
+
+class FakeClient():
+    """
+    Stand in for the koordinates client
+    """
+
+    def __init__(self, source):
+        self.layers = types.SimpleNamespace(get=lambda id: FakeLayer(int(id), source))
+
+class RunnerTestCase(unittest.TestCase):
+    """
+    Dry run config and fake client for tests that run layers
+    """
+
+    def setUp(self):
+        self.destination_dir = tempfile.mkdtemp()
+        self.config = {
+            'Connection': {'Api_key': 'peanutbutter', 'Domain': 'example.com'},
+            'Text': {'Mapping': {1: {'search': 'Kelp', 'replace': 'Seaweed',
+                                     'ignore_case': False, 'target_element': None}}},
+            'Output': {'Destination': self.destination_dir},
+            'Datasets': {'Layers': [1, 2]},
+            'Test': {'Dry_run': True, 'Overwrite_files': True}
+        }
+        self.client = FakeClient(os.path.join(os.getcwd(), 'data/TEST_metadata_file.iso.xml'))
+
+    def tearDown(self):
+        shutil.rmtree(self.destination_dir)
+
+class TestMetadataUpdaterRunner(RunnerTestCase):
+
+    def test_config_from_dict(self):
+        """
+        Test a config can be created from a dict
+        """
+
+        config = metadata_updater.ConfigReader.from_dict(self.config)
+        self.assertEqual(config.layers, [1, 2])
+        self.assertEqual(config.test_dry_run, True)
+        self.assertEqual(config.summarise, False)
+
+    def test_config_layer_ids(self):
+        """
+        Test the Layers ids are read as ints and
+        anything else is logged and skipped
+        """
+
+        self.config['Datasets']['Layers'] = ['1', 'abc', 2]
+        result = metadata_updater.Runner(self.config, self.client).run()
+        self.assertEqual([o['layer_id'] for o in result.outcomes], [1, 2])
+
+    def test_runner_dry_run(self):
+        """
+        Test a dry run edits the files and 
+        returns the outcome for each layer 
+        """
+
+        result = metadata_updater.Runner(self.config, self.client).run()
+        self.assertEqual(result.layer_count, 2)
+        self.assertEqual(result.errors, 0)
+        self.assertEqual(sorted(o['outcome'] for o in result.outcomes), 
+                         [run_context.DRY_RUN, run_context.DRY_RUN])
+        edited = os.path.join(self.destination_dir, 'layer_1_test layer 1.iso.xml')
+        self.assertFalse(metadata_updater.file_has_text('Kelp', False, edited))
+        self.assertTrue(os.path.isfile(edited + '._bak'))
+
+    def test_runner_concurrent(self):
+        """
+        Test runs with network threads and transform
+        processes give the same outcomes
+        """
+
+        self.config['Performance'] = {'Transform_workers': 2, 'Network_workers': 2}
+        self.config['Datasets']['Layers'] = [1, 2, 3, 4, 5]
+        with metadata_updater.Runner(self.config, self.client) as runner:
+            result = runner.run()
+        self.assertEqual(result.layer_count, 5)
+        self.assertEqual([o['outcome'] for o in result.outcomes], [run_context.DRY_RUN] * 5)
+
+    def test_runner_streaming(self):
+        """
+        Test files at or above the streaming threshold
+        are streamed to the edited file
+        """
+
+        self.config['Performance'] = {'Streaming_threshold_mb': 0}
+        result = metadata_updater.Runner(self.config, self.client).run([1])
+        self.assertEqual([o['outcome'] for o in result.outcomes], [run_context.DRY_RUN])
+        edited = os.path.join(self.destination_dir, 'layer_1_test layer 1.iso.xml')
+        self.assertFalse(metadata_updater.file_has_text('Kelp', False, edited))
+        self.assertFalse(os.path.exists(edited + '.edited'))
+
+    def test_runner_sharded_layout(self):
+        """
+        Test documents are written to hashed subdirectories
+        and resolved through the output manifest
+        """
+
+        self.config['Output']['Layout'] = 'sharded'
+        metadata_updater.Runner(self.config, self.client).run()
+        manifest = layout.load_manifest(self.destination_dir)
+        self.assertEqual(sorted(manifest), [1, 2])
+        for layer_id, entry in manifest.items():
+            file = layout.resolve(self.destination_dir, layer_id)
+            self.assertEqual(file, os.path.join(self.destination_dir, layout.bucket(layer_id),
+                                                'layer_{0}.iso.xml'.format(layer_id)))
+            self.assertTrue(os.path.isfile(file + '._bak'))
+            self.assertEqual(entry['sha1'], layout.file_sha1(file))
+            self.assertEqual(entry['title'], 'test layer {0}'.format(layer_id))
+        self.assertIsNone(layout.resolve(self.destination_dir, 3))
+
+    def test_output_manifest_kept_across_runs(self):
+        """
+        Test each run adds its layers to the output manifest
+        """
+
+        runner = metadata_updater.Runner(self.config, self.client)
+        runner.run([1])
+        runner.run([2])
+        self.assertEqual(layout.resolve(self.destination_dir, 1),
+                         os.path.join(self.destination_dir, 'layer_1_test layer 1.iso.xml'))
+        self.assertEqual(sorted(layout.load_manifest(self.destination_dir)), [1, 2])
+
+    def test_moved_documents_replaced(self):
+        """
+        Test a layer's document from an earlier run, found through
+        the output manifest, is removed when the layout changes
+        """
+
+        metadata_updater.Runner(self.config, self.client).run([1])
+        flat_file = layout.resolve(self.destination_dir, 1)
+        self.assertTrue(os.path.isfile(flat_file))
+        self.config['Output']['Layout'] = 'sharded'
+        metadata_updater.Runner(self.config, self.client).run([1])
+        self.assertFalse(os.path.exists(flat_file))
+        self.assertFalse(os.path.exists(flat_file + '._bak'))
+        sharded_file = layout.resolve(self.destination_dir, 1)
+        self.assertEqual(os.path.dirname(sharded_file), os.path.join(self.destination_dir, layout.bucket(1)))
+        self.assertTrue(os.path.isfile(sharded_file))
+
+    def test_runner_repeat_runs(self):
+        """
+        Test each run returns its own result
+        """
+
+        runner = metadata_updater.Runner(self.config, self.client)
+        first = runner.run([1])
+        second = runner.run([1, 2])
+        self.assertEqual(first.layer_count, 1)
+        self.assertEqual(second.layer_count, 2)
+
+class TestMetadataUpdaterValidation(RunnerTestCase):
+
+    def setUp(self):
+        super(TestMetadataUpdaterValidation, self).setUp()
+        self.config['Validation'] = {'Schema': os.path.join(os.getcwd(), 'data/md_metadata.xsd'),
+                                     'Schematron': os.path.join(os.getcwd(), 'data/md_metadata.sch')}
+        with open('data/TEST_metadata_file.iso.xml') as f:
+            self.text = f.read()
+
+    def validate(self, text):
+        file = os.path.join(self.destination_dir, 'document.xml')
+        with open(file, 'w') as f:
+            f.write(text)
+        return validation.Validator(self.config['Validation']['Schema'],
+                                    self.config['Validation']['Schematron']).validate(file)
+
+    def test_validator(self):
+        """
+        Test schema, schematron and well formedness
+        errors are reported
+        """
+
+        self.assertEqual(self.validate(self.text), [])
+        errors = self.validate(self.text.replace('gmd:fileIdentifier', 'gmd:fileIdentifer'))
+        self.assertEqual(len(errors), 2)
+        self.assertIn('fileIdentifer', errors[0])
+        self.assertIn('The metadata must have a file identifier', errors[1])
+        errors = self.validate(self.text.replace('</gmd:MD_Metadata>', ''))
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith('not well formed'))
+
+    def test_runner_rejects_invalid(self):
+        """
+        Test an edit that breaks the document is rejected
+        before any draft is created
+        """
+
+        self.config['Text']['Mapping'][2] = {'search': 'gmd:fileIdentifier', 'replace': 'gmd:fileId'}
+        self.config['Output']['Diff_report'] = True
+        result = metadata_updater.Runner(self.config, self.client).run()
+        self.assertEqual(result.errors, 2)
+        self.assertEqual([(o['outcome'], o['stage']) for o in result.outcomes],
+                         [(run_context.INVALID, 'validate')] * 2)
+        self.assertTrue(all(o['message'] for o in result.outcomes))
+        # Rejected edits are not in the change report
+        self.assertEqual(os.path.getsize(os.path.join(self.destination_dir, 'metadata_changes.jsonl')), 0)
+
+    def test_runner_validates_in_workers(self):
+        """
+        Test valid edits pass validation in the
+        transform worker processes
+        """
+
+        self.config['Performance'] = {'Transform_workers': 2, 'Network_workers': 2}
+        with metadata_updater.Runner(self.config, self.client) as runner:
+            result = runner.run()
+        self.assertEqual(result.errors, 0)
+        self.assertEqual([o['outcome'] for o in result.outcomes], [run_context.DRY_RUN] * 2)
+
+    def test_invalid_schema(self):
+        """
+        Test a missing or invalid schema is a config error
+        """
+
+        for schema in ('data/missing.xsd', 'data/TEST_metadata_file.iso.xml'):
+            self.config['Validation'] = {'Schema': schema}
+            with self.assertRaises(SystemExit):
+                metadata_updater.Runner(self.config, self.client)
+
+class TestMetadataUpdaterDiffReport(RunnerTestCase):
+
+    def test_dry_run_diff_report(self):
+        """
+        Test a dry run writes the changes made to each
+        layer to the JSON lines and HTML reports
+        """
+
+        self.config['Output']['Diff_report'] = True
+        metadata_updater.Runner(self.config, self.client).run()
+        with open(os.path.join(self.destination_dir, 'metadata_changes.jsonl')) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(sorted({record['layer_id'] for record in records}), [1, 2])
+        self.assertTrue(all(record['rule_id'] == 1 for record in records))
+        self.assertTrue(all('Seaweed' in record['new'] for record in records))
+        with open(os.path.join(self.destination_dir, 'metadata_changes.html')) as f:
+            report = f.read()
+        self.assertIn('Metadata changes: dry run', report)
+        self.assertIn('{0} change(s) to 2 layer(s)'.format(len(records)), report)
+
+class TestMetadataUpdaterSharding(unittest.TestCase):
+
+    def test_parse_shard(self):
+        """
+        Test --shard K/N is parsed and validated
+        """
+
+        self.assertEqual(metadata_updater.parse_args(['--shard', '3/8']).shard, sharding.Shard(3, 8))
+        for text in ('0/8', '9/8', 'three'):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                sharding.parse_shard(text)
+
+    def test_shards_partition_layers(self):
+        """
+        Test every layer is in exactly one shard
+        """
+
+        layer_ids = list(range(1, 1001))
+        shards = [list(sharding.shard_layer_ids(layer_ids, sharding.Shard(index, 4)))
+                  for index in range(1, 5)]
+        self.assertEqual(sorted(sum(shards, [])), layer_ids)
+        self.assertTrue(all(150 < len(shard) < 350 for shard in shards))
+        self.assertEqual(sharding.shard_of(93639, 8), sharding.shard_of('93639', 8))
+
+class TestMetadataUpdaterAdaptiveLimiter(unittest.TestCase):
+
+    def complete(self, limiter, count, error=False):
+        """
+        Complete count requests, keeping as many in
+        flight as the limit allows
+        """
+
+        starts = []
+        for _ in range(count):
+            while len(starts) < limiter.limit:
+                starts.append(limiter.acquire())
+            limiter.release(starts.pop(0), error)
+        for started in starts:
+            limiter.release(started, error)
+
+    def test_increase_while_healthy(self):
+        """
+        Test the limit rises by one per limit's worth of
+        successful requests, up to the maximum
+        """
+
+        limiter = concurrency.AdaptiveLimiter(minimum=2, maximum=6, latency_target=10)
+        self.complete(limiter, 2)
+        self.assertEqual(limiter.limit, 3)
+        self.complete(limiter, 100)
+        self.assertEqual(limiter.limit, 6)
+        self.assertEqual(limiter.stats()['peak_limit'], 6)
+
+    def test_decrease_once_per_window(self):
+        """
+        Test errors halve the limit, only once for requests
+        started before the decrease, and not below the minimum
+        """
+
+        limiter = concurrency.AdaptiveLimiter(minimum=2, maximum=32, initial=16, latency_target=10)
+        starts = [limiter.acquire() for _ in range(16)]
+        for started in starts:
+            limiter.release(started, error=True)
+        self.assertEqual(limiter.limit, 8)
+        self.assertEqual(limiter.decreases, 1)
+        for _ in range(5):
+            limiter.release(limiter.acquire(), error=True)
+        self.assertEqual(limiter.limit, 2)
+
+    def test_decrease_on_latency(self):
+        """
+        Test the limit is cut when latency exceeds the target
+        """
+
+        limiter = concurrency.AdaptiveLimiter(minimum=1, maximum=8, initial=8, latency_target=0)
+        limiter.release(limiter.acquire())
+        self.assertEqual(limiter.limit, 4)
+
+    def test_no_latency_decrease_without_target(self):
+        """
+        Test, with no latency target, slow requests among
+        fast ones do not cut the limit but errors do
+        """
+
+        limiter = concurrency.AdaptiveLimiter(minimum=1, maximum=8, initial=8)
+        for latency in [0.01, 0.5] * 20:
+            limiter.acquire()
+            limiter.release(time.monotonic() - latency)
+        self.assertEqual(limiter.decreases, 0)
+        limiter.release(limiter.acquire(), error=True)
+        self.assertEqual(limiter.decreases, 1)
+
+    def test_acquire_blocks_at_limit(self):
+        """
+        Test no more than limit requests are in flight
+        """
+
+        limiter = concurrency.AdaptiveLimiter(minimum=1, maximum=1)
+        started = limiter.acquire()
+        acquired = threading.Event()
+        thread = threading.Thread(target=lambda: (limiter.acquire(), acquired.set()))
+        thread.start()
+        self.assertFalse(acquired.wait(0.05))
+        limiter.release(started)
+        self.assertTrue(acquired.wait(1))
+        thread.join()
+
+class TestMetadataUpdaterProfiling(RunnerTestCase):
+
+    def test_parse_args_profile(self):
+        """
+        Test --profile accepts cpu, memory and both
+        """
+
+        self.assertEqual(metadata_updater.parse_args(['--profile', 'both']).profile, 'both')
+        self.assertIsNone(metadata_updater.parse_args([]).profile)
+
+    def test_profile_run(self):
+        """
+        Test profiling a run writes the profiles and
+        attributes time and memory to the stages
+        """
+
+        with profiling.Profiler('both', self.destination_dir):
+            metadata_updater.Runner(self.config, self.client).run()
+        for name in ('profile_cpu.pstats', 'profile_cpu.txt', 'profile_cpu.collapsed',
+                     'profile_memory.txt', 'profile_memory.snapshot'):
+            self.assertTrue(os.path.isfile(os.path.join(self.destination_dir, name)))
+        with open(os.path.join(self.destination_dir, 'profile_stages.json')) as f:
+            stages = json.load(f)['stages']
+        self.assertEqual(stages['update_metadata']['count'], 2)
+        self.assertEqual(stages['get_layer']['outcomes'], {'ok': 2})
+
+class TestMetadataUpdaterSummaryRecord(unittest.TestCase):
+
+    def test_parse_xml_file(self):
+        """
+        Test the metadata is extracted to a SummaryRecord
+        that can be read by attribute and by key
+        """
+
+        record = xml_to_excel.parse_xml_file('data/TEST_metadata_file.iso.xml')
+        self.assertIsInstance(record, xml_to_excel.SummaryRecord)
+        self.assertFalse(hasattr(record, '__dict__'))
+        self.assertEqual(record.title, 'Weed/Kelp polygons (Hydro, 1:4k - 1:22k)')
+        self.assertEqual(record['title'], record.title)
+        self.assertIsNone(record['__layer_id'])
+
+    def test_summary_row(self):
+        """
+        Test the row follows the headers for records and dicts
+        """
+
+        record = xml_to_excel.SummaryRecord(layer_id=5, title='Kelp', is_public=True)
+        record['__license_type'] = 'cc-by'
+        row = record.row()
+        self.assertEqual(len(row), len(xml_to_excel.SUMMARY_HEADERS))
+        self.assertEqual(row[xml_to_excel.SUMMARY_HEADERS.index('__layer_id')], 5)
+        self.assertEqual(row[xml_to_excel.SUMMARY_HEADERS.index('Title')], 'Kelp')
+        self.assertEqual(row[xml_to_excel.SUMMARY_HEADERS.index('__license_type')], 'cc-by')
+        self.assertEqual(row[xml_to_excel.SUMMARY_HEADERS.index('__is_public')], 'True')
+        self.assertEqual(xml_to_excel.summary_row(dict(record)), row)
+
+def numpy():
+    import numpy
+
+    return numpy
+
+class TestMetadataUpdaterAnalytics(RunnerTestCase):
+
+    def summaries(self):
+        return [
+            {'__layer_id': 1, 'organisationName': 'LINZ', '__license_type': 'cc-by',
+             'useLimitation': 'Creative Commons Attribution 3.0 New Zealand',
+             'westBoundLongitude': '166.0', 'eastBoundLongitude': '179.0',
+             'southBoundLatitude': '-48.0', 'northBoundLatitude': '-34.0', '__num_downloads': 10},
+            {'__layer_id': 2, 'organisationName': 'LINZ', '__license_type': 'cc-by',
+             'useLimitation': 'Creative Commons Attribution 4.0 International',
+             'westBoundLongitude': '', 'eastBoundLongitude': '', 'southBoundLatitude': '',
+             'northBoundLatitude': '', '__num_downloads': 30},
+            {'__layer_id': 3, 'organisationName': 'DOC', '__license_type': None,
+             'useLimitation': '', 'westBoundLongitude': '172.1', 'eastBoundLongitude': '172.5',
+             'southBoundLatitude': '-41.2', 'northBoundLatitude': 'n/a', '__num_downloads': 0}
+        ]
+
+    def columns(self):
+        directory = os.path.join(self.destination_dir, analytics.SUMMARY_COLUMNS_DIR)
+        store = analytics.ColumnStore(directory, chunk_rows=2)
+        for data in self.summaries():
+            store.append(data)
+        store.close()
+        return directory
+
+    @unittest.skipUnless(importlib.util.find_spec('numpy'), 'numpy is not installed')
+    def test_column_store_round_trip(self):
+        """
+        Test the summaries are written column wise in
+        chunks and loaded back as arrays
+        """
+
+        directory = self.columns()
+        self.assertEqual(sorted(os.listdir(directory)),
+                         ['chunk-00000.npz', 'chunk-00001.npz', analytics.COLUMNS_INDEX_FILE])
+        columns = analytics.ColumnStore.load(directory)
+        self.assertEqual(columns.row_count, 3)
+        self.assertEqual(columns.fields, xml_to_excel.SUMMARY_KEYS)
+        self.assertEqual(columns.text_values(numpy(), 'organisationName').tolist(),
+                         ['LINZ', 'LINZ', 'DOC'])
+        self.assertEqual(columns.columns['__num_downloads'].tolist(), [10.0, 30.0, 0.0])
+        rows = list(columns.rows())
+        self.assertEqual(rows[2]['useLimitation'], '')
+        self.assertIsNone(rows[2]['northBoundLatitude'])
+
+    def test_summarise_without_analytics(self):
+        """
+        Test the summary columns are only written
+        if analytics are configured
+        """
+
+        self.config['Summarise'] = {'Summarise_metadata': True}
+        metadata_updater.Runner(self.config, self.client).run()
+        self.assertTrue(os.path.isfile(os.path.join(self.destination_dir, 'metadata_summary.xlsx')))
+        self.assertFalse(os.path.exists(os.path.join(self.destination_dir,
+                                                     analytics.SUMMARY_COLUMNS_DIR)))
+
+    @unittest.skipUnless(importlib.util.find_spec('numpy'), 'numpy is not installed')
+    def test_summarise_columns_only(self):
+        """
+        Test a summarise run saves the summary columns
+        and skips the workbook if Summary_excel is False
+        """
+
+        self.config['Summarise'] = {'Summarise_metadata': True, 'Summary_excel': False,
+                                    'Analytics': True}
+        metadata_updater.Runner(self.config, self.client).run()
+        self.assertFalse(os.path.isfile(os.path.join(self.destination_dir, 'metadata_summary.xlsx')))
+        columns = analytics.ColumnStore.load(os.path.join(self.destination_dir,
+                                                          analytics.SUMMARY_COLUMNS_DIR))
+        self.assertEqual(columns.text_values(numpy(), '__layer_id').tolist(), ['1', '2'])
+        self.assertIn('useLimitation', columns.fields)
+
+    @unittest.skipUnless(importlib.util.find_spec('numpy'), 'numpy is not installed')
+    def test_report(self):
+        """
+        Test the report's completeness, statistics, counts,
+        cross tabulation, bounding boxes and search
+        """
+
+        columns = analytics.ColumnStore.load(self.columns())
+        result = analytics.report(columns, search_pattern=r'Attribution 3\.0',
+                                  search_fields=['useLimitation'])
+        self.assertEqual(result['layer_count'], 3)
+        self.assertEqual(result['fields']['__license_type']['filled'], 2)
+        self.assertEqual(result['fields']['organisationName']['distinct'], 2)
+        self.assertEqual(result['numeric']['__num_downloads']['max'], 30.0)
+        self.assertEqual(result['numeric']['northBoundLatitude']['count'], 1)
+        self.assertEqual(result['value_counts']['organisationName'], [('LINZ', 2), ('DOC', 1)])
+        self.assertEqual(result['crosstab']['counts'],
+                         {'LINZ': {'cc-by': 2}, 'DOC': {'(none)': 1}})
+        self.assertEqual(result['missing_bounding_box'], ['2', '3'])
+        self.assertEqual(result['search']['layer_ids'], ['1'])
+
+    @unittest.skipUnless(importlib.util.find_spec('numpy'), 'numpy is not installed')
+    def test_search_text(self):
+        """
+        Test a column searched as one string finds the
+        same values as searching each value
+        """
+
+        np = numpy()
+        values = ['Creative Commons', '', 'Crown', 'ôtaki Commons 3.0', 'commons', 'C', 'ommons']
+        column = analytics.TextColumn.from_values(np, values)
+        for pattern in ['Commons', 'C.*s', '^C', 'ons$', r'\bo', '(?<=C)r', '[^,]*', 's.?$',
+                        r'\d\.\d', 'o(?!m)', '(?i)COMMONS', 'C[^x]*o']:
+            compiled = re.compile(pattern)
+            self.assertEqual(analytics.search_text(np, compiled, column).tolist(),
+                             [compiled.search(value) is not None for value in values], pattern)
+
+    @unittest.skipUnless(importlib.util.find_spec('numpy'), 'numpy is not installed')
+    def test_report_main_json(self):
+        """
+        Test the report command prints the report as JSON
+        """
+
+        directory = self.columns()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            analytics.main([directory, '--json', '--value-counts', '__license_type'])
+        result = json.loads(output.getvalue())
+        self.assertEqual(result['value_counts'], {'__license_type': [['cc-by', 2]]})
+
+    def test_report_unknown_field(self):
+        """
+        Test an unknown search field is an argument error
+        """
+
+        with contextlib.redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+            analytics.parse_args(['columns', '--search', 'x', '--search-field', 'licence'])
+
+class TestMetadataUpdaterStore(RunnerTestCase):
+
+    def setUp(self):
+        super(TestMetadataUpdaterStore, self).setUp()
+        self.store_path = os.path.join(self.destination_dir, 'metadata.sqlite')
+        self.source = 'data/TEST_metadata_file.iso.xml'
+
+    def test_run_stores_documents(self):
+        """
+        Test a run stores the downloaded metadata
+        and it can be searched by field
+        """
+
+        self.config['Store'] = {'Path': self.store_path, 'Label': 'test'}
+        metadata_updater.Runner(self.config, self.client).run()
+        with store.MetadataStore(self.store_path) as metadata_store:
+            runs = metadata_store.runs()
+            self.assertEqual([(run[2], run[3]) for run in runs], [('test', 2)])
+            self.assertEqual(sorted(row[0] for row in metadata_store.search('title: Kelp')), [1, 2])
+            self.assertEqual(metadata_store.search('title: Seaweed'), [])
+
+    def test_diff(self):
+        """
+        Test the diff of two runs finds the layers
+        added, removed and changed
+        """
+
+        edited = os.path.join(self.destination_dir, 'edited.iso.xml')
+        shutil.copyfile(self.source, edited)
+        metadata_updater.update_metadata(edited, self.config['Text']['Mapping'][1])
+        with store.MetadataStore(self.store_path) as metadata_store:
+            metadata_store.start_run()
+            metadata_store.add_document(1, self.source)
+            metadata_store.add_document(2, self.source)
+            metadata_store.start_run()
+            metadata_store.add_document(2, edited)
+            metadata_store.add_document(3, self.source)
+            diff = metadata_store.diff()
+        self.assertEqual(diff['added'], [3])
+        self.assertEqual(diff['removed'], [1])
+        self.assertEqual(list(diff['changed']), [2])
+        self.assertIn('title', diff['changed'][2]['fields'])
+
+    def test_main_search_ids(self):
+        """
+        Test the search command prints a Layers list
+        """
+
+        with store.MetadataStore(self.store_path) as metadata_store:
+            metadata_store.start_run()
+            metadata_store.add_document(7, self.source)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            store.main([self.store_path, 'search', 'organisationName: LINZ', '--ids'])
+        self.assertEqual(output.getvalue().strip(), '[7]')
+
+    def test_main_index(self):
+        """
+        Test the index command stores the documents
+        listed in a destination dir's output manifest
+        """
+
+        self.config['Output']['Layout'] = 'sharded'
+        metadata_updater.Runner(self.config, self.client).run()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            store.main([self.store_path, 'index', self.destination_dir, '--label', 'merged'])
+        self.assertEqual(output.getvalue().strip(), 'Run 1: 2 document(s)')
+        with store.MetadataStore(self.store_path) as metadata_store:
+            self.assertEqual(sorted(row[0] for row in metadata_store.search('title: Seaweed')), [1, 2])
+
+class TestMetadataUpdaterTransform(unittest.TestCase):
+
+    def setUp(self):
+        with open(os.path.join(os.getcwd(), 'data/TEST_metadata_file.iso.xml'), 'rb') as f:
+            self.data = f.read()
+        self.rules = rules.compile_rules({
+            1: {'search': 'Kelp', 'replace': 'Seaweed', 'ignore_case': False, 'target_element': None},
+            2: {'search': '.*', 'replace': 'New Title', 'ignore_case': True,
+                'target_element': './/gmd:citation/gmd:CI_Citation/gmd:title/gco:CharacterString'},
+            3: {'search': 'Gore', 'replace': 'Dunedin', 'ignore_case': True, 'target_element': None}})
+
+    def test_transform_document(self):
+        """
+        Test the rules are applied in memory and 
+        only the applied rules are reported
+        """
+
+        edited, applied = transform.transform_document(self.data, self.rules)
+        self.assertEqual(applied, [1, 2])
+        self.assertNotIn(b'Kelp', edited)
+        self.assertIn(b'<gco:CharacterString>New Title</gco:CharacterString>', edited)
+
+    def test_transform_document_unchanged(self):
+        """
+        Test None is returned when no rule applies
+        """
+
+        edited, applied = transform.transform_document(self.data, self.rules[2:])
+        self.assertIsNone(edited)
+        self.assertEqual(applied, [])
+
+    def test_transformer_process_pool(self):
+        """
+        Test documents transformed in worker processes 
+        match those transformed in process
+        """
+
+        transformer = transform.Transformer(self.rules, workers=2)
+        try:
+            futures = [transformer.submit(self.data) for _ in range(4)]
+            results = [future.result() for future in futures]
+        finally:
+            transformer.close()
+        expected = transform.transform_document(self.data, self.rules)
+        self.assertEqual(results, [expected] * 4)
+
+    def test_transform_document_changes(self):
+        """
+        Test the element and line changes made by
+        each rule are returned when requested
+        """
+
+        edited, applied, changes = transform.transform_document(self.data, self.rules, True)
+        self.assertEqual(applied, [1, 2])
+        self.assertEqual({change.rule_id for change in changes}, {1, 2})
+        line_change = changes[0]
+        self.assertIsNone(line_change.path)
+        self.assertIn('Kelp', line_change.old)
+        self.assertIn('Seaweed', line_change.new)
+        title_change = [change for change in changes if change.rule_id == 2][0]
+        self.assertTrue(title_change.path.endswith('gmd:title/gco:CharacterString'))
+        self.assertEqual(title_change.old, 'Weed/Seaweed polygons (Hydro, 1:4k - 1:22k)')
+        self.assertEqual(title_change.new, 'New Title')
+
+    def test_transform_file(self):
+        """
+        Test streaming the document gives the 
+        same edits as transforming it in memory
+        """
+
+        destination = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, destination)
+        output = os.path.join(destination, 'edited.xml')
+        edited, applied, changes = streaming.transform_file(
+            'data/TEST_metadata_file.iso.xml', output, self.rules, True)
+        expected, expected_applied, expected_changes = transform.transform_document(
+            self.data, self.rules, True)
+        self.assertEqual(edited, output)
+        self.assertEqual(applied, expected_applied)
+        self.assertEqual([change.rule_id for change in changes],
+                         [change.rule_id for change in expected_changes])
+        self.assertEqual(os.listdir(destination), ['edited.xml'])
+
+        def content(root):
+            # Streamed documents keep their formatting, in memory ones are indented
+            return [(element.tag, element.attrib, ' '.join((element.text or '').split()))
+                    for element in root.iter()]
+        with open(output, 'rb') as f:
+            self.assertEqual(content(ET.fromstring(f.read())), content(ET.fromstring(expected)))
+
+    def test_transform_file_unchanged(self):
+        """
+        Test no file is written when no rule applies
+        """
+
+        destination = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, destination)
+        edited, applied = streaming.transform_file('data/TEST_metadata_file.iso.xml',
+                                                   os.path.join(destination, 'edited.xml'),
+                                                   self.rules[2:])
+        self.assertIsNone(edited)
+        self.assertEqual(applied, [])
+        self.assertEqual(os.listdir(destination), [])
+
+    def test_find_text_nested_match(self):
+        """
+        Test the streamed text of a target element is that of
+        the first match in document order, as for a Document,
+        when matches are nested
+        """
+
+        data = (b'<gmd:MD_Metadata xmlns:gmd="http://www.isotc211.org/2005/gmd">'
+                b'<gmd:keyword>outer<gmd:keyword>inner</gmd:keyword></gmd:keyword>'
+                b'<gmd:keyword>last</gmd:keyword></gmd:MD_Metadata>')
+        destination = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, destination)
+        file = os.path.join(destination, 'nested.xml')
+        with open(file, 'wb') as f:
+            f.write(data)
+        root = transform.Document(data).tree.getroot()
+        for path in ['.//gmd:keyword', './/*', './gmd:keyword', './/gmd:keyword/gmd:keyword']:
+            self.assertEqual(streaming.find_text(file, path),
+                             root.find(path, metadata_updater.NAMESPACES).text, path)
+
+    def test_transform_file_unsupported_path(self):
+        """
+        Test rules with element paths that can not be
+        streamed are applied in memory
+        """
+
+        self.assertTrue(streaming.PathMatcher.supports('.//gmd:title/gco:CharacterString'))
+        self.assertFalse(streaming.PathMatcher.supports('.//gmd:title[1]/gco:CharacterString'))
+        rule_set = rules.compile_rules({
+            1: {'search': 'Kelp', 'replace': 'Seaweed', 'ignore_case': False,
+                'target_element': './/gmd:title[1]/gco:CharacterString'}})
+        destination = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, destination)
+        output = os.path.join(destination, 'edited.xml')
+        edited, applied = streaming.transform_file('data/TEST_metadata_file.iso.xml', output, rule_set)
+        self.assertEqual(applied, [1])
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read(), transform.transform_document(self.data, rule_set)[0])
+
+class TestMetadataUpdaterRegexGuard(RunnerTestCase):
+
+    @requires_benchmarks
+    def test_backtracking_risk(self):
+        """
+        Test patterns that will backtrack exponentially are found
+        and are a config error without a timeout, and safe
+        patterns with repeats in repeats are not
+        """
+
+        for pattern in (r'(a+)+$', r'(\w+\s?)+$', r'(.*a)*x', r'((a+)+b)+'):
+            self.assertTrue(rules.backtracking_risk(pattern).definite, pattern)
+            with self.assertRaises(SystemExit):
+                rules.compile_rules({1: {'search': pattern, 'replace': ''}})
+        for pattern in (r'.*Kelp.*', r'(?:foo|bar)*', r'(a|b)+', r'(a+){2}', r'(?:[^,]*,)*x',
+                        r'(\w+\s)+$', r'(?:\s*<[^>]+>)*', corpus.CC3_TO_CC4_MAPPING[1]['search']):
+            self.assertIsNone(rules.backtracking_risk(pattern), pattern)
+
+    def test_possible_backtracking_warned(self):
+        """
+        Test patterns that only may backtrack exponentially
+        are warned of, and are a config error when strict
+        """
+
+        mapping = {1: {'search': r'^(a|aa)+$', 'replace': ''}}
+        self.assertFalse(rules.backtracking_risk(mapping[1]['search']).definite)
+        with self.assertLogs(rules.logger, 'WARNING') as logs:
+            self.assertEqual(len(rules.compile_rules(mapping)), 1)
+        self.assertIn('Mapping 1 search "^(a|aa)+$" may have alternatives', logs.output[0])
+        with self.assertRaises(SystemExit):
+            rules.compile_rules(mapping, strict=True)
+
+        self.config['Text']['Mapping'] = mapping
+        self.config['Text']['Strict_regex_check'] = True
+        with self.assertRaises(SystemExit):
+            metadata_updater.Runner(self.config, self.client)
+
+    @unittest.skipUnless(importlib.util.find_spec('regex'), 'regex is not installed')
+    def test_runner_reports_timeout(self):
+        """
+        Test a search that times out fails only the
+        layer, including in the transform workers
+        """
+
+        with open('data/TEST_metadata_file.iso.xml', 'rb') as f:
+            data = f.read()
+        source = os.path.join(self.destination_dir, 'source.xml')
+        with open(source, 'wb') as f:
+            f.write(data.replace(b'<gmd:fileIdentifier>',
+                                 b'<!-- ' + b'a' * 40 + b'! -->\n<gmd:fileIdentifier>', 1))
+        self.config['Text']['Mapping'] = {1: {'search': r'(a|aa)+$', 'replace': ''}}
+        self.config['Text']['Regex_timeout_ms'] = 50
+        self.config['Performance'] = {'Transform_workers': 2, 'Network_workers': 2}
+        with metadata_updater.Runner(self.config, FakeClient(source)) as runner:
+            result = runner.run()
+        self.assertEqual(result.errors, 2)
+        self.assertEqual([(o['outcome'], o['stage']) for o in result.outcomes],
+                         [(run_context.FAILED, 'update_metadata')] * 2)
+        self.assertIn('Mapping 1 search timed out', result.outcomes[0]['message'])
+
+@requires_benchmarks
+class TestMetadataUpdaterXsltRule(unittest.TestCase):
+
+    def setUp(self):
+        self.mapping = {1: {'xslt': os.path.join(os.getcwd(), 'data/cc4_licence.xsl'),
+                            'search': 'Creative Commons Attribution 3.0'}}
+        self.rules = rules.compile_rules(self.mapping)
+        self.data = corpus.generate_document(1, 6 * 1024, match=True)
+
+    def test_xslt_rule(self):
+        """
+        Test the stylesheet replaces the constraints 
+        block of documents with the search text only
+        """
+
+        self.assertIsInstance(self.rules[0], rules.XsltRule)
+        edited, applied, changes = transform.transform_document(self.data, self.rules, True)
+        self.assertEqual(applied, [1])
+        # Only the resource (not metadata) constraints are replaced
+        cc3 = corpus.CC3_TEXT.encode('utf-8')
+        self.assertEqual(edited.count(cc3), self.data.count(cc3) - 1)
+        self.assertIn(corpus.CC4_TEXT.encode('utf-8'), edited)
+        self.assertIn(b'https://creativecommons.org/licenses/by/4.0/', edited)
+        self.assertTrue(changes and all(change.path is None for change in changes))
+
+        unmatched = corpus.generate_document(1, 6 * 1024, match=False)
+        self.assertEqual(transform.transform_document(unmatched, self.rules), (None, []))
+
+    def test_xslt_rule_parameters(self):
+        """
+        Test parameters are passed to the stylesheet 
+        """
+
+        self.mapping[1]['parameters'] = {'licence': "Licensed under 'CC BY 4.0'"}
+        edited, applied = transform.transform_document(self.data, rules.compile_rules(self.mapping))
+        self.assertIn(b"Licensed under 'CC BY 4.0'", edited)
+
+    def test_xslt_rule_process_pool(self):
+        """
+        Test the stylesheet is compiled again in each
+        worker process and gives the same result
+        """
+
+        transformer = transform.Transformer(self.rules, workers=2)
+        try:
+            results = [transformer.submit(self.data).result() for _ in range(2)]
+        finally:
+            transformer.close()
+        self.assertEqual(results, [transform.transform_document(self.data, self.rules)] * 2)
+
+    def test_xslt_rule_invalid(self):
+        """
+        Test a missing or invalid stylesheet is a config error
+        """
+
+        for xslt in ('data/missing.xsl', 'data/TEST_metadata_file.iso.xml'):
+            with self.assertRaises(SystemExit):
+                rules.compile_rules({1: {'xslt': xslt}})
+
+class TestMetadataUpdaterService(RunnerTestCase):
+
+    def test_parse_layer_ids(self):
+        """
+        Test the accepted input line formats
+        """
+
+        self.assertEqual(service.parse_layer_ids('93639'), [93639])
+        self.assertEqual(service.parse_layer_ids('{"layer_id": 93639}'), [93639])
+        self.assertEqual(service.parse_layer_ids('{"layer_ids": [1, 2]}'), [1, 2])
+        self.assertEqual(service.parse_layer_ids('  '), [])
+        self.assertEqual(service.parse_layer_ids('abc'), [])
+        self.assertEqual(service.parse_layer_ids('[1, "2", "x", null]'), [1, 2])
+
+    def test_service_stdin_batches(self):
+        """
+        Test layers are processed in batches and the
+        service stops at the end of the input
+        """
+
+        runner = metadata_updater.Runner(self.config, self.client)
+        source = service.StdinSource(io.StringIO('1\n{"layer_id": 1}\n{"layer_ids": [2, 3]}\n'))
+        results = service.Service(runner, source, batch_size=2, batch_wait=1).serve()
+        self.assertEqual([result.layer_count for result in results], [2, 1])
+
+    def test_service_batches_share_outputs(self):
+        """
+        Test each batch adds to the summary workbook, diff
+        report, store run and output manifest rather than
+        starting or overwriting them
+        """
+
+        import openpyxl
+
+        store_path = os.path.join(self.destination_dir, 'metadata.sqlite')
+        self.config['Summarise'] = {'Summarise_metadata': True}
+        self.config['Output']['Diff_report'] = True
+        self.config['Store'] = {'Path': store_path, 'Label': 'service'}
+        runner = metadata_updater.Runner(self.config, self.client)
+        source = service.StdinSource(io.StringIO('1\n2\n3\n'))
+        with mock.patch.object(layout.OutputIndex, 'write', autospec=True,
+                               side_effect=layout.OutputIndex.write) as write:
+            results = service.Service(runner, source, batch_size=1, batch_wait=0).serve()
+        self.assertEqual(write.call_count, 1)
+        self.assertEqual(sorted(layout.load_manifest(self.destination_dir)), [1, 2, 3])
+        with store.MetadataStore(store_path) as metadata_store:
+            self.assertEqual([(run[2], run[3]) for run in metadata_store.runs()], [('service', 3)])
+        self.assertEqual(len(results), 3)
+        workbook = openpyxl.load_workbook(os.path.join(self.destination_dir, 'metadata_summary.xlsx'),
+                                          read_only=True)
+        rows = list(workbook.active.iter_rows(values_only=True))[1:]
+        workbook.close()
+        self.assertEqual([row[0] for row in rows], [1, 2, 3])
+        with open(os.path.join(self.destination_dir, 'metadata_changes.jsonl')) as f:
+            layer_ids = {json.loads(line)['layer_id'] for line in f}
+        self.assertEqual(layer_ids, {1, 2, 3})
+
+    def test_source_is_abstract(self):
+        """
+        Test a source must implement read
+        """
+
+        with self.assertRaises(TypeError):
+            service.Source()
+
+    def test_service_spool_directory(self):
+        """
+        Test layer ids written to the spool directory
+        are processed and the spooled file removed 
+        """
+
+        spool_dir = os.path.join(self.destination_dir, 'spool')
+        runner = metadata_updater.Runner(self.config, self.client)
+        source = service.SpoolDirectorySource(spool_dir, poll_interval=0.1)
+        with open(os.path.join(spool_dir, 'changed.jsonl'), 'w') as f:
+            f.write('1\n2\n')
+        svc = service.Service(runner, source, batch_size=2, batch_wait=1)
+        thread = threading.Thread(target=svc.serve)
+        thread.start()
+        deadline = time.monotonic() + 10
+        while not svc.results and time.monotonic() < deadline:
+            time.sleep(0.05)
+        svc.stop()
+        thread.join()
+        self.assertEqual(svc.results[0].layer_count, 2)
+        self.assertEqual(os.listdir(spool_dir), [])
+
+@requires_benchmarks
+class TestMetadataUpdaterImports(unittest.TestCase):
+
+    def test_no_heavy_imports(self):
+        """
+        Test importing the module does not load 
+        koordinates, requests, yaml, lxml or openpyxl
+        """
+
+        self.assertEqual(import_time.heavy_modules_imported(), [])
+
+@requires_benchmarks
+class TestMetadataUpdaterMockService(RunnerTestCase):
+    """
+    Full runs against the mock Data Service 
+    """
+
+    def setUp(self):
+        super(TestMetadataUpdaterMockService, self).setUp()
+        self.service = mock_service.MockDataService(seed=0)
+        for layer_id, document in corpus.generate_corpus(4, 5 * 1024, 20 * 1024, 0.5, seed=1):
+            self.service.add_layer(layer_id, document)
+        self.client = self.service.install(koordinates.Client(self.service.host, 'peanutbutter'))
+        self.config['Text']['Mapping'] = corpus.CC3_TO_CC4_MAPPING
+        self.config['Datasets']['Layers'] = sorted(self.service.layers)
+        self.config['Test']['Dry_run'] = False
+
+    def test_corpus_sizes(self):
+        """
+        Test generated documents are within the size range
+        and only matching documents carry the CC3 text 
+        """
+
+        documents = [corpus.generate_document(1, size, match)
+                     for size, match in ((5 * 1024, True), (200 * 1024, False))]
+        self.assertTrue(5 * 1024 <= len(documents[0]) < 8 * 1024)
+        self.assertTrue(200 * 1024 <= len(documents[1]) < 205 * 1024)
+        self.assertIn(corpus.CC3_TEXT.encode('utf-8'), documents[0])
+        self.assertNotIn(corpus.CC3_TEXT.encode('utf-8'), documents[1])
+
+    def test_run_publishes_edits(self):
+        """
+        Test a run drafts, posts and publishes the edited 
+        metadata for only those layers with the CC3 text
+        """
+
+        cc3 = corpus.CC3_TEXT.encode('utf-8')
+        matching = [layer_id for layer_id, layer in self.service.layers.items()
+                    if cc3 in layer.metadata[1]]
+
+        result = metadata_updater.Runner(self.config, self.client).run()
+        self.assertEqual(result.errors, 0)
+        self.assertEqual(result.layers_edited_count, len(matching))
+        self.assertEqual(len(result.publish_ids), 1)
+        for layer_id in self.service.layers:
+            published = self.service.published_metadata(layer_id)
+            self.assertNotIn(cc3, published)
+            self.assertEqual(corpus.CC4_TEXT.encode('utf-8') in published, layer_id in matching)
+
+    def test_run_retries_get_layer_errors(self):
+        """
+        Test 504s when getting a layer are retried 
+        and the layer's metadata is still processed
+        """
+
+        self.service.error_rate = 0.5
+        self.service.error_path = re.compile(r'/layers/\d+/$')
+        result = metadata_updater.Runner(self.config, self.client).run()
+        self.assertEqual(result.layer_count, 4)
+        gets = [path for method, path in self.service.requests
+                if method == 'GET' and self.service.error_path.search(path)]
+        self.assertTrue(len(gets) > 4)
+        # A failed attempt that is retried is not an error of the layer
+        self.assertEqual(result.errors, 0)
+        self.assertNotIn(run_context.FAILED, [o['outcome'] for o in result.outcomes])
+        downloaded = set(path.split('/')[2] for method, path in self.service.requests
+                         if method == 'GET' and path.endswith('/metadata/'))
+        self.assertEqual(len(downloaded), 4)
+
+    def test_run_records_get_layer_failures(self):
+        """
+        Test a layer that can not be got is recorded as
+        failed at the get_layer stage with the error
+        """
+
+        self.service.error_rate = 1.0
+        self.service.error_path = re.compile(r'/layers/\d+/$')
+        result = metadata_updater.Runner(self.config, self.client).run()
+        self.assertEqual(result.errors, 4)
+        self.assertEqual([(o['outcome'], o['stage']) for o in result.outcomes],
+                         [(run_context.FAILED, 'get_layer')] * 4)
+        self.assertTrue(all(o['message'] for o in result.outcomes))
+
+    def test_publish_batches(self):
+        """
+        Test edited drafts are published in groups
+        of Publish_batch_size
+        """
+
+        self.config['Performance'] = {'Publish_batch_size': 1}
+        result = metadata_updater.Runner(self.config, self.client).run()
+        self.assertTrue(result.layers_edited_count > 0)
+        self.assertEqual(len(result.publish_ids), result.layers_edited_count)
+        self.assertEqual(len(self.service.publishes), result.layers_edited_count)
+
+    def test_track_publishes(self):
+        """
+        Test the run waits for its publish groups, polling with
+        backoff, and records each layer as published or failed
+        """
+
+        self.service.publish_delay = 0.2
+        edited = [layer_id for layer_id, layer in self.service.layers.items()
+                  if corpus.CC3_TEXT.encode('utf-8') in layer.metadata[1]]
+        self.service.failing_publishes = {edited[0]}
+        self.config['Performance'] = {'Publish_batch_size': 1, 'Network_workers': 2,
+                                      'Track_publishes': True}
+        items = []
+        runner = metadata_updater.Runner(self.config, self.client)
+        runner.publish_listeners.append(items.append)
+        with mock.patch.object(publish_tracker, 'POLL_INTERVAL', 0.05):
+            result = runner.run()
+
+        outcomes = {o['layer_id']: o['outcome'] for o in result.outcomes}
+        self.assertEqual([layer_id for layer_id in edited if outcomes[layer_id] == run_context.PUBLISHED],
+                         edited[1:])
+        self.assertEqual(outcomes[edited[0]], run_context.FAILED)
+        self.assertEqual(result.errors, 1)
+        self.assertEqual(sorted(item['layer_id'] for item in items), sorted(edited))
+        self.assertTrue(all(item['time_to_live'] >= 0.2 for item in items))
+        polls = [path for method, path in self.service.requests
+                 if method == 'GET' and path.startswith('/publish/')]
+        # Polled at 0.05, 0.15 and 0.35s with backoff rather than every 0.05s
+        self.assertTrue(len(edited) <= len(polls) <= 3 * len(edited))
+
+    def test_publish_wait_timeout(self):
+        """
+        Test publishes are no longer waited for after the timeout
+        """
+
+        self.service.publish_delay = 60
+        self.config['Performance'] = {'Track_publishes': True, 'Publish_wait_timeout': 0.1}
+        start = time.monotonic()
+        result = metadata_updater.Runner(self.config, self.client).run()
+        self.assertTrue(time.monotonic() - start < 30)
+        self.assertEqual(result.errors, 0)
+        self.assertNotIn(run_context.PUBLISHED, [o['outcome'] for o in result.outcomes])
+
+    def downloaded_order(self):
+        return [int(path.split('/')[2]) for method, path in self.service.requests
+                if method == 'GET' and path.endswith('/metadata/')]
+
+    def test_priority(self):
+        """
+        Test layers are processed most downloaded first, and a later
+        run of selected layers is ordered from the cached catalog
+        """
+
+        layer_ids = sorted(self.service.layers)
+        for downloads, layer_id in enumerate(layer_ids):
+            self.service.layers[layer_id].num_downloads = downloads
+        self.service.layers[layer_ids[0]].public_access = None
+        self.config['Datasets']['Layers'] = 'All'
+        self.config['Test']['Dry_run'] = True
+        self.config['Performance'] = {'Priority': ['public_access', 'num_downloads']}
+        metadata_updater.Runner(self.config, self.client).run()
+        self.assertEqual(self.downloaded_order(), layer_ids[:0:-1] + layer_ids[:1])
+
+        del self.service.requests[:]
+        self.config['Datasets']['Layers'] = layer_ids + [999999]
+        self.config['Performance'] = {'Priority': 'num_downloads'}
+        metadata_updater.Runner(self.config, self.client).run()
+        self.assertEqual(self.downloaded_order()[:4], layer_ids[::-1])
+        self.assertFalse([path for method, path in self.service.requests if path.startswith('/data/')])
+
+    def test_priority_fetches_uncached(self):
+        """
+        Test layers with no cached catalog fields are fetched for
+        them, once, and the fields of the layers processed are
+        cached for later runs
+        """
+
+        layer_ids = sorted(self.service.layers)
+        for downloads, layer_id in enumerate(layer_ids):
+            self.service.layers[layer_id].num_downloads = downloads
+        self.config['Datasets']['Layers'] = layer_ids
+        self.config['Test']['Dry_run'] = True
+        self.config['Performance'] = {'Priority': 'num_downloads'}
+        metadata_updater.Runner(self.config, self.client).run()
+        self.assertEqual(self.downloaded_order(), layer_ids[::-1])
+        for layer_id in layer_ids:
+            self.assertEqual(self.service.requests.count(('GET', '/layers/{0}/'.format(layer_id))), 1)
+        with open(os.path.join(self.destination_dir, priority.CATALOG_CACHE_FILE)) as f:
+            self.assertEqual(sorted(map(int, json.load(f))), layer_ids)
+
+    def test_priority_windows(self):
+        """
+        Test layers are ordered within windows of Priority_window ids
+        """
+
+        layer_ids = sorted(self.service.layers)
+        for downloads, layer_id in enumerate(layer_ids):
+            self.service.layers[layer_id].num_downloads = downloads
+        self.config['Datasets']['Layers'] = layer_ids
+        self.config['Test']['Dry_run'] = True
+        self.config['Performance'] = {'Priority': 'num_downloads', 'Priority_window': 2}
+        metadata_updater.Runner(self.config, self.client).run()
+        self.assertEqual(self.downloaded_order(), layer_ids[1::-1] + layer_ids[:1:-1])
+
+    def test_priority_unknown_key(self):
+        """
+        Test an unknown priority key is a config error
+        """
+
+        self.config['Performance'] = {'Priority': 'popularity'}
+        with self.assertRaises(SystemExit):
+            metadata_updater.Runner(self.config, self.client)
+
+    def run_shards(self, count):
+        config = metadata_updater.ConfigReader.from_dict(self.config)
+        results = []
+        for index in range(1, count + 1):
+            config.shard = sharding.Shard(index, count)
+            config.destination_dir = sharding.shard_dir(self.destination_dir, config.shard)
+            results.append(metadata_updater.Runner(config, self.client).run())
+        return results
+
+    def test_sharded_run_and_merge(self):
+        """
+        Test shards split the layers without overlap, do not
+        publish, and the merge combines their summaries and
+        results and publishes their drafts
+        """
+
+        import openpyxl
+
+        self.config['Summarise'] = {'Summarise_metadata': True}
+        cc3 = corpus.CC3_TEXT.encode('utf-8')
+        matching = [layer_id for layer_id, layer in self.service.layers.items()
+                    if cc3 in layer.metadata[1]]
+
+        results = self.run_shards(3)
+        self.assertEqual(sum(result.layer_count for result in results), 4)
+        self.assertEqual(self.service.publishes, {})
+
+        runner = metadata_updater.Runner(self.config, self.client)
+        result = sharding.merge_shards(runner)
+        self.assertEqual(result.layer_count, 4)
+        self.assertEqual(result.errors, 0)
+        self.assertEqual(result.layers_edited_count, len(matching))
+        self.assertEqual(sorted(o['layer_id'] for o in result.outcomes), sorted(self.service.layers))
+        self.assertEqual(len(result.publish_ids), 1)
+        for layer_id in matching:
+            self.assertNotIn(cc3, self.service.published_metadata(layer_id))
+        workbook = openpyxl.load_workbook(os.path.join(self.destination_dir, 'metadata_summary.xlsx'),
+                                          read_only=True)
+        rows = list(workbook.active.iter_rows(values_only=True))[1:]
+        workbook.close()
+        self.assertEqual(sorted(row[0] for row in rows), sorted(self.service.layers))
+        for layer_id in self.service.layers:
+            self.assertTrue(os.path.isfile(layout.resolve(self.destination_dir, layer_id)))
+
+    def test_merge_diff_reports(self):
+        """
+        Test the merge combines the shards' change reports
+        """
+
+        from metadata_updater import diff_report
+
+        self.config['Output']['Diff_report'] = True
+        self.config['Test']['Dry_run'] = True
+        cc3 = corpus.CC3_TEXT.encode('utf-8')
+        matching = [layer_id for layer_id, layer in self.service.layers.items()
+                    if cc3 in layer.metadata[1]]
+        self.run_shards(3)
+        sharding.merge_shards(metadata_updater.Runner(self.config, self.client))
+        with open(os.path.join(self.destination_dir, diff_report.JSONL_FILE)) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(sorted(set(record['layer_id'] for record in records)), sorted(matching))
+        with open(os.path.join(self.destination_dir, diff_report.HTML_FILE)) as f:
+            self.assertIn('to {0} layer(s)'.format(len(matching)), f.read())
+
+    def test_merge_requires_all_shards(self):
+        """
+        Test the merge fails if a shard has not completed
+        """
+
+        self.run_shards(2)
+        os.remove(os.path.join(self.destination_dir, 'shard-2-of-2', sharding.SHARD_MANIFEST_FILE))
+        with self.assertRaises(SystemExit):
+            sharding.merge_shards(metadata_updater.Runner(self.config, self.client))
+
+    def test_adaptive_concurrency(self):
+        """
+        Test Data Service requests pass through the adaptive
+        limiter, which backs off on the injected 504s
+        """
+
+        self.service.error_rate = 0.3
+        self.service.error_path = re.compile(r'/layers/\d+/$')
+        self.config['Performance'] = {'Network_workers': 4, 'Adaptive_concurrency': True,
+                                      'Min_network_workers': 2}
+        runner = metadata_updater.Runner(self.config, self.client)
+        result = runner.run()
+        self.assertEqual(result.layer_count, 4)
+        stats = runner.limiter.stats()
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertEqual(stats['requests'], len(self.service.requests))
+        self.assertTrue(stats['errors'] > 0)
+        self.assertTrue(2 <= stats['limit'] <= 4)
+
+    def test_metadata_cache_revalidates(self):
+        """
+        Test later runs revalidate the cached metadata and
+        only download the documents that have changed
+        """
+
+        self.config['Test']['Dry_run'] = True
+        self.config['Output']['Metadata_cache'] = os.path.join(self.destination_dir, 'cache')
+        runner = metadata_updater.Runner(self.config, self.client)
+        runner.run()
+        self.assertEqual(runner.metadata_cache.stats(), {'not_modified': 0, 'downloaded': 4})
+
+        layer_id = sorted(self.service.layers)[0]
+        changed = corpus.generate_document(layer_id, 6 * 1024, match=True, seed=99)
+        self.service.set_published_metadata(layer_id, changed)
+        result = runner.run()
+        self.assertEqual(result.layer_count, 4)
+        self.assertEqual(self.service.not_modified, 3)
+        self.assertEqual(runner.metadata_cache.stats(), {'not_modified': 3, 'downloaded': 5})
+        backup = os.path.join(self.destination_dir, 'layer_{0}_Layer {0}.iso.xml._bak'.format(layer_id))
+        with open(backup, 'rb') as f:
+            self.assertEqual(f.read(), changed)
+
+    def test_metadata_cache_request_fails(self):
+        """
+        Test a failed conditional request falls back
+        to downloading the metadata uncached
+        """
+
+        self.config['Test']['Dry_run'] = True
+        self.config['Output']['Metadata_cache'] = os.path.join(self.destination_dir, 'cache')
+        runner = metadata_updater.Runner(self.config, self.client)
+        runner.run()
+        request = self.client.request
+
+        def conditional_fails(method, url, *args, **kwargs):
+            if 'If-None-Match' in kwargs.get('headers', {}):
+                raise koordinates.exceptions.ServerError('Service Unavailable')
+            return request(method, url, *args, **kwargs)
+
+        with mock.patch.object(self.client, 'request', side_effect=conditional_fails):
+            result = runner.run()
+        self.assertEqual(result.errors, 0)
+        self.assertEqual(runner.metadata_cache.stats(), {'not_modified': 0, 'downloaded': 4})
+        self.assertEqual(len(self.downloaded_order()), 8)
+
+    def test_metadata_cache_sharded_layout(self):
+        """
+        Test the cached copies are kept in the same
+        subdirectories as the sharded output
+        """
+
+        self.config['Test']['Dry_run'] = True
+        self.config['Output']['Layout'] = 'sharded'
+        cache_dir = os.path.join(self.destination_dir, 'cache')
+        self.config['Output']['Metadata_cache'] = cache_dir
+        metadata_updater.Runner(self.config, self.client).run()
+        for layer_id in self.service.layers:
+            self.assertTrue(os.path.isfile(os.path.join(
+                cache_dir, layout.bucket(layer_id), 'layer_{0}.iso.xml'.format(layer_id))))
+
+    def test_compressed_transfers(self):
+        """
+        Test metadata is downloaded and uploaded compressed
+        and the raw and wire bytes are counted
+        """
+
+        self.config['Performance'] = {'Compression': True, 'Compress_uploads': True}
+        runner = metadata_updater.Runner(self.config, self.client)
+        result = runner.run()
+        self.assertEqual(result.errors, 0)
+        self.assertTrue(result.layers_edited_count > 0)
+        stats = runner.transfer_stats.stats()
+        self.assertTrue(0 < stats['downloaded_wire'] < stats['downloaded_raw'] / 2)
+        self.assertTrue(0 < stats['uploaded_wire'] < stats['uploaded_raw'] / 2)
+        for layer_id in self.service.layers:
+            self.assertNotIn(corpus.CC3_TEXT.encode('utf-8'), self.service.published_metadata(layer_id))
+
+    def test_compressed_upload_rejected(self):
+        """
+        Test uploads are sent uncompressed once the
+        server rejects a compressed body
+        """
+
+        self.service.compressed_uploads = False
+        self.config['Performance'] = {'Compression': True, 'Compress_uploads': True}
+        runner = metadata_updater.Runner(self.config, self.client)
+        result = runner.run()
+        self.assertEqual(result.errors, 0)
+        stats = runner.transfer_stats.stats()
+        self.assertEqual(stats['uploaded_wire'], stats['uploaded_raw'])
+        for layer_id in self.service.layers:
+            self.assertNotIn(corpus.CC3_TEXT.encode('utf-8'), self.service.published_metadata(layer_id))
+
+    def test_compressed_upload_invalid(self):
+        """
+        Test a 400 for the content of a compressed upload is
+        returned, not sent again, and compression kept on, but
+        a 400 rejecting the encoding is sent again uncompressed
+        """
+
+        import requests
+        import urllib3
+
+        sent = []
+
+        def respond(request, **kwargs):
+            sent.append(request.headers.get('Content-Encoding'))
+            response = requests.Response()
+            response.status_code = 400
+            response.raw = urllib3.HTTPResponse(body=io.BytesIO(message.encode('utf-8')), status=400,
+                                                preload_content=False)
+            return response
+
+        adapter = compression.CompressionAdapter(types.SimpleNamespace(send=respond),
+                                                 compression.TransferStats(), compress_uploads=True)
+        request = requests.Request('PUT', 'https://example.com/metadata/', data=b'<xml>' * 1000,
+                                   headers={'Content-Type': 'text/xml'}).prepare()
+        message = '{"error": "metadata is not valid ISO 19139"}'
+        self.assertEqual(adapter.send(request).status_code, 400)
+        self.assertEqual(sent, ['gzip'])
+        self.assertTrue(adapter.compress_uploads)
+
+        message = '{"error": "Content-Encoding gzip is not supported"}'
+        adapter.send(request)
+        self.assertEqual(sent, ['gzip', 'gzip', None])
+        self.assertFalse(adapter.compress_uploads)
+
+    def test_pipeline_streams_summaries(self):
+        """
+        Test a pipelined run with the smallest queues
+        writes a summary row for every layer
+        """
+
+        import openpyxl
+
+        self.config['Summarise'] = {'Summarise_metadata': True}
+        self.config['Performance'] = {'Network_workers': 2, 'Queue_size': 1, 'Max_rss_mb': 1}
+        with metadata_updater.Runner(self.config, self.client) as runner:
+            result = runner.run()
+        self.assertEqual(result.errors, 0)
+        self.assertEqual(len(result.publish_ids), 1)
+        workbook = openpyxl.load_workbook(os.path.join(self.destination_dir, 'metadata_summary.xlsx'))
+        self.assertEqual(workbook.active.max_row, 5)
+
+    def test_pipeline_raises_stage_errors(self):
+        """
+        Test an unhandled error in a pipeline 
+        stage stops the run and is raised, and
+        the outputs opened are still closed
+        """
+
+        self.service.error_rate = 1.0
+        self.service.error_path = re.compile(r'/metadata/$')
+        store_path = os.path.join(self.destination_dir, 'metadata.sqlite')
+        self.config['Summarise'] = {'Summarise_metadata': True}
+        self.config['Store'] = {'Path': store_path, 'Label': 'failed'}
+        self.config['Performance'] = {'Network_workers': 2, 'Queue_size': 1}
+        with metadata_updater.Runner(self.config, self.client) as runner:
+            self.assertRaises(koordinates.exceptions.ServerError, runner.run)
+        self.assertTrue(os.path.isfile(os.path.join(self.destination_dir, 'metadata_summary.xlsx')))
+        self.assertTrue(os.path.isfile(os.path.join(self.destination_dir, layout.OUTPUT_MANIFEST_FILE)))
+        with store.MetadataStore(store_path) as metadata_store:
+            self.assertEqual([run[2] for run in metadata_store.runs()], ['failed'])
+
+    def test_pipeline_raises_layer_id_errors(self):
+        """
+        Test an error raised by the layer ids stops the
+        stages before it is raised
+        """
+
+        def layer_ids():
+            yield from sorted(self.service.layers)[:2]
+            raise RuntimeError('source failed')
+
+        self.config['Performance'] = {'Network_workers': 2, 'Queue_size': 1}
+        with metadata_updater.Runner(self.config, self.client) as runner:
+            self.assertRaises(RuntimeError, runner.run, layer_ids())
+        self.assertFalse([thread for thread in threading.enumerate()
+                          if thread.name.startswith(('download-', 'upload-'))])
+
+    def test_publish_batcher_publishes_outside_lock(self):
+        """
+        Test drafts can be added while a group is published
+        """
+
+        publishing, release = threading.Event(), threading.Event()
+        published = []
+
+        def publish(group):
+            publishing.set()
+            release.wait(5)
+            published.append(group)
+
+        def draft(version):
+            return types.SimpleNamespace(is_draft_version=True, latest_version=version)
+
+        batcher = pipeline.PublishBatcher(publish, batch_size=2)
+        batcher.add_layer_item(draft(1))
+        thread = threading.Thread(target=batcher.add_layer_item, args=(draft(2),))
+        thread.start()
+        self.assertTrue(publishing.wait(5))
+        added = threading.Thread(target=batcher.add_layer_item, args=(draft(3),))
+        added.start()
+        added.join(5)
+        self.assertFalse(added.is_alive())
+        release.set()
+        thread.join()
+        batcher.flush()
+        self.assertEqual([group.items for group in published], [[1, 2], [3]])
+
 class TestMetadataLog(unittest.TestCase):
     """
     Log Tests
@@ -220,5 +1812,59 @@ class TestMetadataLog(unittest.TestCase):
         logger = log.conf_logging('root')
         self.assertIsInstance(logger, logging.Logger)
 
+    def test_log_no_duplicate_handlers(self):
+        """
+        test repeat configuration does not
+        attach handlers more than once
+        """
+
+        logger = log.conf_logging('root')
+        handler_count = len(logger.handlers)
+        logger = log.conf_logging('root')
+        self.assertEqual(len(logger.handlers), handler_count)
+
+    def test_log_queue(self):
+        """
+        test queue mode attaches a single QueueHandler
+        """
+
+        logger = log.conf_logging('root', asynchronous=True)
+        try:
+            queue_handlers = [h for h in logger.handlers 
+                              if isinstance(h, logging.handlers.QueueHandler)]
+            self.assertEqual(len(queue_handlers), 1)
+        finally:
+            log.conf_logging('root')
+
+    def test_stage_timings_not_on_console(self):
+        """
+        test stage timings are written to the
+        log file but not the console
+        """
+
+        logger = log.conf_logging('root')
+        console, = [h for h in logger.handlers if type(h) is logging.StreamHandler]
+        rotate_file, = [h for h in logger.handlers
+                        if isinstance(h, logging.handlers.RotatingFileHandler)]
+        self.assertEqual(console.level, logging.INFO)
+        self.assertEqual(rotate_file.level, logging.NOTSET)
+
+    def test_json_formatter_stage_fields(self):
+        """
+        test structured records include the stage fields
+        """
+
+        record = logging.LogRecord('root', logging.DEBUG, __file__, 1, 
+                                   'Dataset 1: get_metadata ok', None, None)
+        record.layer_id = 1
+        record.stage = 'get_metadata'
+        record.duration = 0.5
+        record.outcome = 'ok'
+        entry = json.loads(log.JsonFormatter().format(record))
+        self.assertEqual(entry['layer_id'], 1)
+        self.assertEqual(entry['stage'], 'get_metadata')
+        self.assertEqual(entry['duration'], 0.5)
+        self.assertEqual(entry['outcome'], 'ok')
+
 if __name__ == '__main__':
     unittest.main()
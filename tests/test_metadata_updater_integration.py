@@ -178,7 +178,7 @@ class TestMetadataUpdaterUpdFileActivePub(unittest.TestCase):
     Purpose: test get_draft failure
     must hit
     
-    ERRORS += 1
+    context.add_error(layer.id, 'get_draft', ...)
     logger.critical('A draft already exists for {0} and is in a ' \
                     'publish group. THIS HAS NOT BEEN UPDATED '.format(layer.id))
     """